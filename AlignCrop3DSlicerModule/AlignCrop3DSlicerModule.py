@@ -1,7 +1,24 @@
 import os
+import sys
+import csv
+import json
+import time
+import zlib
+import shutil
+import hashlib
 import inspect
+import itertools
+import functools
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import traceback
+import contextlib
 import unittest
 import vtk, qt, ctk, slicer
+import numpy
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
 import logging
 
@@ -30,6 +47,128 @@ class AlignCrop3DSlicerModule(ScriptedLoadableModule):
     Western University(Ontario, CA) in the Auditory Biophyiscs Lab
 """ # replace with organization, grant and thanks.
 
+#
+# AlignCrop3DSlicerModuleProfiler
+#
+
+class AlignCrop3DSlicerModuleProfiler(object):
+    """Records wall time, CPU time and memory of the module stages, one record per
+    stage appended to a JSON lines (or, for a .csv path, CSV) file.
+    Recording is off until enable() is called; disabled stages only check a flag.
+    Stages nest per thread (background tasks record their own stages) and CPU time is
+    that of the recording thread where the platform provides it.
+    """
+    enabled     = False
+    outputPath  = None
+    caseName    = ''
+    local       = threading.local()
+    writeLock   = threading.Lock()
+    fields      = [ 'case', 'stage', 'parent', 'thread', 'startTime', 'wallSeconds', 'cpuSeconds',
+                    'rssBeforeMB', 'rssAfterMB', 'rssDeltaMB', 'peakRSSMB' ]
+
+    @classmethod
+    def enable(cls, outputPath, caseName=''):
+        cls.enabled     = True
+        cls.outputPath  = outputPath
+        cls.caseName    = caseName
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+
+    @classmethod
+    def setCase(cls, caseName):
+        cls.caseName = caseName
+
+    @staticmethod
+    def currentRSS():
+        """Resident set size of the process in bytes (0 if unknown)
+        """
+        try:
+            import psutil
+            return psutil.Process(os.getpid()).memory_info().rss
+        except ImportError:
+            pass
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, ValueError, AttributeError):
+            return 0
+
+    @staticmethod
+    def peakRSS():
+        """Peak resident set size of the process in bytes (0 if unknown)
+        """
+        try:
+            import resource
+        except ImportError:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    @classmethod
+    @contextlib.contextmanager
+    def stage(cls, name):
+        if not cls.enabled:
+            yield
+            return
+
+        cpuClock = getattr(time, 'thread_time', None) or getattr(time, 'process_time', None) or time.clock
+        if not hasattr(cls.local, 'stack'):
+            cls.local.stack = []
+        stack = cls.local.stack
+        parent = stack[-1] if stack else ''
+        stack.append(name)
+        rssBefore = cls.currentRSS()
+        startTime, startCPU = time.time(), cpuClock()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - startTime, cpuClock() - startCPU
+            stack.pop()
+            rssAfter = cls.currentRSS()
+            cls.write({ 'case'          : cls.caseName,
+                        'stage'         : name,
+                        'parent'        : parent,
+                        'thread'        : threading.current_thread().name,
+                        'startTime'     : round(startTime, 3),
+                        'wallSeconds'   : round(wall, 6),
+                        'cpuSeconds'    : round(cpu, 6),
+                        'rssBeforeMB'   : round(rssBefore / 1048576.0, 2),
+                        'rssAfterMB'    : round(rssAfter / 1048576.0, 2),
+                        'rssDeltaMB'    : round((rssAfter - rssBefore) / 1048576.0, 2),
+                        'peakRSSMB'     : round(cls.peakRSS() / 1048576.0, 2) })
+
+    @classmethod
+    def profile(cls, name):
+        """Method decorator recording each call as a stage
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with cls.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def write(cls, record):
+        if not cls.outputPath:
+            logging.info('Stage %(stage)s: %(wallSeconds).3f s wall, %(cpuSeconds).3f s CPU, %(rssDeltaMB)+.1f MB' % record)
+            return
+        with cls.writeLock:
+            if cls.outputPath.lower().endswith('.csv'):
+                writeHeader = not os.path.exists(cls.outputPath) or os.path.getsize(cls.outputPath) == 0
+                with open(cls.outputPath, 'a') as outputFile:
+                    writer = csv.DictWriter(outputFile, fieldnames=cls.fields)
+                    if writeHeader:
+                        writer.writeheader()
+                    writer.writerow(record)
+            else:
+                with open(cls.outputPath, 'a') as outputFile:
+                    outputFile.write(json.dumps(record, sort_keys=True) + '\n')
+
 #
 # AlignCrop3DSlicerModuleWidget
 #
@@ -124,6 +263,11 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         fiduicalPlacementCO.addWidget(self.RWButtonCO)
         parametersFormLayoutAlignCO.addRow("Fiduical Placement: ", fiduicalPlacementCO)
 
+        self.proposeButtonCO = qt.QPushButton("Propose Landmarks")
+        self.proposeButtonCO.toolTip = "Place all fiducials automatically by matching the atlas landmarks, then confirm or drag them"
+        self.proposeButtonCO.enabled = False
+        parametersFormLayoutAlignCO.addRow(self.proposeButtonCO)
+
         #
         # Align Button
         #
@@ -236,6 +380,11 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         fiduicalPlacement3.addWidget(self.RWButton)
         parametersFormLayoutAlignTB.addRow("Fiduical Placement: ", fiduicalPlacement3)
 
+        self.proposeButtonTB = qt.QPushButton("Propose Landmarks")
+        self.proposeButtonTB.toolTip = "Place all fiducials automatically by matching the atlas landmarks, then confirm or drag them"
+        self.proposeButtonTB.enabled = False
+        parametersFormLayoutAlignTB.addRow(self.proposeButtonTB)
+
 
         #
         # Align Button
@@ -289,6 +438,106 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         self.cropInputSelector.setToolTip( "select input volume " )
         parametersFormLayoutCrop.addRow("Crop Input Volume: ", self.cropInputSelector)
 
+        #
+        # Label maps & segmentations cropped with the input volume
+        #
+        self.associatedNodesSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.associatedNodesSelector.nodeTypes = ["vtkMRMLLabelMapVolumeNode", "vtkMRMLSegmentationNode"]
+        self.associatedNodesSelector.noneEnabled = False
+        self.associatedNodesSelector.addEnabled = False
+        self.associatedNodesSelector.removeEnabled = False
+        self.associatedNodesSelector.setMRMLScene(slicer.mrmlScene)
+        self.associatedNodesSelector.setToolTip("Label maps & segmentations of the input volume, aligned & cropped with exactly its geometry " +
+                                                "(nearest neighbour) in the same pass. Select them before aligning, they follow the " +
+                                                "alignment transform of the input volume")
+        parametersFormLayoutCrop.addRow("Crop Associated Labels: ", self.associatedNodesSelector)
+
+
+        #
+        # Crop directly from an uncompressed NRRD file
+        #
+        self.cropFromFileCheckBox = qt.QCheckBox()
+        self.cropFromFileCheckBox.checked = False
+        self.cropFromFileCheckBox.toolTip = "Read only the region of interest from an uncompressed NRRD file instead of the loaded input volume"
+        parametersFormLayoutCrop.addRow("Crop From File: ", self.cropFromFileCheckBox)
+
+        self.cropInputPathEdit = ctk.ctkPathLineEdit()
+        self.cropInputPathEdit.filters = ctk.ctkPathLineEdit.Files
+        self.cropInputPathEdit.nameFilters = ["NRRD (*.nrrd *.nhdr)"]
+        self.cropInputPathEdit.toolTip = "Uncompressed (raw encoding) NRRD file to crop"
+        parametersFormLayoutCrop.addRow("Crop Input File: ", self.cropInputPathEdit)
+
+        self.cropOutputPathEdit = ctk.ctkPathLineEdit()
+        self.cropOutputPathEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+        self.cropOutputPathEdit.nameFilters = ["NRRD (*.nrrd)"]
+        self.cropOutputPathEdit.toolTip = "File the cropped volume is written to"
+        parametersFormLayoutCrop.addRow("Crop Output File: ", self.cropOutputPathEdit)
+
+        self.cropTransformSelector = slicer.qMRMLNodeComboBox()
+        self.cropTransformSelector.nodeTypes = ["vtkMRMLLinearTransformNode", "vtkMRMLTransformNode"]
+        self.cropTransformSelector.addEnabled = False
+        self.cropTransformSelector.removeEnabled = False
+        self.cropTransformSelector.noneEnabled = True
+        self.cropTransformSelector.setMRMLScene( slicer.mrmlScene )
+        self.cropTransformSelector.setToolTip( "Alignment transform resampled into the cropped file (none - plain crop)" )
+        parametersFormLayoutCrop.addRow("Crop Input Transform: ", self.cropTransformSelector)
+
+        #
+        # Output scalar type of the cropped volume
+        #
+        self.outputTypeSelector = qt.QComboBox()
+        self.outputTypeSelector.addItems(AlignCrop3DSlicerModuleLogic.outputTypes)
+        self.outputTypeSelector.toolTip = "input - keep the input type, uint8/int16 - rescale the cropped intensities onto the smaller type (kept if the input type fits)"
+        parametersFormLayoutCrop.addRow("Output Type: ", self.outputTypeSelector)
+
+        #
+        # Resampling of the cropped volume
+        #
+        resamplingLayout = qt.QHBoxLayout()
+        self.outputSpacingSpinBox = qt.QDoubleSpinBox()
+        self.outputSpacingSpinBox.minimum = 0.0
+        self.outputSpacingSpinBox.maximum = 100.0
+        self.outputSpacingSpinBox.decimals = 3
+        self.outputSpacingSpinBox.singleStep = 0.01
+        self.outputSpacingSpinBox.value = 0.0
+        self.outputSpacingSpinBox.suffix = " mm"
+        self.outputSpacingSpinBox.specialValueText = "Input spacing"
+        self.outputSpacingSpinBox.toolTip = "Isotropic spacing the region of interest is resampled to while cropping"
+        resamplingLayout.addWidget(self.outputSpacingSpinBox)
+        self.isotropicCheckBox = qt.QCheckBox("Isotropic")
+        self.isotropicCheckBox.toolTip = "Resample to the smallest input spacing on all axes (when no output spacing is set)"
+        resamplingLayout.addWidget(self.isotropicCheckBox)
+        self.interpolationSelector = qt.QComboBox()
+        self.interpolationSelector.addItems(AlignCrop3DSlicerModuleLogic.cropInterpolations)
+        self.interpolationSelector.currentIndex = 1
+        self.interpolationSelector.toolTip = "Interpolation of resampled crops, sinc & bspline run through the Crop Volume module"
+        resamplingLayout.addWidget(self.interpolationSelector)
+        parametersFormLayoutCrop.addRow("Output Spacing: ", resamplingLayout)
+
+        #
+        # Region of interest fitted to the whole template or to its foreground
+        #
+        roiLayout = qt.QHBoxLayout()
+        self.roiModeSelector = qt.QComboBox()
+        self.roiModeSelector.addItems(AlignCrop3DSlicerModuleLogic.roiModes)
+        self.roiModeSelector.toolTip = "volume - whole crop template extent, foreground - bounding box of the template voxels above the threshold (non zero labels of label maps)"
+        roiLayout.addWidget(self.roiModeSelector)
+        self.roiThresholdSpinBox = ctk.ctkDoubleSpinBox()
+        self.roiThresholdSpinBox.minimum = -100000.0
+        self.roiThresholdSpinBox.maximum = 100000.0
+        self.roiThresholdSpinBox.value = self.roiThresholdSpinBox.minimum
+        self.roiThresholdSpinBox.specialValueText = "Automatic"
+        self.roiThresholdSpinBox.toolTip = "Foreground threshold of the template (Automatic - Otsu threshold)"
+        roiLayout.addWidget(self.roiThresholdSpinBox)
+        self.roiMarginSpinBox = qt.QDoubleSpinBox()
+        self.roiMarginSpinBox.minimum = 0.0
+        self.roiMarginSpinBox.maximum = 100.0
+        self.roiMarginSpinBox.singleStep = 0.5
+        self.roiMarginSpinBox.value = 1.0
+        self.roiMarginSpinBox.suffix = " mm"
+        self.roiMarginSpinBox.toolTip = "Margin added around the template foreground (rounded up to whole voxels)"
+        roiLayout.addWidget(self.roiMarginSpinBox)
+        parametersFormLayoutCrop.addRow("Region Of Interest: ", roiLayout)
 
         #
         #Define ROI & Crop buttons
@@ -306,6 +555,226 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         imageCropping.addWidget(self.cropButton)
         parametersFormLayoutCrop.addRow("Select & Crop Region of Interest: ", imageCropping)
 
+        #
+        # Advanced Options AREA
+        #
+        parametersCollapsibleButtonAdvanced = ctk.ctkCollapsibleButton()
+        parametersCollapsibleButtonAdvanced.text = "Advanced"
+        parametersCollapsibleButtonAdvanced.collapsed = True
+        self.layout.addWidget(parametersCollapsibleButtonAdvanced)
+
+        # Layout within the Advanced collapsible button
+        parametersFormLayoutAdvanced = qt.QFormLayout(parametersCollapsibleButtonAdvanced)
+
+        #
+        # Landmark registration options
+        #
+        self.transformTypeSelector = qt.QComboBox()
+        self.transformTypeSelector.addItems(["Rigid", "Similarity"])
+        self.transformTypeSelector.toolTip = "Landmark transform type (Similarity also estimates an isotropic scale)"
+        parametersFormLayoutAdvanced.addRow("Transform Type: ", self.transformTypeSelector)
+
+        self.useCLICheckBox = qt.QCheckBox()
+        self.useCLICheckBox.checked = False
+        self.useCLICheckBox.toolTip = "Run the Fiducial Registration CLI module instead of the built-in landmark solver"
+        parametersFormLayoutAdvanced.addRow("Use Fiducial Registration CLI: ", self.useCLICheckBox)
+
+        #
+        # Outlier tolerant landmark fitting
+        #
+        self.robustCheckBox = qt.QCheckBox()
+        self.robustCheckBox.checked = False
+        self.robustCheckBox.toolTip = "Reject misplaced landmarks that disagree with the fit of the others (built-in solver)"
+        parametersFormLayoutAdvanced.addRow("Robust Fitting: ", self.robustCheckBox)
+
+        self.inlierThresholdSpinBox = ctk.ctkDoubleSpinBox()
+        self.inlierThresholdSpinBox.minimum = 0.01
+        self.inlierThresholdSpinBox.maximum = 100.0
+        self.inlierThresholdSpinBox.singleStep = 0.1
+        self.inlierThresholdSpinBox.value = 1.0
+        self.inlierThresholdSpinBox.suffix = " mm"
+        self.inlierThresholdSpinBox.toolTip = "Landmarks further than this from the consensus fit are rejected"
+        parametersFormLayoutAdvanced.addRow("Inlier Distance: ", self.inlierThresholdSpinBox)
+
+        self.proposalScoreSpinBox = ctk.ctkDoubleSpinBox()
+        self.proposalScoreSpinBox.minimum = 0.0
+        self.proposalScoreSpinBox.maximum = 1.0
+        self.proposalScoreSpinBox.singleStep = 0.05
+        self.proposalScoreSpinBox.value = 0.5
+        self.proposalScoreSpinBox.toolTip = "Proposed landmarks matching the atlas with a lower correlation are left out (skipped)"
+        parametersFormLayoutAdvanced.addRow("Proposal Minimum Score: ", self.proposalScoreSpinBox)
+
+        self.surfaceThresholdSpinBox = ctk.ctkDoubleSpinBox()
+        self.surfaceThresholdSpinBox.minimum = -100000.0
+        self.surfaceThresholdSpinBox.maximum = 100000.0
+        self.surfaceThresholdSpinBox.value = self.surfaceThresholdSpinBox.minimum
+        self.surfaceThresholdSpinBox.specialValueText = "Automatic"
+        self.surfaceThresholdSpinBox.toolTip = "Bone threshold of the surface alignment used with fewer than 3 fiducials (Automatic - Otsu threshold)"
+        parametersFormLayoutAdvanced.addRow("Surface Threshold: ", self.surfaceThresholdSpinBox)
+
+        #
+        # Intensity refinement of the alignment inside the crop ROI
+        #
+        self.refinementSelector = qt.QComboBox()
+        self.refinementSelector.addItems(["none"] + AlignCrop3DSlicerModuleLogic.refinementMetrics)
+        self.refinementSelector.toolTip = "Refine the alignment by the intensities inside the crop template ROI (ncc - normalized correlation, mi - mutual information)"
+        parametersFormLayoutAdvanced.addRow("Intensity Refinement: ", self.refinementSelector)
+
+        #
+        # Deferred hardening
+        #
+        self.deferHardenCheckBox = qt.QCheckBox()
+        self.deferHardenCheckBox.checked = False
+        self.deferHardenCheckBox.toolTip = ("Keep the landmark transform as parent transform of the input volume for display only. " +
+                                            "The volume is resampled when it is cropped or when Harden Transform is pressed, " +
+                                            "and Align can be pressed again after moving fiducials")
+        parametersFormLayoutAdvanced.addRow("Defer Hardening: ", self.deferHardenCheckBox)
+
+        self.hardenButton = qt.QPushButton("Harden Transform")
+        self.hardenButton.toolTip = "Resample the aligned input volumes & fiducials with their deferred landmark transform"
+        self.hardenButton.enabled = False
+        parametersFormLayoutAdvanced.addRow(self.hardenButton)
+
+        #
+        # Live re-registration while fiducials are moved
+        #
+        self.liveUpdateCheckBox = qt.QCheckBox()
+        self.liveUpdateCheckBox.checked = False
+        self.liveUpdateCheckBox.toolTip = ("Recompute the landmark transform while the placed fiducials are moved " +
+                                           "(requires deferred hardening)")
+        parametersFormLayoutAdvanced.addRow("Live Update: ", self.liveUpdateCheckBox)
+
+        self.fiducialErrorLabel = qt.QLabel("-")
+        self.fiducialErrorLabel.toolTip = "Root mean square distance (mm) of the aligned fiducials to the template fiducials"
+        parametersFormLayoutAdvanced.addRow("Fiducial Registration Error: ", self.fiducialErrorLabel)
+
+        #
+        # Multi-atlas alignment
+        #
+        self.candidateAtlasSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.candidateAtlasSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+        self.candidateAtlasSelector.noneEnabled = False
+        self.candidateAtlasSelector.addEnabled = False
+        self.candidateAtlasSelector.removeEnabled = False
+        self.candidateAtlasSelector.setMRMLScene(slicer.mrmlScene)
+        self.candidateAtlasSelector.setToolTip("Further atlases registered together with the selected one, the best fit is applied. " +
+                                               "Fiducials are paired by name (list named like, or starting with, the atlas name)")
+        parametersFormLayoutAdvanced.addRow("Candidate Atlases: ", self.candidateAtlasSelector)
+
+        self.atlasRankingLabel = qt.QLabel("-")
+        self.atlasRankingLabel.wordWrap = True
+        parametersFormLayoutAdvanced.addRow("Atlas Ranking: ", self.atlasRankingLabel)
+
+        #
+        # Scene resources of the processed cases
+        #
+        self.sceneScope = AlignCrop3DSlicerModuleSceneScope()
+
+        self.releaseNodesButton = qt.QPushButton("Release Case Nodes")
+        self.releaseNodesButton.toolTip = ("Remove the fiducial, transform, ROI and crop parameter nodes added by the module. " +
+                                           "Transforms of volumes that were not hardened are kept")
+        parametersFormLayoutAdvanced.addRow(self.releaseNodesButton)
+
+        #
+        # Stage timing & memory instrumentation
+        #
+        self.profileCheckBox = qt.QCheckBox()
+        self.profileCheckBox.checked = False
+        self.profileCheckBox.toolTip = "Record wall time, CPU time & memory of every align/crop stage"
+        parametersFormLayoutAdvanced.addRow("Record Timings: ", self.profileCheckBox)
+
+        self.profilePathEdit = ctk.ctkPathLineEdit()
+        self.profilePathEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+        self.profilePathEdit.nameFilters = ["JSON lines (*.jsonl)", "CSV (*.csv)"]
+        self.profilePathEdit.currentPath = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleTimings.jsonl')
+        self.profilePathEdit.toolTip = "Stage records are appended to this file (.jsonl or .csv)"
+        parametersFormLayoutAdvanced.addRow("Timings File: ", self.profilePathEdit)
+
+        #
+        # Atlas cache
+        #
+        self.atlasCache = AlignCrop3DSlicerModuleAtlasCache()
+
+        self.atlasCacheCheckBox = qt.QCheckBox()
+        self.atlasCacheCheckBox.checked = True
+        self.atlasCacheCheckBox.toolTip = ("Keep the data derived from atlas/template volumes (template ROI, " +
+                                           "landmarks, preview pyramids) on disk for later cases & sessions")
+        parametersFormLayoutAdvanced.addRow("Cache Atlas Data: ", self.atlasCacheCheckBox)
+
+        self.clearAtlasCacheButton = qt.QPushButton("Clear Atlas Cache")
+        self.clearAtlasCacheButton.toolTip = "Remove all cached atlas data from " + self.atlasCache.directory
+        parametersFormLayoutAdvanced.addRow(self.clearAtlasCacheButton)
+
+        #
+        # Progressive overlay after alignment
+        #
+        self.previewCheckBox = qt.QCheckBox()
+        self.previewCheckBox.checked = True
+        self.previewCheckBox.toolTip = ("Overlay downsampled copies of large aligned & template volumes first, " +
+                                        "refined to full resolution in the background")
+        parametersFormLayoutAdvanced.addRow("Progressive Overlay: ", self.previewCheckBox)
+        self.preview = None
+
+        #
+        # Memory budget of out-of-core cropping
+        #
+        self.memoryBudgetSpinBox = qt.QSpinBox()
+        self.memoryBudgetSpinBox.minimum = 64
+        self.memoryBudgetSpinBox.maximum = 1024 * 1024
+        self.memoryBudgetSpinBox.singleStep = 256
+        self.memoryBudgetSpinBox.value = 1024
+        self.memoryBudgetSpinBox.suffix = " MB"
+        self.memoryBudgetSpinBox.toolTip = "Working memory of a file crop resampled through its transform"
+        parametersFormLayoutAdvanced.addRow("File Crop Memory Budget: ", self.memoryBudgetSpinBox)
+
+        #
+        # Compression of the files written by file crops
+        #
+        compressionLayout = qt.QHBoxLayout()
+        self.outputEncodingSelector = qt.QComboBox()
+        self.outputEncodingSelector.addItems(["gzip", "raw"])
+        self.outputEncodingSelector.toolTip = "gzip is compressed on all cores, raw (uncompressed) is fastest for scratch storage"
+        compressionLayout.addWidget(self.outputEncodingSelector)
+        self.compressionLevelSpinBox = qt.QSpinBox()
+        self.compressionLevelSpinBox.minimum = 1
+        self.compressionLevelSpinBox.maximum = 9
+        self.compressionLevelSpinBox.value = 1
+        self.compressionLevelSpinBox.prefix = "Level "
+        self.compressionLevelSpinBox.toolTip = "1 - fastest, 9 - smallest files"
+        compressionLayout.addWidget(self.compressionLevelSpinBox)
+        parametersFormLayoutAdvanced.addRow("File Crop Output Encoding: ", compressionLayout)
+
+        #
+        # Background processing
+        #
+        self.backgroundCheckBox = qt.QCheckBox()
+        self.backgroundCheckBox.checked = True
+        self.backgroundCheckBox.toolTip = ("Run the registration CLI and the cropping in the background, " +
+                                           "keeping the views responsive and allowing to cancel")
+        parametersFormLayoutAdvanced.addRow("Run In Background: ", self.backgroundCheckBox)
+
+        #
+        # Progress of background processing
+        #
+        progressLayout = qt.QHBoxLayout()
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.visible = False
+        progressLayout.addWidget(self.progressBar)
+        self.cancelButton = qt.QPushButton("Cancel")
+        self.cancelButton.toolTip = "Stop the running registration or crop"
+        self.cancelButton.visible = False
+        progressLayout.addWidget(self.cancelButton)
+        self.layout.addLayout(progressLayout)
+        self.backgroundTask = None
+        self.backgroundCLI  = None
+
+        #Coalesce point modified events so dragging stays fluid
+        self.liveUpdateTimer = qt.QTimer()
+        self.liveUpdateTimer.setSingleShot(True)
+        self.liveUpdateTimer.setInterval(50)
+        self.liveAlignment = None
+
         #
         # Volume connections
         #
@@ -319,6 +788,7 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         self.AButton.connect('clicked(bool)', self.onAButton)
         self.RWButtonCO.connect('clicked(bool)', self.onRWButtonCO)
         self.alignButtonCO.connect('clicked(bool)', self.onAlignButtonCO)
+        self.proposeButtonCO.connect('clicked(bool)', self.onProposeButtonCO)
 
         # Temporal Bone
         self.templateAtlasSelectorTB.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectAlignTB)
@@ -332,13 +802,28 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
         self.OWButton.connect('clicked(bool)', self.onOWButton)
         self.RWButton.connect('clicked(bool)', self.onRWButton)
         self.alignButtonTB.connect('clicked(bool)', self.onAlignButtonTB)
+        self.proposeButtonTB.connect('clicked(bool)', self.onProposeButtonTB)
 
         #Crop Volumes
         self.cropTemplateSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectCrop)
         self.cropInputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelectCrop)
+        self.cropFromFileCheckBox.connect('toggled(bool)', self.onSelectCrop)
+        self.cropInputPathEdit.connect('currentPathChanged(QString)', self.onSelectCrop)
+        self.cropOutputPathEdit.connect('currentPathChanged(QString)', self.onSelectCrop)
         self.defineCropButton.connect('clicked(bool)', self.onDefineCropButton)
         self.cropButton.connect('clicked(bool)', self.onCropButton)
 
+        #Advanced
+        self.hardenButton.connect('clicked(bool)', self.onHardenButton)
+        self.releaseNodesButton.connect('clicked(bool)', self.onReleaseNodesButton)
+        self.profileCheckBox.connect('toggled(bool)', self.onProfileChanged)
+        self.profilePathEdit.connect('currentPathChanged(QString)', self.onProfileChanged)
+        self.liveUpdateCheckBox.connect('toggled(bool)', self.onLiveUpdateToggled)
+        self.deferHardenCheckBox.connect('toggled(bool)', self.onDeferHardenToggled)
+        self.liveUpdateTimer.connect('timeout()', self.updateLiveAlignment)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+        self.clearAtlasCacheButton.connect('clicked(bool)', self.onClearAtlasCacheButton)
+
         # Add vertical spacer
         self.layout.addStretch(1)
 
@@ -350,18 +835,20 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
     #Align Cochlear Only Buttons
     def onOWButtonCO(self):
 
+        self.stopLiveAlignment()
+
         #initialize placement checklist
         self.placementListCO = {'OW': True, 'CN': True, 'A': True,'RW': True} #Tracking skipped fiducial
 
-        #Setup Fiduical placement
-        self.movingFiducialNodeCO = slicer.vtkMRMLMarkupsFiducialNode()
-        slicer.mrmlScene.AddNode(self.movingFiducialNodeCO)
+        #Setup Fiduical placement (reusing the fiducial node of the previous case)
+        self.movingFiducialNodeCO = self.sceneScope.getNode('movingFiducialCO', 'vtkMRMLMarkupsFiducialNode', 'F')
 
         #Fiduical Placement Widget
-        self.fiducialWidgetCO = slicer.qSlicerMarkupsPlaceWidget()
-        self.fiducialWidgetCO.buttonsVisible = False
-        self.fiducialWidgetCO.placeButton().show()
-        self.fiducialWidgetCO.setMRMLScene(slicer.mrmlScene)
+        if not hasattr(self, 'fiducialWidgetCO'):
+            self.fiducialWidgetCO = slicer.qSlicerMarkupsPlaceWidget()
+            self.fiducialWidgetCO.buttonsVisible = False
+            self.fiducialWidgetCO.placeButton().show()
+            self.fiducialWidgetCO.setMRMLScene(slicer.mrmlScene)
         self.fiducialWidgetCO.setCurrentNode(self.movingFiducialNodeCO)
         self.fiducialWidgetCO.placeMultipleMarkups = slicer.qSlicerMarkupsPlaceWidget.ForcePlaceSingleMarkup
 
@@ -442,59 +929,114 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
         self.RWButtonCO.enabled = False
         self.alignButtonCO.enabled = False
+        deferHarden = self.deferHardenCheckBox.checked
 
-        self.landmarkTransformCO = slicer.vtkMRMLTransformNode()
-        slicer.mrmlScene.AddNode(self.landmarkTransformCO)
+        #Re-aligning a deferred case updates its transform in place
+        if not (deferHarden and hasattr(self, 'landmarkTransformCO') and
+                self.inputVolumeCO.GetTransformNodeID() == self.landmarkTransformCO.GetID()):
+            self.landmarkTransformCO = self.sceneScope.getNode('landmarkTransformCO', 'vtkMRMLTransformNode', 'LandmarkTransform')
 
+        AlignCrop3DSlicerModuleProfiler.setCase(self.inputVolumeCO.GetName())
         logic = AlignCrop3DSlicerModuleLogic()
         if(self.movingFiducialNodeCO.GetNumberOfFiducials() > 2):
-            logic.runAlignmentRegistration(self.landmarkTransformCO, self.templateFidCO, self.movingFiducialNodeCO, self.placementListCO)
-        else:
-            slicer.util.infoDisplay("At least 3 fiducials required for registration to proceed")
-
-        #Apply Landmark transform on input Volume & Fiducials and Harden
-        self.inputVolumeCO.SetAndObserveTransformNodeID(self.landmarkTransformCO.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.inputVolumeCO)
-        self.movingFiducialNodeCO.SetAndObserveTransformNodeID(self.landmarkTransformCO.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.movingFiducialNodeCO)
-
-
-        #Set template to foreground in Slice Views
-        applicationLogic 	= slicer.app.applicationLogic()
-        selectionNode 		= applicationLogic.GetSelectionNode()
-        selectionNode.SetSecondaryVolumeID(self.templateVolumeCO.GetID())
-        applicationLogic.PropagateForegroundVolumeSelection(0)
-
-        #set overlap of foreground & background in slice view
-        sliceLayout = slicer.app.layoutManager()
-        sliceLogicR = sliceLayout.sliceWidget('Red').sliceLogic()
-        compositeNodeR = sliceLogicR.GetSliceCompositeNode()
-        compositeNodeR.SetForegroundOpacity(0.5)
-        sliceLogicY = sliceLayout.sliceWidget('Yellow').sliceLogic()
-        compositeNodeY = sliceLogicY.GetSliceCompositeNode()
-        compositeNodeY.SetForegroundOpacity(0.5)
-        sliceLogicG = sliceLayout.sliceWidget('Green').sliceLogic()
-        compositeNodeG = sliceLogicG.GetSliceCompositeNode()
-        compositeNodeG.SetForegroundOpacity(0.5)
+            if self.candidateAtlasSelector.checkedNodes():
+                if not self.runMultiAtlasAlignment(self.landmarkTransformCO, self.movingFiducialNodeCO, self.placementListCO,
+                                                   self.templateAtlasSelectorCO, self.templateFidSelectorCO):
+                    self.alignButtonCO.enabled = True
+                    return
+            elif self.useCLICheckBox.checked and self.backgroundCheckBox.checked and not self.robustCheckBox.checked:
+                self.startBackgroundCLI(self.landmarkTransformCO, self.templateFidCO, self.movingFiducialNodeCO, self.placementListCO,
+                                        functools.partial(self.finishAlignCO, deferHarden), self.alignButtonCO)
+                return
+            elif not self.runLandmarkAlignment(self.landmarkTransformCO, self.templateFidCO, self.movingFiducialNodeCO, self.placementListCO):
+                self.alignButtonCO.enabled = True
+                return
+        elif not self.runSurfaceAlignment(self.landmarkTransformCO, self.templateVolumeCO, self.inputVolumeCO,
+                                          self.templateFidCO, self.movingFiducialNodeCO, self.placementListCO):
+            self.alignButtonCO.enabled = True
+            return
+        self.finishAlignCO(deferHarden)
+
+    def finishAlignCO(self, deferHarden):
+
+        self.refineAlignment(self.landmarkTransformCO, self.templateVolumeCO, self.inputVolumeCO,
+                             self.templateFidCO, self.movingFiducialNodeCO, self.placementListCO)
+
+        #Apply Landmark transform on input Volume, its associated labels & Fiducials and Harden
+        alignedNodes = [self.inputVolumeCO, self.movingFiducialNodeCO] + list(self.associatedNodesSelector.checkedNodes())
+        for node in alignedNodes:
+            node.SetAndObserveTransformNodeID(self.landmarkTransformCO.GetID())
+        if deferHarden:
+            #Transform kept for display, resampled on crop or Harden Transform
+            self.alignButtonCO.enabled = True
+            self.hardenButton.enabled = True
+        else:
+            with AlignCrop3DSlicerModuleProfiler.stage('harden'):
+                for node in alignedNodes:
+                    slicer.vtkSlicerTransformLogic().hardenTransform(node)
+
+
+        with AlignCrop3DSlicerModuleProfiler.stage('viewRefresh'):
+            #Set template to foreground in Slice Views
+            applicationLogic 	= slicer.app.applicationLogic()
+            selectionNode 		= applicationLogic.GetSelectionNode()
+            selectionNode.SetSecondaryVolumeID(self.templateVolumeCO.GetID())
+            applicationLogic.PropagateForegroundVolumeSelection(0)
+
+            #set overlap of foreground & background in slice view
+            sliceLayout = slicer.app.layoutManager()
+            sliceLogicR = sliceLayout.sliceWidget('Red').sliceLogic()
+            compositeNodeR = sliceLogicR.GetSliceCompositeNode()
+            compositeNodeR.SetForegroundOpacity(0.5)
+            sliceLogicY = sliceLayout.sliceWidget('Yellow').sliceLogic()
+            compositeNodeY = sliceLogicY.GetSliceCompositeNode()
+            compositeNodeY.SetForegroundOpacity(0.5)
+            sliceLogicG = sliceLayout.sliceWidget('Green').sliceLogic()
+            compositeNodeG = sliceLogicG.GetSliceCompositeNode()
+            compositeNodeG.SetForegroundOpacity(0.5)
+            self.startPreview(self.inputVolumeCO, self.templateVolumeCO)
 
         #centre slice viewer on image
-        slicer.app.applicationLogic().FitSliceToAll()
+        with AlignCrop3DSlicerModuleProfiler.stage('fitSliceToAll'):
+            slicer.app.applicationLogic().FitSliceToAll()
+
+        self.updateFiducialError(self.landmarkTransformCO)
+        if deferHarden and self.liveUpdateCheckBox.checked:
+            self.startLiveAlignment(self.landmarkTransformCO, self.templateFidCO, self.movingFiducialNodeCO, self.placementListCO)
+
+    def onProposeButtonCO(self):
+
+        self.stopLiveAlignment()
+        self.movingFiducialNodeCO = self.sceneScope.getNode('movingFiducialCO', 'vtkMRMLMarkupsFiducialNode', 'F')
+        self.proposeLandmarks(self.inputVolumeCO, self.templateVolumeCO, self.templateFidCO, self.movingFiducialNodeCO,
+                              self.proposeButtonCO, self.finishProposeCO)
+
+    def finishProposeCO(self, placementList):
+
+        self.placementListCO = placementList
+
+        #Proposed fiducials are confirmed (or dragged) before aligning
+        for button in [self.OWButtonCO, self.CNButton, self.AButton, self.RWButtonCO]:
+            button.enabled = False
+        self.alignButtonCO.enabled = True
 
     #Align Temporal Bone Buttons
     def onPAButton(self):
 
+        self.stopLiveAlignment()
+
         #initialize placement checklist
         self.placementListTB = {'PA': True, 'GG': True, 'SF': True,'AE': True,'PSC': True,'OW': True,'RW': True} #Tracking skipped fiducial
 
-        #Setup Fiduical placement
-        self.movingFiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
-        slicer.mrmlScene.AddNode(self.movingFiducialNode)
+        #Setup Fiduical placement (reusing the fiducial node of the previous case)
+        self.movingFiducialNode = self.sceneScope.getNode('movingFiducialTB', 'vtkMRMLMarkupsFiducialNode', 'F')
 
         #Fiduical Placement Widget
-        self.fiducialWidget = slicer.qSlicerMarkupsPlaceWidget()
-        self.fiducialWidget.buttonsVisible = False
-        self.fiducialWidget.placeButton().show()
-        self.fiducialWidget.setMRMLScene(slicer.mrmlScene)
+        if not hasattr(self, 'fiducialWidget'):
+            self.fiducialWidget = slicer.qSlicerMarkupsPlaceWidget()
+            self.fiducialWidget.buttonsVisible = False
+            self.fiducialWidget.placeButton().show()
+            self.fiducialWidget.setMRMLScene(slicer.mrmlScene)
         self.fiducialWidget.setCurrentNode(self.movingFiducialNode)
         self.fiducialWidget.placeMultipleMarkups = slicer.qSlicerMarkupsPlaceWidget.ForcePlaceSingleMarkup
 
@@ -549,7 +1091,7 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
             self.SFButton.enabled = False
             self.AEButton.enabled = True
         else:
-            self.placementListTB['GG'] = False
+            self.placementListTB['SF'] = False
             #Enable/Disable Buttons
             self.SFButton.enabled = False
             self.AEButton.enabled = True
@@ -639,55 +1181,150 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
         self.RWButton.enabled = False
         self.alignButtonTB.enabled = False
+        deferHarden = self.deferHardenCheckBox.checked
 
-        self.landmarkTransform = slicer.vtkMRMLTransformNode()
-        slicer.mrmlScene.AddNode(self.landmarkTransform)
+        #Re-aligning a deferred case updates its transform in place
+        if not (deferHarden and hasattr(self, 'landmarkTransform') and
+                self.inputVolumeTB.GetTransformNodeID() == self.landmarkTransform.GetID()):
+            self.landmarkTransform = self.sceneScope.getNode('landmarkTransformTB', 'vtkMRMLTransformNode', 'LandmarkTransform')
 
+        AlignCrop3DSlicerModuleProfiler.setCase(self.inputVolumeTB.GetName())
         logic = AlignCrop3DSlicerModuleLogic()
         if(self.movingFiducialNode.GetNumberOfFiducials() > 2):
-            logic.runAlignmentRegistration(self.landmarkTransform, self.templateFidTB, self.movingFiducialNode, self.placementListTB)
+            if self.candidateAtlasSelector.checkedNodes():
+                if not self.runMultiAtlasAlignment(self.landmarkTransform, self.movingFiducialNode, self.placementListTB,
+                                                   self.templateAtlasSelectorTB, self.templateFidSelectorTB):
+                    self.alignButtonTB.enabled = True
+                    return
+            elif self.useCLICheckBox.checked and self.backgroundCheckBox.checked and not self.robustCheckBox.checked:
+                self.startBackgroundCLI(self.landmarkTransform, self.templateFidTB, self.movingFiducialNode, self.placementListTB,
+                                        functools.partial(self.finishAlignTB, deferHarden), self.alignButtonTB)
+                return
+            elif not self.runLandmarkAlignment(self.landmarkTransform, self.templateFidTB, self.movingFiducialNode, self.placementListTB):
+                self.alignButtonTB.enabled = True
+                return
+        elif not self.runSurfaceAlignment(self.landmarkTransform, self.templateVolumeTB, self.inputVolumeTB,
+                                          self.templateFidTB, self.movingFiducialNode, self.placementListTB):
+            self.alignButtonTB.enabled = True
+            return
+        self.finishAlignTB(deferHarden)
+
+    def finishAlignTB(self, deferHarden):
+
+        self.refineAlignment(self.landmarkTransform, self.templateVolumeTB, self.inputVolumeTB,
+                             self.templateFidTB, self.movingFiducialNode, self.placementListTB)
+
+        #Apply Landmark transform on input Volume, its associated labels & Fiducials and Harden
+        alignedNodes = [self.inputVolumeTB, self.movingFiducialNode] + list(self.associatedNodesSelector.checkedNodes())
+        for node in alignedNodes:
+            node.SetAndObserveTransformNodeID(self.landmarkTransform.GetID())
+        if deferHarden:
+            #Transform kept for display, resampled on crop or Harden Transform
+            self.alignButtonTB.enabled = True
+            self.hardenButton.enabled = True
         else:
-            slicer.util.infoDisplay("At least 3 fiducials required for registration to proceed")
-
-        #Apply Landmark transform on input Volume & Fiducials and Harden
-        self.inputVolumeTB.SetAndObserveTransformNodeID(self.landmarkTransform.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.inputVolumeTB)
-        self.movingFiducialNode.SetAndObserveTransformNodeID(self.landmarkTransform.GetID())
-        slicer.vtkSlicerTransformLogic().hardenTransform(self.movingFiducialNode)
+            with AlignCrop3DSlicerModuleProfiler.stage('harden'):
+                for node in alignedNodes:
+                    slicer.vtkSlicerTransformLogic().hardenTransform(node)
 
 
         #TODO - Align output is incorrect!! Investigate (Jan 17th - 2018)
 
-        #Set template to foreground in Slice Views
-        applicationLogic 	= slicer.app.applicationLogic()
-        selectionNode 		= applicationLogic.GetSelectionNode()
-        selectionNode.SetSecondaryVolumeID(self.templateVolumeTB.GetID())
-        applicationLogic.PropagateForegroundVolumeSelection(0)
-
-        #set overlap of foreground & background in slice view
-        sliceLayout = slicer.app.layoutManager()
-        sliceLogicR = sliceLayout.sliceWidget('Red').sliceLogic()
-        compositeNodeR = sliceLogicR.GetSliceCompositeNode()
-        compositeNodeR.SetForegroundOpacity(0.5)
-        sliceLogicY = sliceLayout.sliceWidget('Yellow').sliceLogic()
-        compositeNodeY = sliceLogicY.GetSliceCompositeNode()
-        compositeNodeY.SetForegroundOpacity(0.5)
-        sliceLogicG = sliceLayout.sliceWidget('Green').sliceLogic()
-        compositeNodeG = sliceLogicG.GetSliceCompositeNode()
-        compositeNodeG.SetForegroundOpacity(0.5)
+        with AlignCrop3DSlicerModuleProfiler.stage('viewRefresh'):
+            #Set template to foreground in Slice Views
+            applicationLogic 	= slicer.app.applicationLogic()
+            selectionNode 		= applicationLogic.GetSelectionNode()
+            selectionNode.SetSecondaryVolumeID(self.templateVolumeTB.GetID())
+            applicationLogic.PropagateForegroundVolumeSelection(0)
+
+            #set overlap of foreground & background in slice view
+            sliceLayout = slicer.app.layoutManager()
+            sliceLogicR = sliceLayout.sliceWidget('Red').sliceLogic()
+            compositeNodeR = sliceLogicR.GetSliceCompositeNode()
+            compositeNodeR.SetForegroundOpacity(0.5)
+            sliceLogicY = sliceLayout.sliceWidget('Yellow').sliceLogic()
+            compositeNodeY = sliceLogicY.GetSliceCompositeNode()
+            compositeNodeY.SetForegroundOpacity(0.5)
+            sliceLogicG = sliceLayout.sliceWidget('Green').sliceLogic()
+            compositeNodeG = sliceLogicG.GetSliceCompositeNode()
+            compositeNodeG.SetForegroundOpacity(0.5)
+            self.startPreview(self.inputVolumeTB, self.templateVolumeTB)
 
         #centre slice viewer on image
-        slicer.app.applicationLogic().FitSliceToAll()
+        with AlignCrop3DSlicerModuleProfiler.stage('fitSliceToAll'):
+            slicer.app.applicationLogic().FitSliceToAll()
         #Make Atlas Fidcials visible
         self.templateFidTB.SetDisplayVisibility(1)
 
+        self.updateFiducialError(self.landmarkTransform)
+        if deferHarden and self.liveUpdateCheckBox.checked:
+            self.startLiveAlignment(self.landmarkTransform, self.templateFidTB, self.movingFiducialNode, self.placementListTB)
+
+
+    def onProposeButtonTB(self):
+
+        self.stopLiveAlignment()
+        self.movingFiducialNode = self.sceneScope.getNode('movingFiducialTB', 'vtkMRMLMarkupsFiducialNode', 'F')
+        self.proposeLandmarks(self.inputVolumeTB, self.templateVolumeTB, self.templateFidTB, self.movingFiducialNode,
+                              self.proposeButtonTB, self.finishProposeTB)
+
+    def finishProposeTB(self, placementList):
+
+        self.placementListTB = placementList
+
+        #Proposed fiducials are confirmed (or dragged) before aligning
+        for button in [self.PAButton, self.GGButton, self.SFButton, self.AEButton, self.PSCButton, self.OWButton, self.RWButton]:
+            button.enabled = False
+        self.alignButtonTB.enabled = True
+
+    def proposeLandmarks(self, inputVolume, templateVolume, templateFiducial, movingFiducial, proposeButton, onProposed):
+        """Proposes the landmarks by template matching in a worker thread, then fills movingFiducial
+        with them and calls onProposed(placementChecklist). Failures are displayed
+        """
+        if self.backgroundTask and self.backgroundTask.isRunning():
+            slicer.util.showStatusMessage("Wait for the running task or cancel it", 5000)
+            return
+        logic = AlignCrop3DSlicerModuleLogic()
+        cache = self.atlasCache if self.atlasCacheCheckBox.checked else None
+        try:
+            compute = logic.startProposeLandmarks(inputVolume, templateVolume, templateFiducial, cache=cache)
+        except ValueError as e:
+            slicer.util.errorDisplay("Landmark proposal failed: %s" % e)
+            return
+
+        def onFinished(proposals):
+            self.hideProgress()
+            proposeButton.enabled = True
+            placementList = logic.applyLandmarkProposals(movingFiducial, proposals, self.proposalScoreSpinBox.value)
+            slicer.util.showStatusMessage("Proposed landmarks: " + ", ".join("%s %.2f" % (proposal['key'], proposal['score'])
+                                                                             for proposal in proposals), 10000)
+            onProposed(placementList)
+        def onFailed(error):
+            self.hideProgress()
+            proposeButton.enabled = True
+            if isinstance(error, AlignCrop3DSlicerModuleCancelledError):
+                slicer.util.showStatusMessage("Landmark proposal cancelled", 5000)
+            else:
+                slicer.util.errorDisplay("Landmark proposal failed: %s" % error)
+
+        def profiledCompute(progressCallback, cancelEvent):
+            with AlignCrop3DSlicerModuleProfiler.stage('proposeLandmarks'):
+                return compute(progressCallback, cancelEvent)
+        proposeButton.enabled = False
+        self.backgroundTask = AlignCrop3DSlicerModuleTask(profiledCompute, onFinished=onFinished, onFailed=onFailed,
+                                                          onProgress=self.setProgress)
+        self.showProgress("Proposing landmarks")
+        self.backgroundTask.start()
 
     #Cropping Buttons
     def onDefineCropButton(self):
 
         #Define logic & retrieve atlas/template region of interest (ROI)
-        logic = AlignCrop3DSlicerModuleLogic()
-        self.templateROI = logic.runDefineCropROIVoxel(self.cropTemplateVolume)
+        try:
+            self.templateROI = self.defineCropROI(self.cropTemplateVolume)
+        except ValueError as e:
+            slicer.util.errorDisplay("Region of interest failed: %s" % e)
+            return
 
         #Enable cropping button
         self.cropButton.enabled = True
@@ -696,21 +1333,452 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
         #cropVolume
         logic = AlignCrop3DSlicerModuleLogic()
-        logic.runCropVolume(    self.templateROI,
-                                self.cropInputSelector.currentNode())
+        associatedNodes = [] if self.cropFromFileCheckBox.checked else self.associatedNodesSelector.checkedNodes()
+        #sinc & bspline crops run in the Crop Volume module, on the main thread
+        if self.backgroundCheckBox.checked and self.interpolationSelector.currentText in logic.resampleInterpolations \
+                and not associatedNodes and (self.cropFromFileCheckBox.checked or not self.templateROI.GetParentTransformNode()):
+            self.startBackgroundCrop(logic)
+            return
+        outputType      = self.outputTypeSelector.currentText
+        interpolation   = self.interpolationSelector.currentText
+        inputVolume     = self.cropInputSelector.currentNode()
+        if associatedNodes:
+            #Volume, label maps & segmentations resampled together through the (possibly unhardened) transform
+            try:
+                croppedVolume, croppedNodes = logic.runCropVolumeGroup( self.templateROI,
+                                                                        inputVolume,
+                                                                        associatedNodes,
+                                                                        interpolation=interpolation,
+                                                                        outputType=outputType,
+                                                                        spacing=self.getOutputSpacing(inputVolume))
+            except ValueError as e:
+                slicer.util.errorDisplay("Crop failed: %s" % e)
+                return
+            castStats = logic.getCastStats(croppedVolume)
+        elif self.cropFromFileCheckBox.checked:
+            castStats = {}
+            outputPath = self.cropOutputPathEdit.currentPath
+            try:
+                self.createFileCrop(logic, castStats)(None, None)
+            except (ValueError, IOError, OSError) as e:
+                #non-NRRD, compressed or non-overlapping input: no partial output is left
+                if os.path.exists(outputPath):
+                    os.remove(outputPath)
+                slicer.util.errorDisplay("Crop failed: %s" % e)
+                return
+            slicer.util.loadVolume(outputPath)
+        elif inputVolume.GetParentTransformNode() and interpolation in logic.resampleInterpolations:
+            #Transformed (not hardened) input, resample the ROI through the transform in one pass
+            croppedVolume = logic.runAlignCropVolume(   self.templateROI,
+                                                        inputVolume,
+                                                        interpolation=interpolation,
+                                                        outputType=outputType,
+                                                        spacing=self.getOutputSpacing(inputVolume))
+            castStats = logic.getCastStats(croppedVolume)
+        else:
+            croppedVolume = logic.runCropVolume(    self.templateROI,
+                                                    inputVolume,
+                                                    scope=self.sceneScope,
+                                                    outputType=outputType,
+                                                    spacing=self.getOutputSpacing(inputVolume),
+                                                    interpolation=interpolation)
+            castStats = logic.getCastStats(croppedVolume) if croppedVolume else None
+
+
+        self.finishCrop(castStats)
 
+    def finishCrop(self, castStats=None):
 
         #TODO - setup layout on slicer view after cropping.
         #centre slice viewer on image
-        slicer.app.applicationLogic().FitSliceToAll()
+        with AlignCrop3DSlicerModuleProfiler.stage('fitSliceToAll'):
+            slicer.app.applicationLogic().FitSliceToAll()
+
+        self.cropButton.enabled = False
+        if castStats and 'inputRange' in castStats:
+            slicer.util.showStatusMessage("Cropped to %s, range %g - %g, %.2f%% voxels clipped" % (
+                castStats['outputType'], castStats['inputRange'][0], castStats['inputRange'][1],
+                100.0 * castStats['clippedFraction']), 10000)
+
+    #Surface alignment of cases with fewer than 3 fiducials
+    def runLandmarkAlignment(self, transform, templateFiducial, movingFiducial, placementChecklist):
+        logic = AlignCrop3DSlicerModuleLogic()
+        try:
+            logic.runAlignmentRegistration(transform, templateFiducial, movingFiducial, placementChecklist,
+                                           transformType=self.transformTypeSelector.currentText,
+                                           useCLI=self.useCLICheckBox.checked,
+                                           robust=self.robustCheckBox.checked,
+                                           inlierThreshold=self.inlierThresholdSpinBox.value)
+        except (ValueError, RuntimeError) as e:
+            #Too few inliers of the robust fit or Fiducial Registration CLI failed (see checkCLIStatus)
+            slicer.util.errorDisplay("Fiducial registration failed: %s" % e)
+            return False
+        return True
+
+    def runSurfaceAlignment(self, transform, templateVolume, inputVolume, templateFiducial, movingFiducial, placementChecklist):
+        logic = AlignCrop3DSlicerModuleLogic()
+        threshold = self.surfaceThresholdSpinBox.value
+        if threshold == self.surfaceThresholdSpinBox.minimum:
+            threshold = None
+        try:
+            logic.runSurfaceRegistration(transform, templateVolume, inputVolume, templateFiducial, movingFiducial,
+                                         placementChecklist, transformType=self.transformTypeSelector.currentText,
+                                         threshold=threshold)
+        except ValueError as e:
+            slicer.util.errorDisplay("Surface alignment failed: %s" % e)
+            return False
+        return True
+
+    #Template ROI with the selected ROI mode
+    def defineCropROI(self, templateVolume):
+        logic = AlignCrop3DSlicerModuleLogic()
+        cache = self.atlasCache if self.atlasCacheCheckBox.checked else None
+        threshold = self.roiThresholdSpinBox.value
+        if threshold == self.roiThresholdSpinBox.minimum:
+            threshold = None
+        return logic.runDefineCropROIVoxel(templateVolume, scope=self.sceneScope, cache=cache,
+                                           mode=self.roiModeSelector.currentText, threshold=threshold,
+                                           margin=self.roiMarginSpinBox.value)
+
+    #Intensity refinement inside the ROI of the crop template (the alignment template if none selected)
+    def refineAlignment(self, transform, templateVolume, inputVolume, templateFiducial, movingFiducial, placementChecklist):
+        metric = self.refinementSelector.currentText
+        if metric not in AlignCrop3DSlicerModuleLogic.refinementMetrics:
+            return
+        logic = AlignCrop3DSlicerModuleLogic()
+        try:
+            roi = self.defineCropROI(self.cropTemplateSelector.currentNode() or templateVolume)
+            logic.runIntensityRefinement(transform, templateVolume, inputVolume, roi, metric=metric,
+                                         fixedFiducial=templateFiducial, movingFiducial=movingFiducial,
+                                         placementChecklist=placementChecklist)
+        except ValueError as e:
+            slicer.util.errorDisplay("Intensity refinement failed: %s" % e)
+            return
+        refinement = logic.getRegistrationQuality(transform)['refinement']
+        slicer.util.showStatusMessage("Refined by %.2f mm, %.2f deg (%s %.3f -> %.3f)" % (
+            refinement['translationMM'], refinement['rotationDeg'], metric,
+            refinement['initialValue'], refinement['finalValue']), 10000)
+
+    #Multi-atlas alignment
+    def runMultiAtlasAlignment(self, transform, movingFiducial, placementChecklist, atlasSelector, fiducialSelector):
+        """Registers against the selected & the candidate atlases, applies the best fit
+        and selects the winning atlas (and its crop template). Returns False on failure
+        """
+        logic = AlignCrop3DSlicerModuleLogic()
+        atlases = [(atlasSelector.currentNode(), fiducialSelector.currentNode())]
+        for atlasVolume in self.candidateAtlasSelector.checkedNodes():
+            if atlasVolume == atlases[0][0]:
+                continue
+            atlasFiducial = logic.getAtlasFiducial(atlasVolume)
+            if atlasFiducial is None:
+                logging.warning("No fiducials paired with atlas %s" % atlasVolume.GetName())
+                continue
+            atlases.append((atlasVolume, atlasFiducial))
+
+        try:
+            ranking = logic.runMultiAtlasRegistration(transform, [atlasFiducial for atlasVolume, atlasFiducial in atlases],
+                                                      movingFiducial, placementChecklist,
+                                                      transformType=self.transformTypeSelector.currentText)
+        except ValueError as e:
+            slicer.util.errorDisplay("Multi-atlas alignment failed: %s" % e)
+            return False
+        self.atlasRankingLabel.text = ", ".join("%s %.3f mm" % (atlases[candidate['index']][0].GetName(), candidate['error'])
+                                                for candidate in ranking)
+
+        bestVolume, bestFiducial = atlases[ranking[0]['index']]
+        atlasSelector.setCurrentNode(bestVolume)
+        fiducialSelector.setCurrentNode(bestFiducial)
+        self.cropTemplateSelector.setCurrentNode(bestVolume)
+        return True
 
+    #Progressive overlay
+    def startPreview(self, inputVolume, templateVolume):
+        self.stopPreview()
+        if not self.previewCheckBox.checked:
+            return
+        cache = self.atlasCache if self.atlasCacheCheckBox.checked else None
+        self.preview = AlignCrop3DSlicerModulePreview(inputVolume, templateVolume, cache=cache)
+        self.preview.start()
+
+    def stopPreview(self):
+        if self.preview:
+            self.preview.stop()
+        self.preview = None
+
+    def getOutputSpacing(self, inputVolume=None):
+        """Output spacing set in the Crop section (None - input spacing), the isotropic
+        spacing of inputVolume when only Isotropic is checked
+        """
+        if self.outputSpacingSpinBox.value > 0:
+            return self.outputSpacingSpinBox.value
+        if self.isotropicCheckBox.checked and inputVolume is not None:
+            return min(inputVolume.GetSpacing())
+        return None
+
+    def createFileCrop(self, logic, castStats=None):
+        """File crop as compute(progressCallback, cancelEvent), reading the scene only here:
+        a plain crop of the voxels, or the out-of-core resampling through the selected transform.
+        The output type statistics are added to castStats
+        """
+        roiBounds   = logic.getROIBounds(self.templateROI)
+        inputPath   = self.cropInputPathEdit.currentPath
+        outputPath  = self.cropOutputPathEdit.currentPath
+        transform   = self.cropTransformSelector.currentNode()
+        encoding    = self.outputEncodingSelector.currentText
+        level       = self.compressionLevelSpinBox.value
+        outputType  = self.outputTypeSelector.currentText
+        spacing     = self.outputSpacingSpinBox.value or None
+        interpolation = self.interpolationSelector.currentText
+        if transform is None and spacing is None:
+            return lambda progressCallback, cancelEvent: logic.runCropVolumeFromFile(
+                roiBounds, inputPath, outputPath, progressCallback=progressCallback, cancelEvent=cancelEvent,
+                encoding=encoding, compressionLevel=level, outputType=outputType, castStats=castStats)
+
+        transformToWorld    = logic.getTransformToWorldMatrix(transform)
+        memoryBudgetMB      = self.memoryBudgetSpinBox.value
+        return lambda progressCallback, cancelEvent: logic.runAlignCropVolumeFromFile(
+            roiBounds, inputPath, outputPath, transformToWorld, memoryBudgetMB=memoryBudgetMB,
+            progressCallback=progressCallback, cancelEvent=cancelEvent, encoding=encoding, compressionLevel=level,
+            outputType=outputType, castStats=castStats, spacing=spacing, interpolation=interpolation)
+
+    #Background processing
+    def startBackgroundCrop(self, logic):
         self.cropButton.enabled = False
+        if self.cropFromFileCheckBox.checked:
+            outputPath  = self.cropOutputPathEdit.currentPath
+            castStats   = {}
+            compute     = self.createFileCrop(logic, castStats)
+            def onFinished(outputPath):
+                slicer.util.loadVolume(outputPath)
+                self.finishCrop(castStats)
+            def onFailed(error):
+                if os.path.exists(outputPath):
+                    os.remove(outputPath)
+                self.onBackgroundFailed(error)
+        else:
+            inputVolume = self.cropInputSelector.currentNode()
+            croppedVolume, compute = logic.startCropVolume(self.templateROI, inputVolume,
+                                                           interpolation=self.interpolationSelector.currentText,
+                                                           outputType=self.outputTypeSelector.currentText,
+                                                           spacing=self.getOutputSpacing(inputVolume))
+            def onFinished(castStats):
+                croppedVolume.GetImageData().Modified()
+                logic.setCastStats(croppedVolume, castStats)
+                self.finishCrop(castStats)
+            def onFailed(error):
+                slicer.mrmlScene.RemoveNode(croppedVolume)
+                self.onBackgroundFailed(error)
+
+        self.backgroundTask = AlignCrop3DSlicerModuleTask(compute,
+                                                          onFinished=lambda result: (self.hideProgress(), onFinished(result)),
+                                                          onFailed=lambda error: (self.hideProgress(), onFailed(error)),
+                                                          onProgress=self.setProgress)
+        self.showProgress("Cropping")
+        self.backgroundTask.start()
+
+    def onBackgroundFailed(self, error):
+        self.cropButton.enabled = True
+        if isinstance(error, AlignCrop3DSlicerModuleCancelledError):
+            slicer.util.showStatusMessage("Crop cancelled", 5000)
+        else:
+            slicer.util.errorDisplay("Crop failed: %s" % error)
+
+    def startBackgroundCLI(self, transform, fixedFiducial, movingFiducial, placementChecklist, onFinished, alignButton):
+        logic = AlignCrop3DSlicerModuleLogic()
+        transformType = self.transformTypeSelector.currentText
+        cliNode = logic.runAlignmentRegistrationCLI(transform, fixedFiducial, movingFiducial, placementChecklist,
+                                                    transformType=transformType, wait=False)
+        #quality of the fit is computed once the CLI completed
+        onFinished = functools.partial(self.onBackgroundCLIFinished, onFinished, transform, fixedFiducial,
+                                       movingFiducial, placementChecklist, transformType)
+        observerTag = cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode.StatusModifiedEvent, self.onBackgroundCLIModified)
+        self.backgroundCLI = { 'cliNode'        : cliNode,
+                               'observerTag'    : observerTag,
+                               'onFinished'     : onFinished,
+                               'alignButton'    : alignButton,
+                               'startTime'      : time.time() }
+        self.showProgress("Registering")
+
+    def onBackgroundCLIModified(self, cliNode, event):
+        if not self.backgroundCLI:
+            return
+        self.setProgress(cliNode.GetProgress() / 100.0)
+        if cliNode.IsBusy():
+            return
+
+        cliNode.RemoveObserver(self.backgroundCLI['observerTag'])
+        background, self.backgroundCLI = self.backgroundCLI, None
+        self.hideProgress()
+        logging.info("Fiducial Registration CLI %s in %.2f s" % (cliNode.GetStatusString(), time.time() - background['startTime']))
+        if cliNode.GetStatus() == cliNode.Completed:
+            background['onFinished']()
+        else:
+            background['alignButton'].enabled = True
+            if cliNode.GetStatus() != cliNode.Cancelled:
+                slicer.util.errorDisplay("Fiducial registration failed: %s" % cliNode.GetErrorText())
+
+    def onBackgroundCLIFinished(self, onFinished, transform, fixedFiducial, movingFiducial, placementChecklist, transformType):
+        AlignCrop3DSlicerModuleLogic().updateRegistrationQuality(transform, fixedFiducial, movingFiducial,
+                                                                 placementChecklist, transformType)
+        onFinished()
+
+    def onCancelButton(self):
+        if self.backgroundTask and self.backgroundTask.isRunning():
+            self.backgroundTask.cancel()
+        if self.backgroundCLI:
+            self.backgroundCLI['cliNode'].Cancel()
+
+    def showProgress(self, text):
+        self.progressBar.value      = 0
+        self.progressBar.format     = text + " %p%"
+        self.progressBar.visible    = True
+        self.cancelButton.visible   = True
+
+    def setProgress(self, fraction):
+        self.progressBar.value = int(round(100 * min(max(fraction, 0.0), 1.0)))
+
+    def hideProgress(self):
+        self.progressBar.visible    = False
+        self.cancelButton.visible   = False
+
+    def onHardenButton(self):
+
+        #Preview levels of the input are taken before hardening
+        self.stopPreview()
+
+        #Harden deferred landmark transforms into the aligned volumes & fiducials
+        transformLogic = slicer.vtkSlicerTransformLogic()
+        for transformName, nodeNames in [ ('landmarkTransformCO', ['inputVolumeCO', 'movingFiducialNodeCO']),
+                                          ('landmarkTransform', ['inputVolumeTB', 'movingFiducialNode']) ]:
+            transform = getattr(self, transformName, None)
+            if transform is None:
+                continue
+            nodes = [getattr(self, nodeName, None) for nodeName in nodeNames] + list(self.associatedNodesSelector.checkedNodes())
+            for node in nodes:
+                if node and node.GetTransformNodeID() == transform.GetID():
+                    transformLogic.hardenTransform(node)
+
+        self.hardenButton.enabled = False
+        self.alignButtonCO.enabled = False
+        self.alignButtonTB.enabled = False
+        self.stopLiveAlignment()
+
+    def onReleaseNodesButton(self):
+
+        self.stopLiveAlignment()
+        self.stopPreview()
+        report = self.sceneScope.release()
+        slicer.util.showStatusMessage("Released %d nodes" % report['removed'], 5000)
+
+        #Restart the fiducial placement & cropping workflows
+        for button in ( self.CNButton, self.AButton, self.RWButtonCO, self.alignButtonCO,
+                        self.GGButton, self.SFButton, self.AEButton, self.PSCButton, self.OWButton,
+                        self.RWButton, self.alignButtonTB, self.cropButton, self.hardenButton ):
+            button.enabled = False
+        self.onSelectAlignCO()
+        self.onSelectAlignTB()
+        self.fiducialErrorLabel.text = "-"
+
+    def onClearAtlasCacheButton(self):
+        self.atlasCache.clear()
+        slicer.util.showStatusMessage("Atlas cache cleared", 5000)
+
+    def onProfileChanged(self):
+        if self.profileCheckBox.checked:
+            AlignCrop3DSlicerModuleProfiler.enable(self.profilePathEdit.currentPath)
+        else:
+            AlignCrop3DSlicerModuleProfiler.disable()
+
+    #Live re-registration
+    def onLiveUpdateToggled(self, checked):
+        if checked:
+            self.deferHardenCheckBox.checked = True
+        else:
+            self.stopLiveAlignment()
+
+    def onDeferHardenToggled(self, checked):
+        if not checked:
+            self.liveUpdateCheckBox.checked = False
+
+    def updateFiducialError(self, transform):
+        #Quality computed at registration time, before the placed fiducials were hardened
+        logic = AlignCrop3DSlicerModuleLogic()
+        quality = logic.getRegistrationQuality(transform)
+        if quality is None:
+            self.fiducialErrorLabel.text = "-"
+            return
+        self.fiducialErrorLabel.text = "%.3f mm" % quality['fre']
+        if quality.get('method') == 'surface':
+            self.fiducialErrorLabel.text += " surface RMS (%d points)" % quality['surfacePoints'][1]
+        if quality['maxLooTRE'] is not None:
+            self.fiducialErrorLabel.text += ", leave-one-out max %.3f mm" % quality['maxLooTRE']
+        if quality.get('method') == 'surface':
+            self.fiducialErrorLabel.text += ", %.0f%% pairs kept" % (100.0 * quality['inlierFraction'])
+        elif quality['conditionNumber'] is None:
+            self.fiducialErrorLabel.text += ", condition undefined (collinear landmarks)"
+        else:
+            self.fiducialErrorLabel.text += ", condition %.1f" % quality['conditionNumber']
+        if quality.get('rejected'):
+            self.fiducialErrorLabel.text += ", rejected %s" % ', '.join(quality['rejected'])
+        self.fiducialErrorLabel.styleSheet = "" if logic.isRegistrationQualityAcceptable(quality) else "color: red"
+
+    def startLiveAlignment(self, transform, fixedFiducial, movingFiducial, placementChecklist):
+        self.stopLiveAlignment()
+
+        #Surface & intensity refined fits can not be recomputed from the landmarks alone
+        logic = AlignCrop3DSlicerModuleLogic()
+        quality = logic.getRegistrationQuality(transform) or {}
+        if quality.get('method') == 'surface' or quality.get('refinement'):
+            logging.info("Live update disabled for surface or intensity refined alignments")
+            return
+        try:
+            fixedPoints, movingPoints = logic.getLandmarkPointArrays(fixedFiducial, movingFiducial, placementChecklist)
+        except ValueError as e:
+            logging.warning("Live update disabled: %s" % e)
+            return
+        observerTag = movingFiducial.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onMovingFiducialModified)
+        self.liveAlignment = { 'logic'              : logic,
+                               'transform'          : transform,
+                               'fixedFiducial'      : fixedFiducial,
+                               'movingFiducial'     : movingFiducial,
+                               'placementChecklist' : placementChecklist,
+                               'observerTag'        : observerTag }
+
+    def stopLiveAlignment(self):
+        self.liveUpdateTimer.stop()
+        if self.liveAlignment:
+            self.liveAlignment['movingFiducial'].RemoveObserver(self.liveAlignment['observerTag'])
+        self.liveAlignment = None
+
+    def onMovingFiducialModified(self, caller, event):
+        if not self.liveUpdateTimer.isActive():
+            self.liveUpdateTimer.start()
+
+    def updateLiveAlignment(self):
+        if not self.liveAlignment:
+            return
+        #Same fit as the Align button (robust settings included, no CLI), quality updated with it
+        transform = self.liveAlignment['transform']
+        try:
+            self.liveAlignment['logic'].runAlignmentRegistration(transform, self.liveAlignment['fixedFiducial'],
+                                                                 self.liveAlignment['movingFiducial'],
+                                                                 self.liveAlignment['placementChecklist'],
+                                                                 transformType=self.transformTypeSelector.currentText,
+                                                                 robust=self.robustCheckBox.checked,
+                                                                 inlierThreshold=self.inlierThresholdSpinBox.value)
+        except (ValueError, RuntimeError) as e:
+            logging.warning("Live update skipped: %s" % e)
+            return
+        self.updateFiducialError(transform)
 
     def cleanup(self):
-        pass
+        self.stopLiveAlignment()
+        self.stopPreview()
+        self.onCancelButton()
 
     def onSelectAlignCO(self):
         self.OWButtonCO.enabled =  self.templateAtlasSelectorCO.currentNode() and self.templateFidSelectorCO.currentNode() and self.inputSelectorCO.currentNode()
+        self.proposeButtonCO.enabled = self.OWButtonCO.enabled
 
         if(self.OWButtonCO.enabled):
             self.inputVolumeCO    = self.inputSelectorCO.currentNode()
@@ -721,6 +1789,7 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
 
     def onSelectAlignTB(self):
         self.PAButton.enabled =  self.templateAtlasSelectorTB.currentNode() and self.templateFidSelectorTB.currentNode() and self.inputSelectorTB.currentNode()
+        self.proposeButtonTB.enabled = self.PAButton.enabled
 
         if(self.PAButton.enabled):
             self.inputVolumeTB    = self.inputSelectorTB.currentNode()
@@ -730,7 +1799,19 @@ class AlignCrop3DSlicerModuleWidget(ScriptedLoadableModuleWidget):
             self.templateFidTB.SetDisplayVisibility(0)
 
     def onSelectCrop(self):
-        self.defineCropButton.enabled = self.cropTemplateSelector.currentNode() and self.cropInputSelector.currentNode()
+        cropFromFile = self.cropFromFileCheckBox.checked
+        self.cropInputSelector.enabled  = not cropFromFile
+        self.associatedNodesSelector.enabled = not cropFromFile
+        self.cropInputPathEdit.enabled  = cropFromFile
+        self.cropOutputPathEdit.enabled = cropFromFile
+        self.cropTransformSelector.enabled = cropFromFile
+
+        if cropFromFile:
+            self.defineCropButton.enabled = bool(self.cropTemplateSelector.currentNode() and
+                                                 self.cropInputPathEdit.currentPath and
+                                                 self.cropOutputPathEdit.currentPath)
+        else:
+            self.defineCropButton.enabled = self.cropTemplateSelector.currentNode() and self.cropInputSelector.currentNode()
 
         if(self.defineCropButton.enabled):
             self.cropTemplateVolume = self.cropTemplateSelector.currentNode()
@@ -750,6 +1831,10 @@ class AlignCrop3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py"""
 
+    #Template fiducial order for each protocol
+    landmarkOrderCO = ['OW', 'CN', 'A', 'RW']
+    landmarkOrderTB = ['PA', 'GG', 'SF', 'AE', 'PSC', 'OW', 'RW']
+
     def hasImageData(self,volumeNode):
         """This is an example logic method that
         returns true if the passed in volume
@@ -777,49 +1862,1030 @@ class AlignCrop3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
           return False
         return True
 
-    def runAlignmentRegistration(self, transform, fixedFiducial, movingFiducial, placementChecklist):
+    def getLandmarkOrder(self, placementChecklist):
+        """Returns the template fiducial order of the protocol the checklist belongs to
+        (cochlea only when 4 landmarks, temporal bone otherwise)
+        """
+        if len(placementChecklist) == len(self.landmarkOrderCO):
+            return self.landmarkOrderCO
+        return self.landmarkOrderTB
 
+    def getLandmarkPointArrays(self, fixedFiducial, movingFiducial, placementChecklist):
+        """Returns corresponding (N, 3) arrays of template (fixed) and placed (moving)
+        fiducial positions. Skipped landmarks are left out of both arrays.
+        """
+        order           = self.getLandmarkOrder(placementChecklist)
+        placedIndices   = [index for index, key in enumerate(order) if placementChecklist[key]]
+
+        if movingFiducial.GetNumberOfFiducials() != len(placedIndices):
+            raise ValueError("%d fiducials placed but %d expected from the placement checklist" %
+                             (movingFiducial.GetNumberOfFiducials(), len(placedIndices)))
+        if fixedFiducial.GetNumberOfFiducials() < len(order):
+            raise ValueError("Template fiducials must contain %d points" % len(order))
+
+        pos = [0.0, 0.0, 0.0]
+        fixedPoints = numpy.zeros((len(placedIndices), 3))
+        for row, index in enumerate(placedIndices):
+            fixedFiducial.GetNthFiducialPosition(index, pos)
+            fixedPoints[row] = pos
+        movingPoints = numpy.zeros((len(placedIndices), 3))
+        for row in range(len(placedIndices)):
+            movingFiducial.GetNthFiducialPosition(row, pos)
+            movingPoints[row] = pos
+
+        return fixedPoints, movingPoints
+
+    def computeLandmarkTransform(self, fixedPoints, movingPoints, transformType='Rigid'):
+        """Closed form least squares landmark transform (Kabsch/Umeyama) mapping
+        movingPoints onto fixedPoints.
+        Points are (N, 3) arrays or stacks of (B, N, 3) arrays, in which case all
+        B problems are solved at once and a (B, 4, 4) array is returned.
+        transformType is 'Rigid' or 'Similarity' (rigid + isotropic scale)
+        """
+        fixed  = numpy.asarray(fixedPoints, dtype=numpy.float64)
+        moving = numpy.asarray(movingPoints, dtype=numpy.float64)
+        single = (fixed.ndim == 2)
+        if single:
+            fixed  = fixed[numpy.newaxis]
+            moving = moving[numpy.newaxis]
+
+        fixedCentroid   = fixed.mean(axis=1)
+        movingCentroid  = moving.mean(axis=1)
+        fixedCentered   = fixed - fixedCentroid[:, numpy.newaxis, :]
+        movingCentered  = moving - movingCentroid[:, numpy.newaxis, :]
+
+        #Cross covariance & its SVD (batched)
+        covariance = numpy.einsum('bni,bnj->bij', movingCentered, fixedCentered)
+        U, S, Vt   = numpy.linalg.svd(covariance)
+        V          = Vt.transpose(0, 2, 1)
+        Ut         = U.transpose(0, 2, 1)
+
+        #Avoid reflections
+        D = numpy.ones_like(S)
+        D[:, 2] = numpy.sign(numpy.linalg.det(numpy.matmul(V, Ut)))
+        D[D[:, 2] == 0, 2] = 1.0
+        rotation = numpy.matmul(V * D[:, numpy.newaxis, :], Ut)
+
+        scale = numpy.ones(len(fixed))
+        if transformType == 'Similarity':
+            movingVariance  = (movingCentered ** 2).sum(axis=(1, 2))
+            scale           = (S * D).sum(axis=1) / numpy.maximum(movingVariance, 1e-12)
+        elif transformType != 'Rigid':
+            raise ValueError("Unsupported transform type: %s" % transformType)
+
+        matrix = numpy.zeros((len(fixed), 4, 4))
+        matrix[:, :3, :3]  = rotation * scale[:, numpy.newaxis, numpy.newaxis]
+        matrix[:, :3, 3]   = fixedCentroid - numpy.einsum('bij,bj->bi', matrix[:, :3, :3], movingCentroid)
+        matrix[:, 3, 3]    = 1.0
+
+        return matrix[0] if single else matrix
+
+    def computeRobustLandmarkTransform(self, fixedPoints, movingPoints, transformType='Rigid', inlierThreshold=1.0):
+        """Outlier tolerant landmark transform: every 3 landmark subset is solved (one batched
+        solve), the hypothesis with the largest consensus (landmarks within inlierThreshold mm,
+        ties broken by the smallest inlier error) wins and is refitted to its consensus set
+        until the set is stable.
+        Returns the 4x4 matrix and the boolean (N,) inlier mask
+        """
+        fixedPoints     = numpy.asarray(fixedPoints, dtype=numpy.float64)
+        movingPoints    = numpy.asarray(movingPoints, dtype=numpy.float64)
+        count           = len(fixedPoints)
+        if count < 3:
+            raise ValueError("At least 3 fiducials required")
+
+        #Minimal subsets, collinear ones leave the rotation undefined
+        subsets = numpy.array(list(itertools.combinations(range(count), 3)))
+        edges   = movingPoints[subsets[:, 1:]] - movingPoints[subsets[:, :1]]
+        area    = numpy.linalg.norm(numpy.cross(edges[:, 0], edges[:, 1]), axis=1)
+        subsets = subsets[area > 1e-6 * max(area.max(), 1e-12)]
+        if not len(subsets):
+            raise ValueError("Fiducials are collinear")
+
+        matrices    = self.computeLandmarkTransform(fixedPoints[subsets], movingPoints[subsets], transformType)
+        transformed = numpy.einsum('bij,nj->bni', matrices[:, :3, :3], movingPoints) + matrices[:, numpy.newaxis, :3, 3]
+        distances   = numpy.sqrt(((transformed - fixedPoints) ** 2).sum(axis=2))
+        inliers     = distances <= inlierThreshold
+        inlierError = numpy.where(inliers, distances ** 2, 0.0).sum(axis=1)
+        best        = numpy.lexsort((inlierError, -inliers.sum(axis=1)))[0]
+
+        inlierMask = inliers[best]
+        if inlierMask.sum() < 3:
+            #No consensus beyond a minimal subset, keep its landmarks
+            inlierMask = numpy.zeros(count, dtype=bool)
+            inlierMask[subsets[best]] = True
+        for iteration in range(count):
+            matrix = self.computeLandmarkTransform(fixedPoints[inlierMask], movingPoints[inlierMask], transformType)
+            distances = numpy.sqrt(((movingPoints.dot(matrix[:3, :3].T) + matrix[:3, 3] - fixedPoints) ** 2).sum(axis=1))
+            refitMask = distances <= inlierThreshold
+            if refitMask.sum() < 3 or numpy.array_equal(refitMask, inlierMask):
+                break
+            inlierMask = refitMask
+
+        return matrix, inlierMask
+
+    def computeFiducialRegistrationError(self, fixedPoints, movingPoints, matrix):
+        """Root mean square distance between the transformed moving points and the fixed points.
+        With stacks of (B, N, 3) points and/or (B, 4, 4) matrices the B errors are returned as an array
+        """
+        movingPoints    = numpy.asarray(movingPoints, dtype=numpy.float64)
+        matrix          = numpy.asarray(matrix, dtype=numpy.float64)
+        transformed     = numpy.einsum('...ij,...nj->...ni', matrix[..., :3, :3], movingPoints) + matrix[..., numpy.newaxis, :3, 3]
+        errors          = numpy.sqrt(((transformed - fixedPoints) ** 2).sum(axis=-1).mean(axis=-1))
+        return float(errors) if errors.ndim == 0 else errors
+
+    def computeRegistrationQuality(self, fixedPoints, movingPoints, matrix, transformType='Rigid'):
+        """Fit quality of a landmark transform from the (N, 3) point arrays:
+        per landmark residuals & their RMS (fiducial registration error), leave-one-out
+        target registration error estimates (each landmark predicted by the fit to the
+        others, all N refits solved at once; needs 4+ landmarks) and the condition number
+        of the placed landmark configuration (None for collinear landmarks). Returns a JSON
+        serializable dictionary
+        """
+        fixedPoints     = numpy.asarray(fixedPoints, dtype=numpy.float64)
+        movingPoints    = numpy.asarray(movingPoints, dtype=numpy.float64)
+        matrix          = numpy.asarray(matrix, dtype=numpy.float64)
+        count           = len(fixedPoints)
+
+        transformed = movingPoints.dot(matrix[:3, :3].T) + matrix[:3, 3]
+        residuals   = numpy.sqrt(((transformed - fixedPoints) ** 2).sum(axis=1))
+
+        leaveOneOut = None
+        if count >= 4:
+            #Row i of the (N, N-1) index table leaves landmark i out
+            others          = numpy.array([[index for index in range(count) if index != left] for left in range(count)])
+            refits          = self.computeLandmarkTransform(fixedPoints[others], movingPoints[others], transformType)
+            predicted       = numpy.einsum('bij,bj->bi', refits[:, :3, :3], movingPoints) + refits[:, :3, 3]
+            leaveOneOut     = numpy.sqrt(((predicted - fixedPoints) ** 2).sum(axis=1))
+
+        #Largest over second singular value: the rotation is undefined for collinear (not planar) landmarks
+        singularValues = numpy.linalg.svd(movingPoints - movingPoints.mean(axis=0), compute_uv=False) if count else numpy.zeros(1)
+        if count >= 3 and singularValues[1] > 1e-12 * max(singularValues[0], 1e-12):
+            conditionNumber = float(singularValues[0] / singularValues[1])
+        else:
+            #undefined, stored as null (JSON has no infinity)
+            conditionNumber = None
+
+        return self.createRegistrationQuality('landmark', transformType, residuals.tolist(),
+                                              float(numpy.sqrt((residuals ** 2).mean())) if count else 0.0,
+                                              leaveOneOut.tolist() if leaveOneOut is not None else None, conditionNumber)
+
+    def createRegistrationQuality(self, method, transformType, residuals, fre, looTRE=None, conditionNumber=None, **fields):
+        """Fit quality dictionary shared by the registration methods ('landmark' or 'surface'),
+        so every quality has the keys isRegistrationQualityAcceptable & the reports read.
+        Method specific fields are added
+        """
+        quality = { 'method'          : method,
+                    'residuals'       : residuals,
+                    'fre'             : fre,
+                    'looTRE'          : looTRE,
+                    'maxLooTRE'       : max(looTRE) if looTRE else None,
+                    'conditionNumber' : conditionNumber,
+                    'transformType'   : transformType }
+        quality.update(fields)
+        return quality
+
+    def isRegistrationQualityAcceptable(self, quality, maxFRE=1.0, maxLooTRE=2.0, maxConditionNumber=100.0,
+                                        minInlierFraction=0.8):
+        """False if a quality metric exceeds its limit (mm for the errors). Surface fits have
+        no landmark metrics: their RMS distance (fre) & fraction of kept surface pairs are checked
+        """
+        if quality is None or quality['fre'] > maxFRE:
+            return False
+        if quality.get('method') == 'surface':
+            return quality['inlierFraction'] >= minInlierFraction
+        if quality['maxLooTRE'] is not None and quality['maxLooTRE'] > maxLooTRE:
+            return False
+        return quality['conditionNumber'] is not None and quality['conditionNumber'] <= maxConditionNumber
+
+    def updateRegistrationQuality(self, transform, fixedFiducial, movingFiducial, placementChecklist, transformType='Rigid',
+                                  inlierMask=None):
+        """Computes the fit quality of the current transform (before the placed fiducials are
+        hardened) and attaches it to the transform node. With an inlier mask (robust fitting)
+        the quality is computed on the inliers and the rejected landmarks are listed.
+        Returns the quality (None if the fiducials do not match the checklist)
+        """
+        try:
+            fixedPoints, movingPoints = self.getLandmarkPointArrays(fixedFiducial, movingFiducial, placementChecklist)
+        except ValueError as e:
+            logging.warning("No registration quality: %s" % e)
+            transform.RemoveAttribute('AlignCrop3DSlicerModule.Quality')
+            return None
+        order       = self.getLandmarkOrder(placementChecklist)
+        landmarks   = [key for key in order if placementChecklist[key]]
+        if inlierMask is None:
+            inlierMask = numpy.ones(len(landmarks), dtype=bool)
+        quality = self.computeRegistrationQuality(fixedPoints[inlierMask], movingPoints[inlierMask],
+                                                  self.getTransformMatrix(transform), transformType)
+        quality['landmarks']    = [key for key, inlier in zip(landmarks, inlierMask) if inlier]
+        quality['rejected']     = [key for key, inlier in zip(landmarks, inlierMask) if not inlier]
+        transform.SetAttribute('AlignCrop3DSlicerModule.Quality', json.dumps(quality))
+        return quality
+
+    def getRegistrationQuality(self, transform):
+        """Quality attached to a transform node by updateRegistrationQuality (None if missing)
+        """
+        quality = transform.GetAttribute('AlignCrop3DSlicerModule.Quality')
+        return json.loads(quality) if quality else None
+
+    def setTransformMatrix(self, transform, matrix):
+        """Writes a 4x4 numpy matrix into a transform node (transform to parent)
+        """
+        vtkMatrix = vtk.vtkMatrix4x4()
+        for row in range(4):
+            for col in range(4):
+                vtkMatrix.SetElement(row, col, matrix[row][col])
+        transform.SetMatrixTransformToParent(vtkMatrix)
+
+    def getTransformMatrix(self, transform):
+        """Returns the transform to parent of a linear transform node as a 4x4 numpy matrix
+        """
+        vtkMatrix = vtk.vtkMatrix4x4()
+        transform.GetMatrixTransformToParent(vtkMatrix)
+        return numpy.array([[vtkMatrix.GetElement(row, col) for col in range(4)] for row in range(4)])
+
+    @AlignCrop3DSlicerModuleProfiler.profile('alignmentRegistration')
+    def runAlignmentRegistration(self, transform, fixedFiducial, movingFiducial, placementChecklist,
+                                 transformType='Rigid', useCLI=False, robust=False, inlierThreshold=1.0):
+        """Computes the landmark transform from the placed (moving) fiducials to the
+        template (fixed) fiducials and stores it in transform.
+        The built-in solver is used unless useCLI is set; the Fiducial Registration CLI
+        is also used as a fallback if the point sets cannot be solved in process.
+        With robust, landmarks further than inlierThreshold (mm) from the consensus fit are
+        rejected (see computeRobustLandmarkTransform, built-in solver only) and listed in
+        the registration quality.
+        Returns the transform as a 4x4 numpy matrix
+        """
         logging.info("Now running Alignment Registration")
 
+        if robust:
+            fixedPoints, movingPoints = self.getLandmarkPointArrays(fixedFiducial, movingFiducial, placementChecklist)
+            matrix, inlierMask = self.computeRobustLandmarkTransform(fixedPoints, movingPoints, transformType, inlierThreshold)
+            self.setTransformMatrix(transform, matrix)
+            quality = self.updateRegistrationQuality(transform, fixedFiducial, movingFiducial, placementChecklist,
+                                                     transformType, inlierMask)
+            if quality['rejected']:
+                logging.warning("Landmarks rejected as outliers: %s" % ', '.join(quality['rejected']))
+            return matrix
+
+        if not useCLI:
+            try:
+                fixedPoints, movingPoints = self.getLandmarkPointArrays(fixedFiducial, movingFiducial, placementChecklist)
+                if len(fixedPoints) < 3:
+                    raise ValueError("At least 3 fiducials required")
+                #Reject collinear configurations, rotation about the line is undefined
+                singularValues = numpy.linalg.svd(movingPoints - movingPoints.mean(axis=0), compute_uv=False)
+                if singularValues[1] <= 1e-6 * max(singularValues[0], 1e-12):
+                    raise ValueError("Fiducials are collinear")
+
+                matrix = self.computeLandmarkTransform(fixedPoints, movingPoints, transformType)
+                self.setTransformMatrix(transform, matrix)
+                self.updateRegistrationQuality(transform, fixedFiducial, movingFiducial, placementChecklist, transformType)
+                return matrix
+            except ValueError as e:
+                logging.warning("Landmark solver failed (%s), falling back to Fiducial Registration CLI" % e)
+
+        with AlignCrop3DSlicerModuleProfiler.stage('fiducialRegistrationCLI'):
+            cliNode = self.runAlignmentRegistrationCLI(transform, fixedFiducial, movingFiducial, placementChecklist,
+                                                       transformType=transformType, wait=True)
+        self.checkCLIStatus(cliNode)
+        self.updateRegistrationQuality(transform, fixedFiducial, movingFiducial, placementChecklist, transformType)
+
+        return self.getTransformMatrix(transform)
+
+    def checkCLIStatus(self, cliNode):
+        """Raises RuntimeError unless the CLI run completed without errors
+        """
+        if cliNode.GetStatus() != cliNode.Completed:
+            raise RuntimeError("%s %s: %s" % (cliNode.GetName(), cliNode.GetStatusString(), cliNode.GetErrorText()))
+
+    @AlignCrop3DSlicerModuleProfiler.profile('multiAtlasRegistration')
+    def runMultiAtlasRegistration(self, transform, atlasFiducials, movingFiducial, placementChecklist,
+                                  transformType='Rigid'):
+        """Registers the placed (moving) fiducials to every atlas fiducial list at once
+        (one batched solve) and ranks the atlases by fiducial registration error.
+        Atlases whose fiducials do not match the checklist (one point per landmark of its
+        landmark order) are left out. The best fit is stored in transform. Returns the ranking, best first, as a list of
+        dictionaries with the atlas index, its error & its 4x4 matrix
+        """
+        indices, fixedStack, movingPoints = [], [], None
+        landmarkCount = len(self.getLandmarkOrder(placementChecklist))
+        for index, atlasFiducial in enumerate(atlasFiducials):
+            #a list of another checklist (e.g. 7 TB points for the 4 CO landmarks) would pair its first points
+            if atlasFiducial.GetNumberOfFiducials() != landmarkCount:
+                logging.warning("Atlas fiducials %s skipped: %d points but %d landmarks in the placement checklist" %
+                                (atlasFiducial.GetName(), atlasFiducial.GetNumberOfFiducials(), landmarkCount))
+                continue
+            try:
+                fixedPoints, movingPoints = self.getLandmarkPointArrays(atlasFiducial, movingFiducial, placementChecklist)
+            except ValueError as e:
+                logging.warning("Atlas fiducials %s skipped: %s" % (atlasFiducial.GetName(), e))
+                continue
+            indices.append(index)
+            fixedStack.append(fixedPoints)
+        if not indices:
+            raise ValueError("No atlas fiducials match the placed fiducials")
+        if len(movingPoints) < 3:
+            raise ValueError("At least 3 fiducials required")
+
+        fixedStack  = numpy.array(fixedStack)
+        matrices    = self.computeLandmarkTransform(fixedStack, numpy.broadcast_to(movingPoints, fixedStack.shape), transformType)
+        errors      = self.computeFiducialRegistrationError(fixedStack, movingPoints, matrices)
+
+        ranking = [ { 'index'   : indices[candidate],
+                      'error'   : float(errors[candidate]),
+                      'matrix'  : matrices[candidate] } for candidate in numpy.argsort(errors) ]
+        self.setTransformMatrix(transform, ranking[0]['matrix'])
+        self.updateRegistrationQuality(transform, atlasFiducials[ranking[0]['index']], movingFiducial,
+                                       placementChecklist, transformType)
+        return ranking
+
+    def getAtlasFiducial(self, atlasVolume):
+        """Fiducial list paired with an atlas volume by name: the list named like the volume,
+        else the first list whose name starts with the volume name (e.g. 'Atlas2-landmarks')
+        """
+        candidates = []
+        for fiducial in slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode'):
+            if fiducial.GetName() == atlasVolume.GetName():
+                return fiducial
+            if fiducial.GetName().startswith(atlasVolume.GetName()):
+                candidates.append(fiducial)
+        return candidates[0] if candidates else None
+
+    def runAlignmentRegistrationCLI(self, transform, fixedFiducial, movingFiducial, placementChecklist,
+                                    transformType='Rigid', wait=True):
+        """Runs the Fiducial Registration CLI module, saving the result into transform.
+        Without wait the CLI runs in the background; observe the returned CLI node for
+        its status & progress, or Cancel() it
+        """
         #deselected unused fiducials
-        if len(placementChecklist) == 4:
-            for key, value in placementChecklist.iteritems():
-                if value != True:
-                    if key == 'OW':
-                        fixedFiducial.SetNthFiducialSelected(0, 0)
-                    if key == 'CN':
-                        fixedFiducial.SetNthFiducialSelected(1, 0)
-                    if key == 'A':
-                        fixedFiducial.SetNthFiducialSelected(2, 0)
-                    if key == 'RW':
-                        fixedFiducial.SetNthFiducialSelected(3, 0)
-        else:
-            for key, value in placementChecklist.iteritems():
-                if value != True:
-                    if key == 'PA':
-                        fixedFiducial.SetNthFiducialSelected(0, 0)
-                    if key == 'GG':
-                        fixedFiducial.SetNthFiducialSelected(1, 0)
-                    if key == 'SF':
-                        fixedFiducial.SetNthFiducialSelected(2, 0)
-                    if key == 'AE':
-                        fixedFiducial.SetNthFiducialSelected(3, 0)
-                    if key == 'PSC':
-                        fixedFiducial.SetNthFiducialSelected(4, 0)
-                    if key == 'OW':
-                        fixedFiducial.SetNthFiducialSelected(5, 0)
-                    if key == 'RW':
-                        fixedFiducial.SetNthFiducialSelected(6, 0)
+        order = self.getLandmarkOrder(placementChecklist)
+        for key, value in placementChecklist.items():
+            if value != True:
+                fixedFiducial.SetNthFiducialSelected(order.index(key), 0)
 
         #Setup and Run Landmark Registration
         cliParamsFidReg = {	'fixedLandmarks'	: fixedFiducial.GetID(),
 		                    'movingLandmarks' 	: movingFiducial.GetID(),
-		                    'TransformType' 	: 'Rigid',
+		                    'TransformType' 	: transformType,
 		                    'saveTransform' 	: transform.GetID() }
 
         cliRigTrans = slicer.cli.run( slicer.modules.fiducialregistration, None,
-		                              cliParamsFidReg, wait_for_completion=True )
+		                              cliParamsFidReg, wait_for_completion=wait )
+        return cliRigTrans
+
+
+    def proposeLandmarks(self, inputVolume, templateVolume, templateFiducial, levels=3, patchRadius=4.0,
+                         searchRadius=6.0, cache=None, maxGlobalVoxels=64*64*64, progressCallback=None, cancelEvent=None):
+        """Locates the atlas landmarks in the input volume by template matching (FFT normalized
+        cross-correlation) on a coarse to fine pyramid of 2**level downsampled volumes.
+        A patch around all landmarks is first searched in the whole coarsest input level (further
+        halved until it has at most maxGlobalVoxels voxels), then every landmark patch
+        (patchRadius mm) is searched within searchRadius mm of its position offset by this match,
+        and refined within 2 voxels of the previous level on finer levels.
+        Patches are resampled onto the input voxel grid, so atlas & input may differ in spacing
+        but are expected in a similar orientation. Template levels come from the atlas cache if given.
+        Returns a list of { key, position (world), score (NCC of the finest level) } in the
+        landmark order of the protocol matching templateFiducial
+        """
+        compute = self.startProposeLandmarks(inputVolume, templateVolume, templateFiducial, levels, patchRadius,
+                                             searchRadius, cache, maxGlobalVoxels)
+        return compute(progressCallback, cancelEvent)
+
+    def startProposeLandmarks(self, inputVolume, templateVolume, templateFiducial, levels=3, patchRadius=4.0,
+                              searchRadius=6.0, cache=None, maxGlobalVoxels=64*64*64):
+        """Main thread half of proposeLandmarks: reads the fiducials, voxels & geometry and
+        returns compute(progressCallback, cancelEvent), which builds the pyramids & matches
+        the landmarks without accessing the scene, so it can run in a worker thread
+        """
+        pos = [0.0, 0.0, 0.0]
+        points = numpy.zeros((templateFiducial.GetNumberOfFiducials(), 3))
+        for index in range(len(points)):
+            templateFiducial.GetNthFiducialPosition(index, pos)
+            points[index] = pos
+        if len(points) == len(self.landmarkOrderCO):
+            order = self.landmarkOrderCO
+        elif len(points) >= len(self.landmarkOrderTB):
+            order = self.landmarkOrderTB
+        else:
+            raise ValueError("Template fiducials must contain %d or %d points" % (len(self.landmarkOrderCO),
+                                                                                  len(self.landmarkOrderTB)))
+        points = points[:len(order)]
+
+        inputSource     = self.getPyramidSource(inputVolume)
+        templateSource  = self.getPyramidSource(templateVolume, cache)
+
+        def compute(progressCallback=None, cancelEvent=None):
+            self.reportProgress(0.0, progressCallback, cancelEvent)
+            inputPyramid    = self.computeArrayPyramid(*(inputSource + (levels,)))
+            templatePyramid = self.computeArrayPyramid(*(templateSource + (levels,)))
+
+            #Constellation of all landmarks, searched everywhere on the coarsest level (of bounded size)
+            self.reportProgress(1.0 / (len(order) + 2), progressCallback, cancelEvent)
+            inputVoxels, inputIJKToRAS = inputPyramid[-1]
+            while inputVoxels.size > maxGlobalVoxels and min(inputVoxels.shape) // 2 >= 8:
+                inputVoxels, inputIJKToRAS = self.downsampleArray(inputVoxels), self.computeDownsampledIJKToRAS(inputIJKToRAS)
+            centre = (points.min(axis=0) + points.max(axis=0)) / 2.0
+            patch = self.resampleLandmarkPatch(templatePyramid, inputIJKToRAS, centre,
+                                               (points.max(axis=0) - points.min(axis=0)) / 2.0 + patchRadius)
+            position, score = self.matchLandmarkPatch(inputVoxels, inputIJKToRAS, patch)
+            offset = position - centre
+
+            proposals = []
+            for index, key in enumerate(order):
+                self.reportProgress(float(index + 2) / (len(order) + 2), progressCallback, cancelEvent)
+                position, radius = points[index] + offset, searchRadius
+                for inputVoxels, inputIJKToRAS in reversed(inputPyramid):
+                    patch = self.resampleLandmarkPatch(templatePyramid, inputIJKToRAS, points[index], patchRadius)
+                    position, score = self.matchLandmarkPatch(inputVoxels, inputIJKToRAS, patch, position, radius)
+                    radius = 2.0 * numpy.linalg.norm(inputIJKToRAS[:3, :3], axis=0).max()
+                proposals.append({ 'key' : key, 'position' : [float(value) for value in position], 'score' : float(score) })
+            self.reportProgress(1.0, progressCallback, cancelEvent)
+            return proposals
+        return compute
+
+    def getVolumePyramid(self, volume, levels, cache=None, toWorld=True):
+        """Voxels & IJK to world (IJK to RAS without toWorld) matrices of a volume (level 0)
+        and of its 2**level downsampled copies, finest first. Levels smaller than 8 voxels
+        on an axis are left out. Levels of cached atlases are read from the atlas cache
+        """
+        return self.computeArrayPyramid(*(self.getPyramidSource(volume, cache, toWorld) + (levels,)))
 
+    def getPyramidSource(self, volume, cache=None, toWorld=True):
+        """Voxels, IJKToRAS & IJK to world matrices and atlas cache & key (None - no cache)
+        of a volume, the scene data computeArrayPyramid needs
+        """
+        toWorld = self.getTransformToWorldMatrix(volume.GetParentTransformNode() if toWorld else None)
+        cacheKey = cache.getVolumeKey(volume) if cache else None
+        return slicer.util.arrayFromVolume(volume), self.getVolumeIJKToRAS(volume), toWorld, cache, cacheKey
+
+    def computeArrayPyramid(self, voxels, ijkToRAS, toWorld, cache, cacheKey, levels):
+        """getVolumePyramid of voxels & their geometry, without accessing the scene
+        """
+        volumeVoxels, volumeIJKToRAS = voxels, ijkToRAS
+        pyramid = [(voxels, toWorld.dot(ijkToRAS))]
+        for level in range(1, levels):
+            if min(voxels.shape) // 2 < 8:
+                break
+            if cache:
+                voxels, ijkToRAS = cache.getKeyPyramidLevel(cacheKey, volumeVoxels, volumeIJKToRAS, level)
+            else:
+                voxels, ijkToRAS = self.downsampleArray(voxels), self.computeDownsampledIJKToRAS(ijkToRAS)
+            pyramid.append((voxels, toWorld.dot(ijkToRAS)))
+        return pyramid
+
+    def computeDownsampledIJKToRAS(self, ijkToRAS):
+        """IJKToRAS matrix of a 2x2x2 downsampled volume (see downsampleArray)
+        """
+        #Averaging 2x2x2 voxels moves the first voxel centre by half a (previous level) voxel
+        ijkToRAS = numpy.array(ijkToRAS)
+        ijkToRAS[:3, 3] = ijkToRAS.dot([0.5, 0.5, 0.5, 1.0])[:3]
+        ijkToRAS[:3, :3] *= 2
+        return ijkToRAS
+
+    def downsampleArray(self, voxels, slabSlices=32):
+        """Mean of 2x2x2 voxel blocks (odd last voxels dropped), slab by slab
+        """
+        shape = tuple(max(1, size // 2) for size in voxels.shape)
+        downsampled = numpy.empty(shape, dtype=voxels.dtype)
+        for start in range(0, shape[0], slabSlices):
+            stop = min(start + slabSlices, shape[0])
+            slab = numpy.asarray(voxels[2 * start:2 * stop, :2 * shape[1], :2 * shape[2]], dtype=numpy.float32)
+            #single voxel thick axes are kept as they are
+            blocks = slab.reshape(stop - start, -1, shape[1], slab.shape[1] // shape[1],
+                                  shape[2], slab.shape[2] // shape[2]).mean(axis=(1, 3, 5))
+            if numpy.issubdtype(voxels.dtype, numpy.integer):
+                blocks = numpy.rint(blocks)
+            downsampled[start:stop] = blocks
+        return downsampled
+
+    def resampleLandmarkPatch(self, templatePyramid, inputIJKToRAS, centre, radius):
+        """Template patch of radius (mm, per axis or scalar) around a world position, resampled
+        onto the voxel axes & spacing of an input level from the finest template level that is
+        not finer than it. Returns the float32 (k, j, i) patch
+        """
+        inputSpacing = numpy.linalg.norm(inputIJKToRAS[:3, :3], axis=0)
+        templateVoxels, templateIJKToRAS = templatePyramid[0]
+        for voxels, ijkToRAS in templatePyramid[1:]:
+            if numpy.linalg.norm(ijkToRAS[:3, :3], axis=0).min() > inputSpacing.min() * 1.01:
+                break
+            templateVoxels, templateIJKToRAS = voxels, ijkToRAS
+
+        dimensions = 2 * numpy.maximum(numpy.round(numpy.asarray(radius) / inputSpacing).astype(int), 1) + 1
+        patchIJKToRAS = numpy.array(inputIJKToRAS, dtype=float)
+        patchIJKToRAS[:3, 3] = centre - patchIJKToRAS[:3, :3].dot((dimensions - 1) / 2.0)
+        patch = numpy.empty(tuple(dimensions[::-1]), dtype=numpy.float32)
+        return self.resampleArray(templateVoxels, numpy.linalg.inv(templateIJKToRAS).dot(patchIJKToRAS), patch.shape,
+                                  outputArray=patch)
+
+    def matchLandmarkPatch(self, voxels, ijkToRAS, patch, centre=None, radius=None):
+        """Best normalized cross-correlation match of a patch (resampled onto the voxel grid)
+        with its centre within radius mm of centre (anywhere when not given), to sub-voxel
+        precision. Returns the world position of the patch centre & the NCC score
+        """
+        patchShape = numpy.array(patch.shape)
+        if centre is None:
+            regionStart, regionStop = numpy.zeros(3, dtype=int), numpy.array(voxels.shape)
+        else:
+            centreKJI = numpy.linalg.inv(ijkToRAS).dot(list(centre) + [1.0])[2::-1]
+            searchKJI = numpy.ceil(radius / numpy.linalg.norm(ijkToRAS[:3, :3], axis=0))[::-1]
+            regionStart = numpy.clip(numpy.round(centreKJI - searchKJI).astype(int) - patchShape // 2, 0, voxels.shape)
+            regionStop  = numpy.clip(numpy.round(centreKJI + searchKJI).astype(int) + patchShape // 2 + 1, 0, voxels.shape)
+        if numpy.any(regionStop - regionStart < patchShape):
+            return (numpy.array(centre, dtype=float) if centre is not None else ijkToRAS[:3, 3]), 0.0
+
+        region = voxels[regionStart[0]:regionStop[0], regionStart[1]:regionStop[1], regionStart[2]:regionStop[2]]
+        correlation = self.computeNormalizedCrossCorrelation(region, patch)
+        peak = numpy.array(numpy.unravel_index(numpy.argmax(correlation), correlation.shape))
+        score = correlation[tuple(peak)]
+
+        #Parabola through the peak & its neighbours on every axis
+        subVoxel = peak.astype(float)
+        for axis in range(3):
+            if 0 < peak[axis] < correlation.shape[axis] - 1:
+                before, after = numpy.array(peak), numpy.array(peak)
+                before[axis] -= 1
+                after[axis] += 1
+                curvature = correlation[tuple(before)] - 2 * score + correlation[tuple(after)]
+                if curvature < 0:
+                    subVoxel[axis] += 0.5 * (correlation[tuple(before)] - correlation[tuple(after)]) / curvature
+
+        centreKJI = regionStart + subVoxel + (patchShape - 1) / 2.0
+        return ijkToRAS.dot(list(centreKJI[::-1]) + [1.0])[:3], float(score)
+
+    def computeNormalizedCrossCorrelation(self, image, template):
+        """Normalized cross-correlation of template at every (k, j, i) offset where it fits inside
+        image: FFT correlation with the zero mean template, local image sums from summed volume
+        tables (accumulated in float64). Offsets where the image (or the template) is constant score 0
+        """
+        #float32 copies, the image may be a whole (coarse) volume
+        image       = numpy.asarray(image, dtype=numpy.float32)
+        image       = image - image.mean(dtype=numpy.float64).astype(numpy.float32)
+        template    = numpy.asarray(template, dtype=numpy.float32)
+        template    = template - template.mean(dtype=numpy.float64).astype(numpy.float32)
+        templateSumSquares = (template.astype(numpy.float64) ** 2).sum()
+        validShape  = tuple(numpy.array(image.shape) - template.shape + 1)
+
+        spectrum = numpy.fft.rfftn(image) * numpy.conj(numpy.fft.rfftn(template, image.shape))
+        correlation = numpy.fft.irfftn(spectrum, image.shape)[:validShape[0], :validShape[1], :validShape[2]]
+
+        #Sum of the image & of its squares under the template at every offset
+        sums, sumSquares = image, image ** 2
+        for axis, size in enumerate(template.shape):
+            sums        = self.computeWindowSums(sums, size, axis)
+            sumSquares  = self.computeWindowSums(sumSquares, size, axis)
+        variance = numpy.maximum(sumSquares - sums ** 2 / template.size, 0.0) * templateSumSquares
+
+        correlationScore = numpy.zeros(validShape)
+        valid = variance > 1e-12 * max(1.0, variance.max())
+        correlationScore[valid] = correlation[valid] / numpy.sqrt(variance[valid])
+        return numpy.clip(correlationScore, -1.0, 1.0)
+
+    def computeWindowSums(self, array, size, axis):
+        """Sums of size consecutive values along an axis (running sums of a cumulative sum)
+        """
+        cumulative = numpy.cumsum(array, axis=axis, dtype=numpy.float64)
+        shape = list(array.shape)
+        shape[axis] = 1
+        cumulative = numpy.concatenate([numpy.zeros(shape), cumulative], axis=axis)
+        return numpy.take(cumulative, range(size, cumulative.shape[axis]), axis=axis) - \
+               numpy.take(cumulative, range(0, cumulative.shape[axis] - size), axis=axis)
+
+    def applyLandmarkProposals(self, movingFiducial, proposals, minimumScore=0.5):
+        """Replaces the points of movingFiducial by the proposed landmarks scoring at least
+        minimumScore (labelled with their key & score), the others are skipped.
+        The proposals are attached to the node. Returns the placement checklist
+        """
+        movingFiducial.RemoveAllMarkups()
+        placementChecklist = {}
+        for proposal in proposals:
+            placementChecklist[proposal['key']] = proposal['score'] >= minimumScore
+            if placementChecklist[proposal['key']]:
+                index = movingFiducial.AddFiducialFromArray(proposal['position'])
+                movingFiducial.SetNthFiducialLabel(index, proposal['key'])
+                movingFiducial.SetNthMarkupDescription(index, "Proposed, NCC %.2f" % proposal['score'])
+        movingFiducial.SetAttribute('AlignCrop3DSlicerModule.LandmarkProposals', json.dumps(proposals))
+        return placementChecklist
+
+    def runSurfaceRegistration(self, transform, templateVolume, inputVolume, fixedFiducial=None, movingFiducial=None,
+                               placementChecklist=None, transformType='Rigid', threshold=None, maxPoints=5000,
+                               iterations=50):
+        """Alignment for cases with too few landmarks: the thresholded (bone) surfaces of both
+        volumes are fitted by iterative closest points (see computeICPTransform), starting from
+        the placed landmarks if any (see computeInitialSurfaceTransform). maxPoints input surface
+        points are fitted to up to 10 times as many (dense) template surface points, threshold
+        defaults to the Otsu threshold of each volume. Surfaces are taken in the volume coordinates (the
+        parent transforms are ignored, like the placed fiducials). The transform is stored in
+        transform with its fit quality (surface RMS distance as fre, no condition number).
+        Returns the transform as a 4x4 numpy matrix
+        """
+        logging.info("Now running Surface Registration")
+
+        fixedSurface, fixedThreshold    = self.extractSurfacePoints(templateVolume, threshold, 10 * maxPoints)
+        movingSurface, movingThreshold  = self.extractSurfacePoints(inputVolume, threshold, maxPoints)
+        if len(fixedSurface) < 3 or len(movingSurface) < 3:
+            raise ValueError("No surface found at threshold %g / %g" % (fixedThreshold, movingThreshold))
+
+        fixedPoints = movingPoints = numpy.zeros((0, 3))
+        landmarks = []
+        if fixedFiducial and movingFiducial and placementChecklist:
+            try:
+                fixedPoints, movingPoints = self.getLandmarkPointArrays(fixedFiducial, movingFiducial, placementChecklist)
+                landmarks = [key for key in self.getLandmarkOrder(placementChecklist) if placementChecklist[key]]
+            except ValueError as e:
+                logging.warning("Surface registration started without landmarks: %s" % e)
+
+        initialMatrix = self.computeInitialSurfaceTransform(fixedSurface, movingSurface, fixedPoints, movingPoints,
+                                                             transformType)
+        matrix, rms, iterationCount, inlierFraction = self.computeICPTransform(fixedSurface, movingSurface, initialMatrix,
+                                                                                transformType, iterations)
+        self.setTransformMatrix(transform, matrix)
+
+        #no landmark configuration to condition the fit, see isRegistrationQualityAcceptable
+        quality = self.createRegistrationQuality('surface', transformType, [], rms,
+                                                 landmarks=landmarks, rejected=[],
+                                                 surfacePoints=[len(fixedSurface), len(movingSurface)],
+                                                 thresholds=[fixedThreshold, movingThreshold],
+                                                 iterations=iterationCount, inlierFraction=inlierFraction)
+        transform.SetAttribute('AlignCrop3DSlicerModule.Quality', json.dumps(quality))
+        logging.info("Surface registration: RMS %.3f mm after %d iterations" % (rms, iterationCount))
+        return matrix
+
+    def extractSurfacePoints(self, volume, threshold=None, maxPoints=5000, maxVoxels=128*128*128, seed=0):
+        """Positions (RAS) of the boundary voxels of the thresholded volume on the finest pyramid
+        level with at most maxVoxels voxels, randomly subsampled to maxPoints.
+        threshold defaults to the Otsu threshold of that level. Returns the points & threshold
+        """
+        dimensions = volume.GetImageData().GetDimensions()
+        levels = 1 + max(0, int(numpy.ceil(numpy.log2(float(numpy.prod(dimensions)) / maxVoxels) / 3.0)))
+        voxels, ijkToRAS = self.getVolumePyramid(volume, levels, toWorld=False)[-1]
+        voxels = numpy.asarray(voxels)
+        if threshold is None:
+            threshold = self.computeOtsuThreshold(voxels)
+
+        #Foreground voxels with a background (or outside) neighbour along an axis
+        mask = voxels >= threshold
+        padded = numpy.pad(mask, 1, mode='constant')
+        interior = numpy.array(mask)
+        for axis in range(3):
+            for shift in (0, 2):
+                index = [slice(1, -1)] * 3
+                index[axis] = slice(shift, shift + mask.shape[axis])
+                interior &= padded[tuple(index)]
+        surfaceKJI = numpy.argwhere(mask & ~interior)
+        if len(surfaceKJI) > maxPoints:
+            surfaceKJI = surfaceKJI[numpy.random.RandomState(seed).choice(len(surfaceKJI), maxPoints, replace=False)]
+
+        points = numpy.hstack([surfaceKJI[:, ::-1].astype(float), numpy.ones((len(surfaceKJI), 1))])
+        return points.dot(ijkToRAS.T)[:, :3], float(threshold)
+
+    def computeOtsuThreshold(self, voxels, bins=256):
+        """Threshold maximizing the between class variance of the voxel histogram
+        """
+        histogram, edges = numpy.histogram(voxels, bins)
+        centres     = (edges[:-1] + edges[1:]) / 2.0
+        weightLow   = numpy.cumsum(histogram).astype(float)
+        weightHigh  = weightLow[-1] - weightLow
+        sumLow      = numpy.cumsum(histogram * centres)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            between = weightLow * weightHigh * (sumLow / weightLow - (sumLow[-1] - sumLow) / weightHigh) ** 2
+        between[~numpy.isfinite(between)] = -1.0
+        #Middle of the best thresholds (empty bins between the classes all separate them equally)
+        best = numpy.flatnonzero(between >= between.max() * (1.0 - 1e-9))
+        return float(edges[best[0] + 1] + edges[best[-1] + 1]) / 2.0
+
+    def computeInitialSurfaceTransform(self, fixedSurface, movingSurface, fixedPoints, movingPoints, transformType='Rigid'):
+        """Start of a surface registration (moving to fixed) from the placed landmark pairs:
+        the landmark transform for 3+, the rotation aligning the directions of the pairs about
+        their midpoints for 2, a translation for 1 and the translation of the surface centroids
+        without landmarks
+        """
+        if len(fixedPoints) >= 3:
+            return self.computeLandmarkTransform(fixedPoints, movingPoints, transformType)
+        if len(fixedPoints):
+            fixedCentre, movingCentre = fixedPoints.mean(axis=0), movingPoints.mean(axis=0)
+        else:
+            fixedCentre, movingCentre = fixedSurface.mean(axis=0), movingSurface.mean(axis=0)
+
+        rotation = numpy.identity(3)
+        if len(fixedPoints) == 2:
+            movingDirection = movingPoints[1] - movingPoints[0]
+            fixedDirection  = fixedPoints[1] - fixedPoints[0]
+            movingDirection /= max(numpy.linalg.norm(movingDirection), 1e-12)
+            fixedDirection  /= max(numpy.linalg.norm(fixedDirection), 1e-12)
+            axis, cosine = numpy.cross(movingDirection, fixedDirection), numpy.dot(movingDirection, fixedDirection)
+            if cosine > -1.0 + 1e-9:
+                #Rodrigues formula of the smallest rotation between the directions
+                cross = numpy.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+                rotation = numpy.identity(3) + cross + cross.dot(cross) / (1.0 + cosine)
+            else:
+                #Opposite directions, half turn about a perpendicular axis
+                perpendicular = numpy.cross(movingDirection, numpy.eye(3)[numpy.argmin(numpy.abs(movingDirection))])
+                perpendicular /= numpy.linalg.norm(perpendicular)
+                rotation = 2.0 * numpy.outer(perpendicular, perpendicular) - numpy.identity(3)
+
+        matrix = numpy.identity(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = fixedCentre - rotation.dot(movingCentre)
+        return matrix
+
+    def computeICPTransform(self, fixedPoints, movingPoints, initialMatrix=None, transformType='Rigid', iterations=50,
+                            tolerance=1e-4, trim=2.5):
+        """Iterative closest point fit of the moving onto the fixed (N, 3) points: every moving
+        point is paired with its nearest fixed point (k-d tree, see createNearestPointSearch),
+        pairs further than trim times the median distance are dropped and the landmark
+        transform of the pairs is solved, until the RMS distance changes less than tolerance (mm).
+        Returns the matrix, the RMS distance & the fraction of the kept pairs and the iterations
+        """
+        nearest = self.createNearestPointSearch(fixedPoints)
+        def pair(matrix):
+            distances, indices = nearest(movingPoints.dot(matrix[:3, :3].T) + matrix[:3, 3])
+            keep = distances <= trim * max(numpy.median(distances), 1e-6)
+            return indices, keep, float(numpy.sqrt((distances[keep] ** 2).mean()))
+
+        matrix = numpy.identity(4) if initialMatrix is None else numpy.array(initialMatrix, dtype=float)
+        indices, keep, rms = pair(matrix)
+        best = (matrix, rms, keep)
+        iteration = 0
+        for iteration in range(1, iterations + 1):
+            matrix = self.computeLandmarkTransform(fixedPoints[indices[keep]], movingPoints[keep], transformType)
+            indices, keep, newRMS = pair(matrix)
+            #Trimming changes the pairs, so the RMS may rise on the way: the best fit is kept
+            if newRMS < best[1]:
+                best = (matrix, newRMS, keep)
+            converged, rms = abs(rms - newRMS) < tolerance, newRMS
+            if converged:
+                break
+        matrix, rms, keep = best
+        return matrix, rms, iteration, float(keep.mean())
+
+    def createNearestPointSearch(self, points):
+        """Nearest neighbour search in an (N, 3) point set: scipy's cKDTree when available,
+        a VTK k-d tree point locator otherwise. Returns search(queryPoints) giving the
+        distances to & indices of the nearest points
+        """
+        points = numpy.ascontiguousarray(points, dtype=numpy.float64)
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            cKDTree = None
+        if cKDTree is not None:
+            tree = cKDTree(points)
+            return lambda queryPoints: tree.query(queryPoints)
+
+        vtkPoints = vtk.vtkPoints()
+        vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=True))
+        polyData = vtk.vtkPolyData()
+        polyData.SetPoints(vtkPoints)
+        locator = vtk.vtkKdTreePointLocator()
+        locator.SetDataSet(polyData)
+        locator.BuildLocator()
+        def search(queryPoints):
+            indices = numpy.array([locator.FindClosestPoint(point) for point in queryPoints.tolist()], dtype=int)
+            return numpy.sqrt(((points[indices] - queryPoints) ** 2).sum(axis=1)), indices
+        return search
+
+    #Similarity metrics of the intensity refinement: normalized cross correlation, mutual information
+    refinementMetrics = ['ncc', 'mi']
+
+    @AlignCrop3DSlicerModuleProfiler.profile('intensityRefinement')
+    def runIntensityRefinement(self, transform, templateVolume, inputVolume, roi, metric='ncc', levels=3,
+                               maxVoxels=512*1024, bins=32, maxEvaluations=150, threads=None,
+                               fixedFiducial=None, movingFiducial=None, placementChecklist=None,
+                               progressCallback=None, cancelEvent=None):
+        """Rigid refinement of the alignment in transform (input to template, e.g. from
+        runAlignmentRegistration) maximizing the similarity (metric 'ncc' or 'mi') of the template
+        and the resampled input inside roi only (the template region of interest of
+        runDefineCropROIVoxel). Coarse to fine over levels 2**level downsampled copies of the ROI
+        (levels with more than maxVoxels ROI voxels are skipped), each level is fitted by
+        runPatternSearch with steps of 2 down to 1/4 (finest level 1/16) voxels. The metric is evaluated on
+        threads (see createRegionSimilarity). The refined matrix is only kept if it improves on the
+        initial one at the finest level used, the outcome is added to the registration quality.
+        Once a refinement is accepted the landmark residuals & FRE of the quality are those of the
+        refined matrix when the fiducials of the landmark fit are given ('landmarkMetrics' refined),
+        otherwise they stay those of the landmark fit ('landmarkMetrics' preRefinement); the
+        values of the landmark fit are kept in 'landmarkFit'. Leave-one-out errors & the condition
+        number describe the landmarks, not the refined matrix.
+        Returns the transform as a 4x4 numpy matrix
+        """
+        if metric not in self.refinementMetrics:
+            raise ValueError("Unsupported similarity metric: %s" % metric)
+        logging.info("Now running Intensity Refinement")
+
+        initialMatrix   = self.getTransformMatrix(transform)
+        roiBounds       = self.getROIBounds(roi)
+        centre          = numpy.array([(roiBounds[2 * axis] + roiBounds[2 * axis + 1]) / 2.0 for axis in range(3)])
+        radius          = max(numpy.linalg.norm([roiBounds[2 * axis + 1] - roiBounds[2 * axis] for axis in range(3)]) / 2.0, 1e-3)
+
+        #Only the template ROI and the input region it maps into (with a margin for the refinement) are read
+        templateIJKToRAS = self.getVolumeIJKToRAS(templateVolume)
+        templateExtent = self.computeROIVoxelExtent(roiBounds, templateIJKToRAS, templateVolume.GetImageData().GetDimensions())
+        templatePyramid = self.getRegionPyramid(templateVolume, templateExtent, levels)
+
+        inputIJKToRAS   = self.getVolumeIJKToRAS(inputVolume)
+        margin          = 0.25 * radius + 2 ** len(templatePyramid) * numpy.linalg.norm(inputIJKToRAS[:3, :3], axis=0).max()
+        corners         = numpy.array([[x, y, z, 1.0] for x in roiBounds[0:2] for y in roiBounds[2:4] for z in roiBounds[4:6]])
+        inputCorners    = numpy.linalg.inv(initialMatrix).dot(corners.T)[:3]
+        inputBounds     = []
+        for axis in range(3):
+            inputBounds += [inputCorners[axis].min() - margin, inputCorners[axis].max() + margin]
+        inputExtent = self.computeROIVoxelExtent(inputBounds, inputIJKToRAS, inputVolume.GetImageData().GetDimensions())
+        inputPyramid = self.getRegionPyramid(inputVolume, inputExtent, len(templatePyramid))
+
+        usedLevels = [level for level in range(len(templatePyramid)) if templatePyramid[level][0].size <= maxVoxels]
+        usedLevels = usedLevels or [len(templatePyramid) - 1]
+
+        #Parameters: rotations (radians) about the ROI centre & translations (mm) in template space
+        def refinedMatrix(parameters):
+            return self.computeRigidParameterMatrix(parameters, centre).dot(initialMatrix)
+
+        threads = threads or multiprocessing.cpu_count()
+        pool = ThreadPool(threads)
+        try:
+            parameters, evaluations = numpy.zeros(6), 0
+            for index, level in enumerate(reversed(usedLevels)):
+                self.reportProgress(float(index) / len(usedLevels), progressCallback, cancelEvent)
+                fixedVoxels, fixedIJKToRAS = templatePyramid[level]
+                movingVoxels, movingIJKToRAS = inputPyramid[min(level, len(inputPyramid) - 1)]
+                similarity = self.createRegionSimilarity(fixedVoxels, fixedIJKToRAS, movingVoxels, movingIJKToRAS,
+                                                         metric, bins, pool, 2 * threads)
+                spacing = numpy.linalg.norm(fixedIJKToRAS[:3, :3], axis=0).max()
+                steps = 2 * spacing * numpy.array([1.0 / radius] * 3 + [1.0] * 3)
+                #Down to 1/4 voxel on the coarser levels, 1/16 voxel on the finest
+                minimumSteps = steps / (32 if index == len(usedLevels) - 1 else 8)
+                parameters, value, levelEvaluations = self.runPatternSearch(lambda p: similarity(refinedMatrix(p)),
+                                                                            parameters, steps, minimumSteps, maxEvaluations,
+                                                                            cancelEvent)
+                evaluations += levelEvaluations
+            initialValue = similarity(initialMatrix)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        matrix = refinedMatrix(parameters)
+        accepted = value > initialValue
+        if accepted:
+            self.setTransformMatrix(transform, matrix)
+        else:
+            matrix = initialMatrix
+            logging.warning("Intensity refinement did not improve the %s metric, alignment kept" % metric)
+
+        quality = self.getRegistrationQuality(transform) or {}
+        if accepted and 'fre' in quality:
+            landmarkFit = dict((key, quality.get(key)) for key in ['residuals', 'fre', 'looTRE', 'maxLooTRE', 'conditionNumber'])
+            landmarkMetrics = 'preRefinement'
+            if quality.get('method') != 'surface' and fixedFiducial and movingFiducial and placementChecklist:
+                refinedQuality = self.computeRefinedLandmarkQuality(quality, matrix, fixedFiducial, movingFiducial,
+                                                                    placementChecklist)
+                if refinedQuality is not None:
+                    quality.update(refinedQuality)
+                    landmarkMetrics = 'refined'
+        quality['refinement'] = { 'metric'        : metric,
+                                  'initialValue'  : float(initialValue),
+                                  'finalValue'    : float(max(value, initialValue)),
+                                  'accepted'      : bool(accepted),
+                                  'levels'        : len(usedLevels),
+                                  'evaluations'   : evaluations,
+                                  'rotationDeg'   : float(numpy.degrees(numpy.linalg.norm(parameters[:3]))) if accepted else 0.0,
+                                  'translationMM' : float(numpy.linalg.norm(parameters[3:])) if accepted else 0.0 }
+        if accepted and 'fre' in quality:
+            quality['refinement'].update({ 'landmarkFit' : landmarkFit, 'landmarkMetrics' : landmarkMetrics })
+        transform.SetAttribute('AlignCrop3DSlicerModule.Quality', json.dumps(quality))
+        self.reportProgress(1.0, progressCallback, cancelEvent)
+        return matrix
+
+    def computeRefinedLandmarkQuality(self, quality, matrix, fixedFiducial, movingFiducial, placementChecklist):
+        """Residuals & FRE of the landmarks fitted by quality (inliers of a robust fit) under a
+        refined matrix, None if the fiducials do not match the checklist
+        """
+        try:
+            fixedPoints, movingPoints = self.getLandmarkPointArrays(fixedFiducial, movingFiducial, placementChecklist)
+        except ValueError as e:
+            logging.warning("Landmark residuals of the refinement not computed: %s" % e)
+            return None
+        placed = [key for key in self.getLandmarkOrder(placementChecklist) if placementChecklist[key]]
+        fitted = numpy.array([key in quality.get('landmarks', placed) for key in placed], dtype=bool)
+        transformed = movingPoints[fitted].dot(matrix[:3, :3].T) + matrix[:3, 3]
+        residuals = numpy.sqrt(((transformed - fixedPoints[fitted]) ** 2).sum(axis=1))
+        return { 'residuals'   : residuals.tolist(),
+                 'fre'         : float(numpy.sqrt((residuals ** 2).mean())) if len(residuals) else 0.0 }
+
+    def getRegionPyramid(self, volume, extent, levels):
+        """Float32 voxels & IJK to RAS matrices of the voxel extent [[iStart, iStop], ...] of a
+        volume and of its 2**level downsampled copies (see getVolumePyramid), finest first
+        """
+        (iStart, iStop), (jStart, jStop), (kStart, kStop) = extent
+        voxels = numpy.asarray(slicer.util.arrayFromVolume(volume)[kStart:kStop, jStart:jStop, iStart:iStop], dtype=numpy.float32)
+        ijkToRAS = numpy.array(self.getVolumeIJKToRAS(volume), dtype=float)
+        ijkToRAS[:3, 3] = ijkToRAS.dot([iStart, jStart, kStart, 1.0])[:3]
+        pyramid = [(voxels, ijkToRAS)]
+        for level in range(1, levels):
+            if min(voxels.shape) // 2 < 4:
+                break
+            voxels = self.downsampleArray(voxels)
+            ijkToRAS = numpy.array(ijkToRAS)
+            ijkToRAS[:3, 3] = ijkToRAS.dot([0.5, 0.5, 0.5, 1.0])[:3]
+            ijkToRAS[:3, :3] *= 2
+            pyramid.append((voxels, ijkToRAS))
+        return pyramid
+
+    def computeRigidParameterMatrix(self, parameters, centre):
+        """Rigid 4x4 matrix of rotations about x, y & z (radians, about centre) followed by
+        a translation (mm), parameters [rx, ry, rz, tx, ty, tz]
+        """
+        rotation = numpy.identity(3)
+        for axis in range(3):
+            cosine, sine = numpy.cos(parameters[axis]), numpy.sin(parameters[axis])
+            first, second = [other for other in range(3) if other != axis]
+            axisRotation = numpy.identity(3)
+            axisRotation[first, first] = axisRotation[second, second] = cosine
+            axisRotation[first, second], axisRotation[second, first] = -sine, sine
+            rotation = axisRotation.dot(rotation)
+        matrix = numpy.identity(4)
+        matrix[:3, :3] = rotation
+        matrix[:3, 3] = centre - rotation.dot(centre) + numpy.asarray(parameters[3:6])
+        return matrix
+
+    def createRegionSimilarity(self, fixedVoxels, fixedIJKToRAS, movingVoxels, movingIJKToRAS, metric='ncc', bins=32,
+                               pool=None, slabs=1, minimumOverlap=0.5):
+        """Similarity of the fixed voxels and the moving voxels resampled through a matrix
+        (moving to fixed RAS), as a function of the matrix: normalized cross correlation
+        ('ncc') or mutual information of bins x bins joint histograms ('mi'). The fixed voxels
+        are split into slabs whose resampling & partial statistics (sums or histograms) run on
+        the threads of pool (numpy releases the GIL) and are combined.
+        Matrices mapping less than minimumOverlap of the fixed voxels into the moving ones score -inf
+        """
+        fixedVoxels     = numpy.asarray(fixedVoxels, dtype=numpy.float32)
+        movingVoxels    = numpy.asarray(movingVoxels, dtype=numpy.float32)
+        movingRASToIJK  = numpy.linalg.inv(movingIJKToRAS)
+        slabSlices      = max(1, -(-fixedVoxels.shape[0] // max(1, slabs)))
+        slabStarts      = list(range(0, fixedVoxels.shape[0], slabSlices))
+
+        def binIndices(voxels, low, high):
+            return numpy.clip(((voxels - low) * (bins / max(high - low, 1e-12))).astype(numpy.intp), 0, bins - 1)
+        if metric == 'mi':
+            fixedBins = binIndices(fixedVoxels, float(fixedVoxels.min()), float(fixedVoxels.max())) * bins
+            movingRange = float(movingVoxels.min()), float(movingVoxels.max())
+
+        def slabStatistics(start, fixedToMovingIJK):
+            stop = min(start + slabSlices, fixedVoxels.shape[0])
+            offset = numpy.identity(4)
+            offset[2, 3] = start
+            moving = numpy.empty((stop - start,) + fixedVoxels.shape[1:], dtype=numpy.float32)
+            self.resampleArray(movingVoxels, fixedToMovingIJK.dot(offset), moving.shape, outputArray=moving,
+                               defaultValue=numpy.nan)
+            inside = ~numpy.isnan(moving)
+            if metric == 'mi':
+                return numpy.bincount(fixedBins[start:stop][inside] + binIndices(moving[inside], *movingRange),
+                                      minlength=bins * bins)
+            fixed, moving = fixedVoxels[start:stop][inside].astype(numpy.float64), moving[inside].astype(numpy.float64)
+            return numpy.array([len(fixed), fixed.sum(), moving.sum(), fixed.dot(fixed), moving.dot(moving), fixed.dot(moving)])
+
+        def similarity(matrix):
+            compute = functools.partial(slabStatistics,
+                                        fixedToMovingIJK=movingRASToIJK.dot(numpy.linalg.inv(matrix)).dot(fixedIJKToRAS))
+            statistics = sum(pool.map(compute, slabStarts) if pool else [compute(start) for start in slabStarts])
+            if metric == 'mi':
+                count = statistics.sum()
+                if count < minimumOverlap * fixedVoxels.size:
+                    return -numpy.inf
+                joint = statistics.reshape(bins, bins) / float(count)
+                marginals = numpy.outer(joint.sum(axis=1), joint.sum(axis=0))
+                nonzero = joint > 0
+                return float((joint[nonzero] * numpy.log(joint[nonzero] / marginals[nonzero])).sum())
+            count, fixedSum, movingSum, fixedSquares, movingSquares, products = statistics
+            if count < minimumOverlap * fixedVoxels.size:
+                return -numpy.inf
+            variance = (fixedSquares - fixedSum ** 2 / count) * (movingSquares - movingSum ** 2 / count)
+            if variance <= 0:
+                return -numpy.inf
+            return float((products - fixedSum * movingSum / count) / numpy.sqrt(variance))
+        return similarity
+
+    def runPatternSearch(self, function, parameters, steps, minimumSteps, maxEvaluations=150, cancelEvent=None):
+        """Maximizes function(parameters) by a compass search: every parameter is moved by
+        +/- its step while that improves the value, all steps are halved when no move does,
+        until they are below minimumSteps or after maxEvaluations evaluations.
+        Returns the best parameters, their value & the number of evaluations
+        """
+        parameters  = numpy.array(parameters, dtype=float)
+        steps       = numpy.array(steps, dtype=float)
+        value       = function(parameters)
+        evaluations = 1
+        while numpy.all(steps >= minimumSteps) and evaluations < maxEvaluations:
+            self.reportProgress(None, None, cancelEvent)
+            improved = False
+            for index in range(len(parameters)):
+                for direction in (1.0, -1.0):
+                    candidate = parameters.copy()
+                    candidate[index] += direction * steps[index]
+                    candidateValue = function(candidate)
+                    evaluations += 1
+                    if candidateValue > value:
+                        parameters, value, improved = candidate, candidateValue, True
+                        break
+            if not improved:
+                steps /= 2
+        return parameters, value, evaluations
 
     def runDefineCropROI(self, cropParam):
         """
@@ -848,43 +2914,1864 @@ class AlignCrop3DSlicerModuleLogic(ScriptedLoadableModuleLogic):
         roi.SetRadiusXYZ(volDim[0]/2, volDim[1]/2, volDim[2]/2 )
         return roi
 
-    def runDefineCropROIVoxel(self, inputVol):
+    #Template ROI modes: the whole template extent or the bounding box of its foreground
+    roiModes = ['volume', 'foreground']
 
-        #create crop volume parameter node
-        cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
-        cropParamNode.SetScene(slicer.mrmlScene)
-        cropParamNode.SetName('Template_ROI')
+    @AlignCrop3DSlicerModuleProfiler.profile('defineCropROIVoxel')
+    def runDefineCropROIVoxel(self, inputVol, scope=None, cache=None, mode='volume', threshold=None, label=None, margin=1.0):
+        """Region of interest covering the template volume, snapped to its voxel grid.
+        With mode 'foreground' it only covers the template foreground (see computeForegroundExtent,
+        threshold, label) plus margin (mm).
+        With a scene scope the ROI & parameter nodes of the previous case are reused.
+        With an atlas cache the ROI of an already seen template is restored from the cache
+        """
+        if mode not in self.roiModes:
+            raise ValueError("Unsupported ROI mode: %s" % mode)
+        roiKey = self.getForegroundROIKey(threshold, label, margin) if mode == 'foreground' else None
+        cachedBounds = cache.getROIBounds(inputVol, roiKey) if cache else None
+        if cachedBounds:
+            if scope:
+                template_roi = scope.getNode('templateROI', 'vtkMRMLAnnotationROINode', 'Template_ROI')
+            else:
+                template_roi = slicer.vtkMRMLAnnotationROINode()
+                template_roi.SetName('Template_ROI')
+                slicer.mrmlScene.AddNode(template_roi)
+            template_roi.SetXYZ([(cachedBounds[2 * axis] + cachedBounds[2 * axis + 1]) / 2.0 for axis in range(3)])
+            template_roi.SetRadiusXYZ([(cachedBounds[2 * axis + 1] - cachedBounds[2 * axis]) / 2.0 for axis in range(3)])
+            return template_roi
+
+        #create crop volume parameter node & ROI
+        if scope:
+            cropParamNode   = scope.getNode('templateROIParameters', 'vtkMRMLCropVolumeParametersNode', 'Template_ROI')
+            template_roi    = scope.getNode('templateROI', 'vtkMRMLAnnotationROINode', 'Template_ROI')
+        else:
+            cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
+            cropParamNode.SetScene(slicer.mrmlScene)
+            cropParamNode.SetName('Template_ROI')
+            template_roi = slicer.vtkMRMLAnnotationROINode()
+            slicer.mrmlScene.AddNode(template_roi)
+            slicer.mrmlScene.AddNode(cropParamNode)
         cropParamNode.SetInputVolumeNodeID(inputVol.GetID())
-
-        #create ROI
-        template_roi = slicer.vtkMRMLAnnotationROINode()
-        slicer.mrmlScene.AddNode(template_roi)
         cropParamNode.SetROINodeID(template_roi.GetID())
 
         #Fit roi to input image
-        slicer.mrmlScene.AddNode(cropParamNode)
         slicer.modules.cropvolume.logic().SnapROIToVoxelGrid(cropParamNode)
         slicer.modules.cropvolume.logic().FitROIToInputVolume(cropParamNode)
 
+        #parameter node only needed while fitting
+        if not scope:
+            slicer.mrmlScene.RemoveNode(cropParamNode)
+
+        #Shrink to the foreground, in the (voxel grid aligned) coordinates of the fitted ROI
+        if mode == 'foreground':
+            extent = self.computeForegroundExtent(inputVol, threshold, label, margin)
+            roiToWorld = self.getTransformToWorldMatrix(template_roi.GetParentTransformNode())
+            bounds = self.computeVoxelExtentBounds(extent, numpy.linalg.inv(roiToWorld).dot(self.getVolumeIJKToRAS(inputVol)))
+            template_roi.SetXYZ([(bounds[2 * axis] + bounds[2 * axis + 1]) / 2.0 for axis in range(3)])
+            template_roi.SetRadiusXYZ([(bounds[2 * axis + 1] - bounds[2 * axis]) / 2.0 for axis in range(3)])
+
+        #ROIs of oblique templates are transformed & can not be restored from bounds
+        if cache and not template_roi.GetParentTransformNode():
+            cache.setROIBounds(inputVol, self.getROIBounds(template_roi), roiKey)
+
         return template_roi
 
-    def runCropVolume(self, roi, volume):
+    def getForegroundROIKey(self, threshold=None, label=None, margin=1.0):
+        """Key of the foreground ROI parameters in the caches
+        """
+        return json.dumps({'threshold': threshold, 'label': label, 'margin': round(float(margin), 6)}, sort_keys=True)
+
+    @AlignCrop3DSlicerModuleProfiler.profile('foregroundExtent')
+    def computeForegroundExtent(self, volume, threshold=None, label=None, margin=1.0, slabVoxels=16*1024*1024):
+        """Voxel extent [[iStart, iStop], ...] (stop exclusive) of the foreground of a volume plus
+        margin (mm, rounded up to whole voxels), clipped to the volume. The foreground is the voxels
+        equal to label if given, the non zero voxels of label maps, or else the voxels at or above
+        threshold (default - Otsu threshold). Computed in one pass of slab projections and cached on
+        the volume node per parameters & voxel modification time
+        """
+        cacheKey = '%s@%d' % (self.getForegroundROIKey(threshold, label, margin), volume.GetImageData().GetMTime())
+        cached = json.loads(volume.GetAttribute('AlignCrop3DSlicerModule.ForegroundExtent') or '{}')
+        if cacheKey in cached:
+            return cached[cacheKey]
+
+        voxels = slicer.util.arrayFromVolume(volume)
+        if label is not None:
+            isForeground = lambda slab: slab == label
+        elif threshold is None and volume.IsA('vtkMRMLLabelMapVolumeNode'):
+            isForeground = lambda slab: slab != 0
+        else:
+            if threshold is None:
+                threshold = self.computeOtsuThreshold(voxels)
+            isForeground = lambda slab: slab >= threshold
+
+        slabSlices  = max(1, int(slabVoxels // max(1, voxels.shape[1] * voxels.shape[2])))
+        sliceMask   = numpy.zeros(voxels.shape[0], dtype=bool)
+        rowMask     = numpy.zeros(voxels.shape[1:], dtype=bool)
+        for start in range(0, voxels.shape[0], slabSlices):
+            mask = isForeground(voxels[start:start + slabSlices])
+            sliceMask[start:start + len(mask)] = mask.reshape(len(mask), -1).any(axis=1)
+            rowMask |= mask.any(axis=0)
+        if not sliceMask.any():
+            raise ValueError("No foreground found in %s" % volume.GetName())
+
+        #(k, j, i) projections to (i, j, k) index ranges
+        projections = [rowMask.any(axis=0), rowMask.any(axis=1), sliceMask]
+        spacing = numpy.linalg.norm(self.getVolumeIJKToRAS(volume)[:3, :3], axis=0)
+        extent = []
+        for axis in range(3):
+            indices = numpy.flatnonzero(projections[axis])
+            marginVoxels = int(numpy.ceil(margin / spacing[axis] - 1e-6))
+            extent.append([int(max(indices[0] - marginVoxels, 0)),
+                           int(min(indices[-1] + 1 + marginVoxels, len(projections[axis])))])
+
+        cached[cacheKey] = extent
+        volume.SetAttribute('AlignCrop3DSlicerModule.ForegroundExtent', json.dumps(cached))
+        return extent
+
+    def computeVoxelExtentBounds(self, extent, ijkToRAS):
+        """RAS bounds [xmin, xmax, ...] of the voxel boundaries of a voxel extent [[iStart, iStop], ...]
+        """
+        corners = numpy.array([[i - 0.5, j - 0.5, k - 0.5, 1.0] for i in extent[0] for j in extent[1] for k in extent[2]])
+        cornersRAS = numpy.asarray(ijkToRAS).dot(corners.T)[:3]
+        bounds = []
+        for axis in range(3):
+            bounds += [float(cornersRAS[axis].min()), float(cornersRAS[axis].max())]
+        return bounds
+
+    @AlignCrop3DSlicerModuleProfiler.profile('cropVolume')
+    def runCropVolume(self, roi, volume, scope=None, useFastPath=True, outputType='input', rescaleRange=None,
+                      spacing=None, spacingScale=1.0, isotropic=False, interpolation='linear'):
+        """Crops volume to roi, as a slice of the voxel array when the ROI is voxel aligned,
+        with the CropVolume module otherwise. outputType & rescaleRange select the output
+        scalar type (see prepareOutputCast).
+        spacing, spacingScale & isotropic resample the ROI to a new spacing in the same pass
+        (see computeOutputSpacing), with one of the cropInterpolations. Nearest & linear
+        resampling is done from the voxel array (see runAlignCropVolume).
+        Returns the cropped volume node
+        """
 
         logging.info('Cropping processing started')
 
+        inputSpacing    = numpy.array(volume.GetSpacing())
+        outputSpacing   = self.computeOutputSpacing(inputSpacing, spacing, spacingScale, isotropic)
+        resample        = not numpy.allclose(outputSpacing, inputSpacing)
+        transform       = volume.GetParentTransformNode()
+        if resample and interpolation in self.resampleInterpolations and not roi.GetParentTransformNode() \
+                and (not transform or transform.IsLinear()):
+            croppedVolume = self.runAlignCropVolume(roi, volume, interpolation=interpolation, outputType=outputType,
+                                                    rescaleRange=rescaleRange, spacing=outputSpacing)
+            logging.info('Cropping processing completed (resampled)')
+            return croppedVolume
+
+        #Voxel snapped ROI aligned with the voxel grid: crop is a plain slice of the voxel array
+        if useFastPath and not resample and not volume.GetParentTransformNode() and not roi.GetParentTransformNode():
+            roiBounds   = self.getROIBounds(roi)
+            ijkToRAS    = self.getVolumeIJKToRAS(volume)
+            if self.isROIVoxelAligned(roiBounds, ijkToRAS):
+                croppedVolume = self.runCropVolumeArray(roiBounds, volume, outputType, rescaleRange)
+                logging.info('Cropping processing completed (voxel aligned)')
+                return croppedVolume
+
+        #CropVolume resamples to the input spacing (the isotropic one: the smallest) times a scale
+        interpolationMode = self.getCropInterpolationMode(interpolation)
+        if spacing is not None:
+            if not numpy.allclose(outputSpacing, outputSpacing[0]):
+                raise ValueError("Anisotropic spacing %s needs %s interpolation" % (list(outputSpacing),
+                                                                                   ' or '.join(self.resampleInterpolations)))
+            isotropic, spacingScale = True, outputSpacing[0] / inputSpacing.min()
+
         #Create Crop Volume Parameter node
-        cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
-        cropParamNode.SetScene(slicer.mrmlScene)
-        cropParamNode.SetName('Crop_volume_Node1')
+        if scope:
+            cropParamNode = scope.getNode('cropParameters', 'vtkMRMLCropVolumeParametersNode', 'Crop_volume_Node1')
+        else:
+            cropParamNode = slicer.vtkMRMLCropVolumeParametersNode()
+            cropParamNode.SetScene(slicer.mrmlScene)
+            cropParamNode.SetName('Crop_volume_Node1')
+            slicer.mrmlScene.AddNode(cropParamNode)
         cropParamNode.SetInputVolumeNodeID(volume.GetID())
         cropParamNode.SetROINodeID(roi.GetID())
-        slicer.mrmlScene.AddNode(cropParamNode)
+        #always crop into a new volume
+        cropParamNode.SetOutputVolumeNodeID(None)
+        cropParamNode.SetIsotropicResampling(isotropic)
+        cropParamNode.SetSpacingScalingConst(spacingScale)
+        cropParamNode.SetInterpolationMode(interpolationMode)
 
         #Apply Cropping
         slicer.modules.cropvolume.logic().Apply(cropParamNode)
+        croppedVolume = slicer.mrmlScene.GetNodeByID(cropParamNode.GetOutputVolumeNodeID())
+
+        #parameter node only needed while cropping
+        if not scope:
+            slicer.mrmlScene.RemoveNode(cropParamNode)
+        if croppedVolume:
+            self.castVolume(croppedVolume, outputType, rescaleRange)
 
         logging.info('Cropping processing completed')
 
+        return croppedVolume
+
+    #Interpolations of the crops, the first ones are also resampled by resampleArray
+    resampleInterpolations  = ['nearest', 'linear']
+    cropInterpolations      = resampleInterpolations + ['sinc', 'bspline']
+
+    def getCropInterpolationMode(self, interpolation):
+        """CropVolume parameter node interpolation mode of a cropInterpolations name
+        """
+        modes = { 'nearest' : slicer.vtkMRMLCropVolumeParametersNode.InterpolationNearestNeighbor,
+                  'linear'  : slicer.vtkMRMLCropVolumeParametersNode.InterpolationLinear,
+                  'sinc'    : slicer.vtkMRMLCropVolumeParametersNode.InterpolationWindowedSinc,
+                  'bspline' : slicer.vtkMRMLCropVolumeParametersNode.InterpolationBSpline }
+        if interpolation not in modes:
+            raise ValueError("Unsupported interpolation: %s" % interpolation)
+        return modes[interpolation]
+
+    def computeOutputSpacing(self, inputSpacing, spacing=None, spacingScale=1.0, isotropic=False):
+        """Output spacing of a resampling crop: spacing (a single value - isotropic) if given,
+        else the input spacing (isotropic - its smallest value on all axes) times spacingScale
+        """
+        if spacing is not None:
+            spacing = numpy.asarray(spacing, dtype=float)
+            return numpy.repeat(spacing, 3) if spacing.ndim == 0 else spacing
+        inputSpacing = numpy.asarray(inputSpacing, dtype=float)
+        if isotropic:
+            inputSpacing = numpy.repeat(inputSpacing.min(), 3)
+        return inputSpacing * spacingScale
+
+    def isROIVoxelAligned(self, roiBounds, ijkToRAS, tolerance=1e-3):
+        """True if the volume axes are aligned with the RAS axes (up to order & sign) and the
+        ROI faces lie on voxel boundaries, i.e. cropping needs no interpolation
+        """
+        directions = numpy.asarray(ijkToRAS, dtype=float)[:3, :3]
+        directions = directions / numpy.linalg.norm(directions, axis=0)
+        if not numpy.all((numpy.abs(directions) > 1.0 - 1e-6).sum(axis=0) == 1):
+            return False
+
+        corners = numpy.array([[x, y, z, 1.0] for x in roiBounds[0:2]
+                                              for y in roiBounds[2:4]
+                                              for z in roiBounds[4:6]])
+        boundaries = numpy.linalg.inv(ijkToRAS).dot(corners.T)[:3] + 0.5
+        return bool(numpy.all(numpy.abs(boundaries - numpy.round(boundaries)) < tolerance))
+
+    @AlignCrop3DSlicerModuleProfiler.profile('cropVolumeArray')
+    def runCropVolumeArray(self, roiBounds, volume, outputType='input', rescaleRange=None):
+        """Crops a volume to voxel aligned RAS bounds by slicing its voxel array,
+        without interpolation. The voxels are copied (& cast, see prepareOutputCast) once,
+        straight into the new volume
+        """
+        ijkToRAS    = self.getVolumeIJKToRAS(volume)
+        inputArray  = slicer.util.arrayFromVolume(volume)
+        (i0, i1), (j0, j1), (k0, k1) = self.computeROIVoxelExtent(roiBounds, ijkToRAS, inputArray.shape[::-1])
+
+        croppedIJKToRAS = numpy.array(ijkToRAS)
+        croppedIJKToRAS[:3, 3] = ijkToRAS.dot([i0, j0, k0, 1.0])[:3]
+        sourceArray = inputArray[k0:k1, j0:j1, i0:i1]
+        outputDtype, rescale, castStats = self.prepareOutputCast(inputArray.dtype, outputType, rescaleRange, sourceArray)
+        croppedVolume, croppedArray = self.createVolumeNode(volume.GetName() + '-cropped', sourceArray.shape,
+                                                            outputDtype, croppedIJKToRAS)
+        if rescale is None:
+            croppedArray[...] = sourceArray
+        else:
+            self.castArray(sourceArray, croppedArray, rescale, castStats)
+        croppedVolume.GetImageData().Modified()
+        self.setCastStats(croppedVolume, self.finishCastStats(castStats, croppedArray.size))
+
+        return croppedVolume
+
+    #NRRD type names & their numpy equivalents
+    nrrdTypes = { 'int8'     : ['signed char', 'int8', 'int8_t'],
+                  'uint8'    : ['uchar', 'unsigned char', 'uint8', 'uint8_t'],
+                  'int16'    : ['short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'],
+                  'uint16'   : ['ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'],
+                  'int32'    : ['int', 'signed int', 'int32', 'int32_t'],
+                  'uint32'   : ['uint', 'unsigned int', 'uint32', 'uint32_t'],
+                  'int64'    : ['longlong', 'long long', 'long long int', 'signed long long',
+                                'signed long long int', 'int64', 'int64_t'],
+                  'uint64'   : ['ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'],
+                  'float32'  : ['float'],
+                  'float64'  : ['double'] }
+
+    def readNrrdHeader(self, path):
+        """Parses the header of a 3D scalar NRRD file.
+        Returns a dictionary with the data file, data offset, numpy dtype, encoding,
+        dimensions (i, j, k) and the IJK to RAS matrix
+        """
+        fields = {}
+        with open(path, 'rb') as nrrdFile:
+            magic = nrrdFile.readline().decode('ascii', 'replace').strip()
+            if not magic.startswith('NRRD'):
+                raise ValueError("%s is not a NRRD file" % path)
+            while True:
+                line = nrrdFile.readline()
+                if not line or not line.strip():
+                    break
+                line = line.decode('ascii', 'replace').strip()
+                if line.startswith('#') or ':=' in line:
+                    continue
+                key, value = line.split(':', 1)
+                fields[key.strip().lower()] = value.strip()
+            dataOffset = nrrdFile.tell()
+
+        if int(fields.get('dimension', 0)) != 3:
+            raise ValueError("Only 3D scalar NRRD files are supported")
+
+        typeName = fields['type'].lower()
+        dtype = None
+        for numpyType, names in self.nrrdTypes.items():
+            if typeName in names:
+                dtype = numpy.dtype(numpyType)
+        if dtype is None:
+            raise ValueError("Unsupported NRRD type: %s" % typeName)
+        if dtype.itemsize > 1:
+            dtype = dtype.newbyteorder('>' if fields.get('endian', 'little') == 'big' else '<')
+
+        dimensions = [int(size) for size in fields['sizes'].split()]
+
+        #Axis directions & origin, NRRD stores them in the file's space (LPS, RAS, ..)
+        if 'space directions' in fields:
+            directions = [[float(value) for value in vector.strip('()').split(',')]
+                          for vector in fields['space directions'].split()]
+        else:
+            spacings = [float(value) for value in fields.get('spacings', '1 1 1').split()]
+            directions = numpy.diag(spacings).tolist()
+        origin = [0.0, 0.0, 0.0]
+        if 'space origin' in fields:
+            origin = [float(value) for value in fields['space origin'].strip('()').split(',')]
+
+        spaceSigns = { 'left-posterior-superior'    : [-1, -1, 1], 'lps' : [-1, -1, 1],
+                       'right-anterior-superior'    : [1, 1, 1],   'ras' : [1, 1, 1],
+                       'left-anterior-superior'     : [-1, 1, 1],  'las' : [-1, 1, 1] }
+        space = fields.get('space', 'right-anterior-superior').lower()
+        if space not in spaceSigns:
+            raise ValueError("Unsupported NRRD space: %s" % space)
+        signs = numpy.array(spaceSigns[space], dtype=float)
+
+        ijkToRAS = numpy.identity(4)
+        ijkToRAS[:3, :3] = (numpy.array(directions, dtype=float) * signs).T
+        ijkToRAS[:3, 3]  = numpy.array(origin, dtype=float) * signs
+
+        #Detached data file
+        dataFile = path
+        dataFileName = fields.get('data file', fields.get('datafile'))
+        if dataFileName:
+            dataFile = dataFileName
+            if not os.path.isabs(dataFile):
+                dataFile = os.path.join(os.path.dirname(os.path.abspath(path)), dataFileName)
+            dataOffset = 0
+            lineSkip = int(fields.get('line skip', fields.get('lineskip', 0)))
+            if lineSkip:
+                with open(dataFile, 'rb') as rawFile:
+                    for line in range(lineSkip):
+                        rawFile.readline()
+                    dataOffset = rawFile.tell()
+
+        encoding = fields.get('encoding', 'raw').lower()
+        byteSkip = int(fields.get('byte skip', fields.get('byteskip', 0)))
+        if byteSkip == -1 and encoding == 'raw':
+            dataOffset = os.path.getsize(dataFile) - dtype.itemsize * int(numpy.prod(dimensions))
+        elif byteSkip > 0:
+            dataOffset += byteSkip
+
+        return { 'dataFile'     : dataFile,
+                 'dataOffset'   : dataOffset,
+                 'dtype'        : dtype,
+                 'encoding'     : encoding,
+                 'dimensions'   : dimensions,
+                 'ijkToRAS'     : ijkToRAS }
+
+    def openNrrdArray(self, path):
+        """Memory maps the voxels of an uncompressed NRRD file.
+        Returns the (k, j, i) ordered read only array and the IJK to RAS matrix
+        """
+        header = self.readNrrdHeader(path)
+        if header['encoding'] != 'raw':
+            raise ValueError("Memory mapping requires raw encoding, %s is %s encoded" % (path, header['encoding']))
+        array = numpy.memmap( header['dataFile'], dtype=header['dtype'], mode='r',
+                              offset=header['dataOffset'], shape=tuple(reversed(header['dimensions'])) )
+        return array, header['ijkToRAS']
+
+    def getNrrdHeader(self, shape, dtype, ijkToRAS, encoding='raw'):
+        """Header (bytes, with the blank line ending it) of a little endian NRRD file
+        of (k, j, i) shaped voxels
+        """
+        typeName = self.nrrdTypes[numpy.dtype(dtype).name][0]
+        #NRRD files written in LPS as Slicer does
+        directions  = numpy.array(ijkToRAS)[:3, :3].T * [-1, -1, 1]
+        origin      = numpy.array(ijkToRAS)[:3, 3] * [-1, -1, 1]
+        formatVector = lambda vector: '(' + ','.join(repr(float(value) + 0.0) for value in vector) + ')'
+
+        header = [ 'NRRD0004',
+                   '# Complete NRRD file format specification at:',
+                   '# http://teem.sourceforge.net/nrrd/format.html',
+                   'type: %s' % typeName,
+                   'dimension: 3',
+                   'space: left-posterior-superior',
+                   'sizes: %d %d %d' % tuple(reversed(shape)),
+                   'space directions: ' + ' '.join(formatVector(vector) for vector in directions),
+                   'kinds: domain domain domain',
+                   'endian: little',
+                   'encoding: %s' % encoding,
+                   'space origin: ' + formatVector(origin) ]
+        return ('\n'.join(header) + '\n\n').encode('ascii')
+
+    nrrdEncodings = ['raw', 'gzip']
+
+    def writeNrrd(self, path, array, ijkToRAS, slabMemoryMB=256, progressCallback=None, cancelEvent=None,
+                  encoding='raw', compressionLevel=1, threads=None):
+        """Writes a (k, j, i) ordered array as a NRRD file, slab by slab so that memory
+        mapped inputs are never read at once.
+        encoding 'raw' writes the voxels as they are (fastest, for scratch storage), 'gzip'
+        compresses chunks of slices on threads (zlib releases the GIL) into consecutive gzip
+        members, which NRRD readers decompress as one stream. compressionLevel is the zlib
+        level (1 fastest - 9 smallest), threads defaults to the number of cores.
+        At most slabMemoryMB of uncompressed chunks are in flight
+        """
+        if encoding not in self.nrrdEncodings:
+            raise ValueError("Unsupported NRRD encoding: %s" % encoding)
+        sliceBytes  = max(1, array.shape[1] * array.shape[2] * array.dtype.itemsize)
+        littleEndian = numpy.dtype(array.dtype).newbyteorder('<')
+        readSlab = lambda start, stop: numpy.ascontiguousarray(array[start:stop], dtype=littleEndian).tobytes()
+
+        with open(path, 'wb') as nrrdFile:
+            nrrdFile.write(self.getNrrdHeader(array.shape, array.dtype, ijkToRAS, encoding))
+
+            if encoding == 'raw':
+                slabSlices = max(1, int(slabMemoryMB * 1024 * 1024 // sliceBytes))
+                for start in range(0, array.shape[0], slabSlices):
+                    self.reportProgress(float(start) / array.shape[0], progressCallback, cancelEvent)
+                    nrrdFile.write(readSlab(start, start + slabSlices))
+            else:
+                threads     = threads or multiprocessing.cpu_count()
+                #Two chunks per thread in flight, each large enough to compress efficiently
+                chunkBytes  = min(max(slabMemoryMB * 1024 * 1024 // (2 * threads), 1024 * 1024), 64 * 1024 * 1024)
+                chunkSlices = max(1, int(chunkBytes // sliceBytes))
+                def compressChunk(start):
+                    #wbits 31: zlib stream with gzip header & trailer
+                    compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, 31)
+                    return compressor.compress(readSlab(start, start + chunkSlices)) + compressor.flush()
+
+                pool = ThreadPool(threads)
+                pending = collections.deque()
+                try:
+                    for start in range(0, array.shape[0], chunkSlices):
+                        if len(pending) >= 2 * threads:
+                            nrrdFile.write(pending.popleft().get())
+                            self.reportProgress(float(start - len(pending) * chunkSlices) / array.shape[0],
+                                                progressCallback, cancelEvent)
+                        pending.append(pool.apply_async(compressChunk, (start,)))
+                    while pending:
+                        nrrdFile.write(pending.popleft().get())
+                finally:
+                    pool.terminate()
+                    pool.join()
+        self.reportProgress(1.0, progressCallback, cancelEvent)
+
+    @AlignCrop3DSlicerModuleProfiler.profile('saveVolume')
+    def saveVolume(self, volume, path, encoding='gzip', compressionLevel=1, threads=None):
+        """Writes a (not transformed) scalar volume node as a NRRD file with writeNrrd,
+        compressing on all cores instead of the single threaded default writer
+        """
+        if volume.GetParentTransformNode():
+            raise ValueError("Harden the transform of %s before saving" % volume.GetName())
+        self.writeNrrd(path, slicer.util.arrayFromVolume(volume), self.getVolumeIJKToRAS(volume),
+                       encoding=encoding, compressionLevel=compressionLevel, threads=threads)
+        return path
+
+    def createNrrdArray(self, path, shape, dtype, ijkToRAS):
+        """Creates a raw encoded NRRD file of (k, j, i) shaped voxels & memory maps its voxels
+        for writing, so results can be written slab by slab without holding them in memory
+        """
+        header = self.getNrrdHeader(shape, dtype, ijkToRAS)
+        dtype = numpy.dtype(dtype).newbyteorder('<')
+        with open(path, 'wb') as nrrdFile:
+            nrrdFile.write(header)
+            #sparse file of the final size
+            nrrdFile.truncate(len(header) + dtype.itemsize * int(numpy.prod(shape)))
+        return numpy.memmap(path, dtype=dtype, mode='r+', offset=len(header), shape=tuple(shape))
+
+    def getROIBounds(self, roi):
+        """Returns the RAS bounds [xmin, xmax, ymin, ymax, zmin, zmax] of an ROI node.
+        Bounds are returned unchanged, so background computations can be given the
+        bounds read on the main thread instead of the node
+        """
+        if isinstance(roi, (list, tuple)):
+            return list(roi)
+        center = [0.0, 0.0, 0.0]
+        radius = [0.0, 0.0, 0.0]
+        roi.GetXYZ(center)
+        roi.GetRadiusXYZ(radius)
+        bounds = []
+        for axis in range(3):
+            bounds += [center[axis] - radius[axis], center[axis] + radius[axis]]
+        return bounds
+
+    def computeROIVoxelExtent(self, roiBounds, ijkToRAS, dimensions, tolerance=1e-3):
+        """Voxel extent [[iStart, iStop], [jStart, jStop], [kStart, kStop]] (stop exclusive)
+        of the voxels whose centres are inside the RAS bounds, clipped to the volume
+        """
+        corners = numpy.array([[x, y, z, 1.0] for x in roiBounds[0:2]
+                                              for y in roiBounds[2:4]
+                                              for z in roiBounds[4:6]])
+        cornersIJK  = numpy.linalg.inv(ijkToRAS).dot(corners.T)[:3]
+        start       = numpy.ceil(cornersIJK.min(axis=1) - tolerance).astype(int)
+        stop        = numpy.floor(cornersIJK.max(axis=1) + tolerance).astype(int) + 1
+        start       = numpy.clip(start, 0, dimensions)
+        stop        = numpy.clip(stop, 0, dimensions)
+        if numpy.any(stop <= start):
+            raise ValueError("Region of interest does not overlap the volume")
+        return [[int(start[axis]), int(stop[axis])] for axis in range(3)]
+
+    @AlignCrop3DSlicerModuleProfiler.profile('cropVolumeFromFile')
+    def runCropVolumeFromFile(self, roi, inputPath, outputPath, slabMemoryMB=256,
+                              progressCallback=None, cancelEvent=None, encoding='raw', compressionLevel=1,
+                              outputType='input', rescaleRange=None, castStats=None, threads=None):
+        """Crops an uncompressed NRRD file to the ROI without loading it.
+        Only the slabs covering the ROI are read (memory mapped) & written to outputPath
+        (see writeNrrd for the encodings & threads). Down-casts (see prepareOutputCast) are written into
+        a memory mapped file first, their statistics are added to the castStats dictionary.
+        A failed or cancelled crop leaves no output files
+        """
+        logging.info('Cropping %s from file started' % inputPath)
+
+        array, ijkToRAS = self.openNrrdArray(inputPath)
+        dimensions = list(reversed(array.shape))
+        (i0, i1), (j0, j1), (k0, k1) = self.computeROIVoxelExtent(self.getROIBounds(roi), ijkToRAS, dimensions)
+
+        croppedIJKToRAS = numpy.array(ijkToRAS)
+        croppedIJKToRAS[:3, 3] = ijkToRAS.dot([i0, j0, k0, 1.0])[:3]
+        sourceArray = array[k0:k1, j0:j1, i0:i1]
+        outputDtype, rescale, stats = self.prepareOutputCast(array.dtype, outputType, rescaleRange, sourceArray)
+        rawPath = outputPath if encoding == 'raw' else outputPath + '.raw.nrrd'
+        try:
+            if rescale is None:
+                self.writeNrrd(outputPath, sourceArray, croppedIJKToRAS, slabMemoryMB,
+                               progressCallback=progressCallback, cancelEvent=cancelEvent,
+                               encoding=encoding, compressionLevel=compressionLevel, threads=threads)
+            else:
+                outputArray = self.createNrrdArray(rawPath, sourceArray.shape, outputDtype, croppedIJKToRAS)
+                self.castArray(sourceArray, outputArray, rescale, stats, slabVoxels=slabMemoryMB * 1024 * 1024 // 16,
+                               progressCallback=progressCallback, cancelEvent=cancelEvent)
+                self.finishNrrdOutput(outputArray, rawPath, outputPath, croppedIJKToRAS, slabMemoryMB, cancelEvent,
+                                      encoding, compressionLevel, threads)
+        except Exception:
+            self.removeNrrdOutput(rawPath, outputPath)
+            raise
+        if castStats is not None:
+            castStats.update(self.finishCastStats(stats, sourceArray.size))
+        del sourceArray, array
+
+        logging.info('Cropping from file completed')
+        return outputPath
+
+    def getVolumeIJKToRAS(self, volume):
+        """Returns the IJK to RAS matrix of a volume node as a 4x4 numpy matrix
+        """
+        vtkMatrix = vtk.vtkMatrix4x4()
+        volume.GetIJKToRASMatrix(vtkMatrix)
+        return numpy.array([[vtkMatrix.GetElement(row, col) for col in range(4)] for row in range(4)])
+
+    def createVolumeNode(self, name, shape, dtype, ijkToRAS, className='vtkMRMLScalarVolumeNode'):
+        """Adds a scalar (or label map, see className) volume node with uninitialized (k, j, i)
+        shaped voxels to the scene. Returns the node & a numpy view of its voxels, so results can be written in place
+        (call imageData.Modified() once written)
+        """
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(shape[2], shape[1], shape[0])
+        imageData.AllocateScalars(numpy_support.get_vtk_array_type(numpy.dtype(dtype)), 1)
+        voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+
+        vtkMatrix = vtk.vtkMatrix4x4()
+        for row in range(4):
+            for col in range(4):
+                vtkMatrix.SetElement(row, col, ijkToRAS[row][col])
+
+        volume = getattr(slicer, className)()
+        volume.SetName(slicer.mrmlScene.GenerateUniqueName(name))
+        volume.SetIJKToRASMatrix(vtkMatrix)
+        volume.SetAndObserveImageData(imageData)
+        slicer.mrmlScene.AddNode(volume)
+        volume.CreateDefaultDisplayNodes()
+
+        return volume, voxels
+
+    def resampleArray(self, inputArray, outputToInputIJK, outputShape, interpolation='linear',
+                      outputArray=None, defaultValue=0, slabVoxels=4*1024*1024,
+                      progressCallback=None, cancelEvent=None, rescale=None, castStats=None):
+        """Resamples a (k, j, i) ordered array on an output grid.
+        outputToInputIJK maps output (i, j, k) voxel indices to input voxel indices (4x4 affine).
+        interpolation is 'nearest' or 'linear'. The output is processed in slabs of about
+        slabVoxels voxels and, for each slab, only the input region the slab maps into is
+        read, so inputArray may be a memory mapped file.
+        Progress is reported & cancelEvent checked between slabs (see reportProgress).
+        rescale (scale, offset) maps the interpolated values to the output values, with
+        integer outputs clipped to their type & the clipped voxels counted into castStats
+        (see prepareOutputCast).
+        Returns outputArray (allocated with the input type when not given)
+        """
+        return self.resampleArrays([inputArray], outputToInputIJK, outputShape, [interpolation], [outputArray],
+                                   [defaultValue], slabVoxels, progressCallback, cancelEvent, [rescale], [castStats])[0]
+
+    def resampleArrays(self, inputArrays, outputToInputIJK, outputShape, interpolations, outputArrays=None,
+                       defaultValues=None, slabVoxels=4*1024*1024, progressCallback=None, cancelEvent=None,
+                       rescales=None, castStats=None):
+        """Resamples (k, j, i) ordered arrays of the same shape (a volume & its label maps) on one
+        output grid in a single pass, with the arguments of resampleArray given per array.
+        The input region, the voxel coordinates and the nearest indices or linear weights of
+        every slab are computed once and shared by all arrays.
+        Returns the output arrays
+        """
+        count               = len(inputArrays)
+        outputToInputIJK    = numpy.asarray(outputToInputIJK, dtype=numpy.float64)
+        outputShape         = tuple(int(size) for size in outputShape)
+        outputArrays        = list(outputArrays) if outputArrays is not None else [None] * count
+        defaultValues       = list(defaultValues) if defaultValues is not None else [0] * count
+        rescales            = list(rescales) if rescales is not None else [None] * count
+        castStats           = list(castStats) if castStats is not None else [None] * count
+        for interpolation in interpolations:
+            if interpolation not in self.resampleInterpolations:
+                raise ValueError("Unsupported interpolation: %s" % interpolation)
+        if any(inputArray.shape != inputArrays[0].shape for inputArray in inputArrays):
+            raise ValueError("Arrays resampled together must have the same shape")
+        inputShape = numpy.array(inputArrays[0].shape[::-1])   # i, j, k
+
+        typeInfos = []
+        for index in range(count):
+            if outputArrays[index] is None:
+                outputArrays[index] = numpy.empty(outputShape, dtype=inputArrays[index].dtype)
+            isInteger = numpy.issubdtype(outputArrays[index].dtype, numpy.integer)
+            typeInfos.append(numpy.iinfo(outputArrays[index].dtype) if isInteger else None)
+            #Voxels outside of the input keep the (rescaled) default intensity
+            if rescales[index] is not None:
+                defaultValues[index] = defaultValues[index] * rescales[index][0] + rescales[index][1]
+                if isInteger:
+                    defaultValues[index] = numpy.clip(numpy.rint(defaultValues[index]), typeInfos[index].min,
+                                                      typeInfos[index].max)
+
+        sliceVoxels = outputShape[1] * outputShape[2]
+        slabSlices  = max(1, int(slabVoxels // max(1, sliceVoxels)))
+        i = numpy.arange(outputShape[2], dtype=numpy.float64)
+        j = numpy.arange(outputShape[1], dtype=numpy.float64)
+
+        for slabStart in range(0, outputShape[0], slabSlices):
+            self.reportProgress(float(slabStart) / outputShape[0], progressCallback, cancelEvent)
+            slabStop = min(slabStart + slabSlices, outputShape[0])
+            k = numpy.arange(slabStart, slabStop, dtype=numpy.float64)
+
+            regionStart, regionStop = self.computeResampleInputRegion(outputToInputIJK, outputShape, inputShape,
+                                                                      slabStart, slabStop)
+            slabs = [outputArray[slabStart:slabStop] for outputArray in outputArrays]
+            if numpy.any(regionStop <= regionStart):
+                for slab, defaultValue in zip(slabs, defaultValues):
+                    slab[...] = defaultValue
+                continue
+            regionShape = regionStop - regionStart
+            slabShape   = slabs[0].shape
+
+            #Input voxel coordinates of the slab, relative to the region
+            coords = []
+            for axis in range(3):
+                row = outputToInputIJK[axis]
+                coords.append( row[0] * i[numpy.newaxis, numpy.newaxis, :] +
+                               row[1] * j[numpy.newaxis, :, numpy.newaxis] +
+                               row[2] * k[:, numpy.newaxis, numpy.newaxis] +
+                               (row[3] - regionStart[axis]) )
+
+            #Points outside the input volume get the default value
+            inside = numpy.ones(slabShape, dtype=bool)
+            for axis in range(3):
+                inside &= (coords[axis] >= -regionStart[axis] - 0.5)
+                inside &= (coords[axis] <= inputShape[axis] - regionStart[axis] - 0.5)
+
+            #Shared by all arrays: flat region indices of the nearest voxels, lower corners & weights
+            if 'nearest' in interpolations:
+                nearestIndex = numpy.zeros(slabShape, dtype=numpy.intp)
+                for axis in (2, 1, 0):
+                    nearest = numpy.clip(numpy.floor(coords[axis] + 0.5), 0, regionShape[axis] - 1).astype(numpy.intp)
+                    nearestIndex = nearestIndex * regionShape[axis] + nearest
+            if 'linear' in interpolations:
+                lower, weight = [], []
+                for axis in range(3):
+                    floor = numpy.clip(numpy.floor(coords[axis]), 0, max(regionShape[axis] - 2, 0))
+                    lower.append(floor.astype(numpy.intp))
+                    weight.append(numpy.clip(coords[axis] - floor, 0.0, 1.0))
+
+            for index in range(count):
+                inputArray, interpolation = inputArrays[index], interpolations[index]
+                region = numpy.ascontiguousarray(inputArray[regionStart[2]:regionStop[2],
+                                                            regionStart[1]:regionStop[1],
+                                                            regionStart[0]:regionStop[0]]).ravel()
+                if interpolation == 'nearest':
+                    values = region[nearestIndex]
+                else:
+                    values = numpy.zeros(slabShape)
+                    for ck in (0, 1):
+                        indexK = numpy.minimum(lower[2] + ck, regionShape[2] - 1)
+                        weightK = weight[2] if ck else 1.0 - weight[2]
+                        for cj in (0, 1):
+                            indexKJ = indexK * regionShape[1] + numpy.minimum(lower[1] + cj, regionShape[1] - 1)
+                            weightKJ = weightK * (weight[1] if cj else 1.0 - weight[1])
+                            for ci in (0, 1):
+                                flatIndex = indexKJ * regionShape[0] + numpy.minimum(lower[0] + ci, regionShape[0] - 1)
+                                values += (weightKJ * (weight[0] if ci else 1.0 - weight[0])) * region[flatIndex]
+
+                rescale, typeInfo = rescales[index], typeInfos[index]
+                if rescale is not None:
+                    values = values * rescale[0] + rescale[1]
+                if typeInfo is not None and (interpolation == 'linear' or rescale is not None):
+                    values = numpy.rint(values)
+                    if castStats[index] is not None:
+                        castStats[index]['clippedLow']  += int(numpy.count_nonzero((values < typeInfo.min) & inside))
+                        castStats[index]['clippedHigh'] += int(numpy.count_nonzero((values > typeInfo.max) & inside))
+                    values = numpy.clip(values, typeInfo.min, typeInfo.max)
+
+                slabs[index][...] = numpy.where(inside, values, defaultValues[index])
+
+        self.reportProgress(1.0, progressCallback, cancelEvent)
+        return outputArrays
+
+    def computeResampleInputRegion(self, outputToInputIJK, outputShape, inputShape, slabStart=0, slabStop=None):
+        """Input voxel region [start, stop) (i, j, k) read to resample output slices
+        slabStart - slabStop (the whole output by default), clipped to the (i, j, k) input shape
+        """
+        if slabStop is None:
+            slabStop = outputShape[0]
+        #Affine, so the corners of the slab bound the region
+        corners = numpy.array([[ci, cj, ck, 1.0] for ci in (0, outputShape[2] - 1)
+                                                 for cj in (0, outputShape[1] - 1)
+                                                 for ck in (slabStart, slabStop - 1)])
+        cornersIJK  = numpy.asarray(outputToInputIJK).dot(corners.T)[:3]
+        regionStart = numpy.clip(numpy.floor(cornersIJK.min(axis=1)).astype(int) - 1, 0, inputShape)
+        regionStop  = numpy.clip(numpy.floor(cornersIJK.max(axis=1)).astype(int) + 2, 0, inputShape)
+        return regionStart, regionStop
+
+    #Output scalar types of the crops: the input type or a rescaled down-cast
+    outputTypes = ['input', 'uint8', 'int16']
+
+    def computeArrayRange(self, array, slabVoxels=4*1024*1024):
+        """Minimum & maximum of an array, slab by slab (memory mapped arrays are read once)
+        """
+        if not array.size:
+            return 0.0, 0.0
+        sliceVoxels = max(1, int(numpy.prod(array.shape[1:])))
+        slabSlices  = max(1, int(slabVoxels // sliceVoxels))
+        low, high = None, None
+        for start in range(0, array.shape[0], slabSlices):
+            slab = array[start:start + slabSlices]
+            low     = slab.min() if low is None else min(low, slab.min())
+            high    = slab.max() if high is None else max(high, slab.max())
+        return float(low), float(high)
+
+    def prepareOutputCast(self, inputDtype, outputType='input', rescaleRange=None, rangeArray=None):
+        """Output dtype, rescale (scale, offset) & statistics of an output type.
+        'input' keeps the input type without rescaling, as do output types holding every
+        value of the input type (e.g. int16 for int16 or uint8 input, so HU are kept) unless
+        rescaleRange is given. Down-casts map rescaleRange (input intensities, the range of
+        rangeArray when not given) linearly onto the full range of the output type; values
+        outside of it are clipped & counted in the statistics. A down-cast without either
+        range raises ValueError
+        """
+        if outputType not in self.outputTypes:
+            raise ValueError("Unsupported output type: %s" % outputType)
+        castStats = { 'outputType' : outputType, 'clippedLow' : 0, 'clippedHigh' : 0, 'voxels' : 0 }
+        if outputType == 'input':
+            castStats['outputType'] = numpy.dtype(inputDtype).name
+            return numpy.dtype(inputDtype), None, castStats
+
+        outputDtype = numpy.dtype(outputType)
+        if rescaleRange is None and numpy.can_cast(inputDtype, outputDtype, 'safe'):
+            return outputDtype, None, castStats
+        if rescaleRange is None:
+            if rangeArray is None:
+                raise ValueError("Casting %s to %s needs a rescale range" % (numpy.dtype(inputDtype).name, outputType))
+            rescaleRange = self.computeArrayRange(rangeArray)
+        low, high = float(rescaleRange[0]), float(rescaleRange[1])
+        typeInfo = numpy.iinfo(outputDtype)
+        scale   = (typeInfo.max - typeInfo.min) / (high - low) if high > low else 1.0
+        offset  = typeInfo.min - low * scale
+        castStats.update({ 'inputRange' : [low, high], 'scale' : scale, 'offset' : offset })
+        return outputDtype, (scale, offset), castStats
+
+    def finishCastStats(self, castStats, voxels):
+        castStats['voxels'] = int(voxels)
+        clipped = castStats['clippedLow'] + castStats['clippedHigh']
+        castStats['clippedFraction'] = float(clipped) / voxels if voxels else 0.0
+        if clipped:
+            logging.warning("%d voxels (%.2f%%) clipped casting to %s" % (clipped, 100.0 * castStats['clippedFraction'],
+                                                                          castStats['outputType']))
+        return castStats
+
+    def castArray(self, inputArray, outputArray, rescale=None, castStats=None, slabVoxels=4*1024*1024,
+                  progressCallback=None, cancelEvent=None):
+        """Copies inputArray into outputArray slab by slab, applying rescale (scale, offset)
+        and rounding & clipping to an integer output type (clipped voxels counted into
+        castStats), so no full size intermediate is allocated
+        """
+        sliceVoxels = max(1, int(numpy.prod(inputArray.shape[1:])))
+        slabSlices  = max(1, int(slabVoxels // sliceVoxels))
+        isInteger   = numpy.issubdtype(outputArray.dtype, numpy.integer)
+        for start in range(0, inputArray.shape[0], slabSlices):
+            self.reportProgress(float(start) / inputArray.shape[0], progressCallback, cancelEvent)
+            slab = inputArray[start:start + slabSlices]
+            if rescale is not None:
+                slab = slab * rescale[0] + rescale[1]
+                if isInteger:
+                    typeInfo = numpy.iinfo(outputArray.dtype)
+                    slab = numpy.rint(slab)
+                    if castStats is not None:
+                        castStats['clippedLow']  += int(numpy.count_nonzero(slab < typeInfo.min))
+                        castStats['clippedHigh'] += int(numpy.count_nonzero(slab > typeInfo.max))
+                    slab = numpy.clip(slab, typeInfo.min, typeInfo.max)
+            outputArray[start:start + slabSlices] = slab
+        self.reportProgress(1.0, progressCallback, cancelEvent)
+        return outputArray
+
+    def castVolume(self, volume, outputType='input', rescaleRange=None):
+        """Casts the voxels of a volume node to an output type (see prepareOutputCast) in place,
+        slab by slab. The statistics are attached to the node & returned
+        """
+        voxels = slicer.util.arrayFromVolume(volume)
+        outputDtype, rescale, castStats = self.prepareOutputCast(voxels.dtype, outputType, rescaleRange, voxels)
+        if outputDtype != voxels.dtype:
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+            imageData.AllocateScalars(numpy_support.get_vtk_array_type(outputDtype), 1)
+            outputArray = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(voxels.shape)
+            self.castArray(voxels, outputArray, rescale, castStats)
+            volume.SetAndObserveImageData(imageData)
+        self.setCastStats(volume, self.finishCastStats(castStats, voxels.size))
+        return castStats
+
+    def setCastStats(self, volume, castStats):
+        volume.SetAttribute('AlignCrop3DSlicerModule.CastStats', json.dumps(castStats))
+
+    def getCastStats(self, volume):
+        """Output type statistics attached to a cropped volume (None if missing)
+        """
+        castStats = volume.GetAttribute('AlignCrop3DSlicerModule.CastStats')
+        return json.loads(castStats) if castStats else None
+
+    def computeROIOutputGeometry(self, roiBounds, spacing):
+        """Output grid of a crop to RAS bounds: voxels of the given spacing, axis aligned
+        with the ROI. Returns the (k, j, i) shape and the IJK to RAS matrix
+        """
+        spacing = numpy.asarray(spacing, dtype=float)
+        size    = numpy.array([roiBounds[1] - roiBounds[0], roiBounds[3] - roiBounds[2], roiBounds[5] - roiBounds[4]])
+        dimensions = numpy.maximum(numpy.round(size / spacing).astype(int), 1)
+
+        ijkToRAS = numpy.identity(4)
+        ijkToRAS[:3, :3] = numpy.diag(spacing)
+        #Centre the voxel grid in the ROI
+        ijkToRAS[:3, 3] = numpy.array(roiBounds[0::2]) + (size - (dimensions - 1) * spacing) / 2.0
+        return tuple(int(size) for size in dimensions[::-1]), ijkToRAS
+
+    def finishNrrdOutput(self, outputArray, rawPath, outputPath, ijkToRAS, slabMemoryMB=256, cancelEvent=None,
+                         encoding='raw', compressionLevel=1, threads=None):
+        """Flushes a memory mapped output (see createNrrdArray) written to rawPath. Encoded outputs
+        are then written to outputPath with writeNrrd (on threads) and the raw file removed
+        """
+        outputArray.flush()
+        if encoding != 'raw':
+            self.writeNrrd(outputPath, outputArray, ijkToRAS, slabMemoryMB, cancelEvent=cancelEvent,
+                           encoding=encoding, compressionLevel=compressionLevel, threads=threads)
+        del outputArray
+        if rawPath != outputPath:
+            os.remove(rawPath)
+
+    def removeNrrdOutput(self, rawPath, outputPath):
+        """Removes the raw intermediate & the partial output of a failed or cancelled file output
+        """
+        for path in set([rawPath, outputPath]):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def getTransformToWorldMatrix(self, transform):
+        """Transform to world of a linear transform node as a 4x4 numpy matrix (identity for None)
+        """
+        if transform is None:
+            return numpy.identity(4)
+        if not transform.IsTransformToWorldLinear():
+            raise ValueError("Fused crop requires a linear transform")
+        vtkMatrix = vtk.vtkMatrix4x4()
+        transform.GetMatrixTransformToWorld(vtkMatrix)
+        return numpy.array([[vtkMatrix.GetElement(row, col) for col in range(4)] for row in range(4)])
+
+    #Bytes per output voxel of the slab arrays resampleArrays holds at once (float64 & intp items of 8 bytes):
+    #input coordinates, inside mask, nearest indices, linear lower corners & weights, the values and the
+    #temporaries of the trilinear sum (corner indices & weights on 2 axes, the flat index with its 3
+    #intermediates, corner weight & complement, gathered & weighted corner values)
+    resampleSlabBytes = { 'coords'      : 3 * 8,
+                          'inside'      : 1,
+                          'nearest'     : 8,
+                          'lower'       : 3 * 8,
+                          'weight'      : 3 * 8,
+                          'values'      : 8,
+                          'temporaries' : 11 * 8 }
+
+    def computeResampleSlabVoxels(self, memoryBudgetMB, outputToInputIJK, outputShape, itemSize):
+        """Output voxels per slab of resampleArray keeping its working memory within the budget:
+        the slab arrays (see resampleSlabBytes) plus the copy of the input region read for the
+        slab, the bounding box of the slab mapped into the input. At least one slice
+        """
+        budget = memoryBudgetMB * 1024 * 1024
+        sliceVoxels = int(outputShape[1]) * int(outputShape[2])
+        bytesPerVoxel = sum(self.resampleSlabBytes.values()) + itemSize
+        outputToInput = numpy.asarray(outputToInputIJK, dtype=float)[:3, :3]
+
+        def slabBytes(slabSlices):
+            #region of computeResampleInputRegion before clipping to the input: corner range + 3 voxels per axis
+            corners = numpy.array([[ci, cj, ck] for ci in (0, outputShape[2] - 1) for cj in (0, outputShape[1] - 1)
+                                                for ck in (0, slabSlices - 1)], dtype=float)
+            cornersIJK = outputToInput.dot(corners.T)
+            regionVoxels = numpy.prod(numpy.ceil(cornersIJK.max(axis=1) - cornersIJK.min(axis=1)) + 3)
+            return slabSlices * sliceVoxels * bytesPerVoxel + regionVoxels * itemSize
+
+        low, high = 1, max(1, int(outputShape[0]))
+        while low < high:
+            middle = (low + high + 1) // 2
+            if slabBytes(middle) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return low * sliceVoxels
+
+    @AlignCrop3DSlicerModuleProfiler.profile('alignCropVolumeFromFile')
+    def runAlignCropVolumeFromFile(self, roi, inputPath, outputPath, transformToWorld=None, interpolation='linear',
+                                   memoryBudgetMB=1024, progressCallback=None, cancelEvent=None,
+                                   encoding='raw', compressionLevel=1, outputType='input', rescaleRange=None,
+                                   castStats=None, spacing=None, threads=None):
+        """Out-of-core fused harden & crop of an uncompressed NRRD file too large for memory.
+        The output is resampled slab by slab: each slab reads only the input region it maps
+        into (memory mapped) and is written straight into the memory mapped output file,
+        with the slab size chosen to keep the working memory within memoryBudgetMB.
+        transformToWorld is the 4x4 matrix of the (not hardened) transform of the input.
+        Compressed outputs are resampled into a raw file next to outputPath first, then
+        compressed by writeNrrd. outputType & rescaleRange select the output scalar type
+        (see prepareOutputCast), its statistics are added to the castStats dictionary.
+        The output has the input spacing unless a spacing is given (see computeOutputSpacing).
+        threads are the compression threads of writeNrrd. A failed or cancelled crop leaves
+        no output files. Returns outputPath
+        """
+        logging.info('Fused transform & crop of %s started' % inputPath)
+
+        inputArray, ijkToRAS = self.openNrrdArray(inputPath)
+        volumeToRAS = numpy.identity(4) if transformToWorld is None else numpy.asarray(transformToWorld, dtype=float)
+        inputSpacing = numpy.linalg.norm(ijkToRAS[:3, :3], axis=0)
+
+        outputShape, outputIJKToRAS = self.computeROIOutputGeometry(self.getROIBounds(roi),
+                                                                    self.computeOutputSpacing(inputSpacing, spacing))
+        outputToInputIJK = numpy.linalg.inv(volumeToRAS.dot(ijkToRAS)).dot(outputIJKToRAS)
+        regionStart, regionStop = self.computeResampleInputRegion(outputToInputIJK, outputShape, inputArray.shape[::-1])
+        rangeArray = inputArray[regionStart[2]:regionStop[2], regionStart[1]:regionStop[1], regionStart[0]:regionStop[0]]
+        outputDtype, rescale, stats = self.prepareOutputCast(inputArray.dtype, outputType, rescaleRange, rangeArray)
+        rawPath = outputPath if encoding == 'raw' else outputPath + '.raw.nrrd'
+        outputArray = self.createNrrdArray(rawPath, outputShape, outputDtype, outputIJKToRAS)
+
+        def onSlab(fraction):
+            #hand written slabs to the file system, keeping dirty pages bounded
+            outputArray.flush()
+            if progressCallback is not None:
+                progressCallback(fraction)
+        try:
+            self.resampleArray(inputArray, outputToInputIJK, outputShape, interpolation=interpolation,
+                               outputArray=outputArray, progressCallback=onSlab, cancelEvent=cancelEvent,
+                               slabVoxels=self.computeResampleSlabVoxels(memoryBudgetMB, outputToInputIJK, outputShape,
+                                                                                        inputArray.itemsize),
+                               rescale=rescale, castStats=stats)
+            self.finishNrrdOutput(outputArray, rawPath, outputPath, outputIJKToRAS, memoryBudgetMB, cancelEvent,
+                                  encoding, compressionLevel, threads)
+        except Exception:
+            del outputArray
+            self.removeNrrdOutput(rawPath, outputPath)
+            raise
+        if castStats is not None:
+            castStats.update(self.finishCastStats(stats, int(numpy.prod(outputShape))))
+        del rangeArray, inputArray
+
+        logging.info('Fused transform & crop from file completed')
+        return outputPath
+
+    def prepareAlignCropVolume(self, roi, volume, transform=None, outputType='input', rescaleRange=None, spacing=None):
+        """Geometry of a fused harden & crop, with the input spacing unless a spacing is given
+        (see computeOutputSpacing). Adds the (empty) output volume to the scene.
+        Returns the output volume, its voxel array, the input voxel array, the output
+        to input IJK matrix and the rescale & statistics of the output type (the default
+        rescale range is the range of the input region the ROI maps into)
+        """
+        if transform is None:
+            transform = volume.GetParentTransformNode()
+        volumeToRAS = self.getTransformToWorldMatrix(transform)
+
+        outputSpacing = self.computeOutputSpacing(volume.GetSpacing(), spacing)
+        outputShape, outputIJKToRAS = self.computeROIOutputGeometry(self.getROIBounds(roi), outputSpacing)
+        inputRASToIJK = numpy.linalg.inv(volumeToRAS.dot(self.getVolumeIJKToRAS(volume)))
+
+        outputToInputIJK = inputRASToIJK.dot(outputIJKToRAS)
+
+        inputArray = slicer.util.arrayFromVolume(volume)
+        regionStart, regionStop = self.computeResampleInputRegion(outputToInputIJK, outputShape, inputArray.shape[::-1])
+        rangeArray = inputArray[regionStart[2]:regionStop[2], regionStart[1]:regionStop[1], regionStart[0]:regionStop[0]]
+        outputDtype, rescale, castStats = self.prepareOutputCast(inputArray.dtype, outputType, rescaleRange, rangeArray)
+        croppedVolume, croppedArray = self.createVolumeNode(volume.GetName() + '-cropped', outputShape,
+                                                            outputDtype, outputIJKToRAS)
+        return croppedVolume, croppedArray, inputArray, outputToInputIJK, rescale, castStats
+
+    @AlignCrop3DSlicerModuleProfiler.profile('alignCropVolume')
+    def runAlignCropVolume(self, roi, volume, transform=None, interpolation='linear', outputType='input', rescaleRange=None,
+                           spacing=None):
+        """Fused harden & crop: resamples only the ROI voxels of the transformed volume,
+        straight from its original voxels, in a single pass.
+        transform defaults to the parent transform of the volume and must be linear.
+        The output has the input spacing unless a spacing is given (see computeOutputSpacing).
+        outputType & rescaleRange select the output scalar type (see prepareOutputCast).
+        Returns the cropped volume node
+        """
+        logging.info('Fused transform & crop processing started')
+
+        croppedVolume, croppedArray, inputArray, outputToInputIJK, rescale, castStats = self.prepareAlignCropVolume(
+            roi, volume, transform, outputType, rescaleRange, spacing)
+        self.resampleArray(inputArray, outputToInputIJK, croppedArray.shape, interpolation=interpolation,
+                           outputArray=croppedArray, rescale=rescale, castStats=castStats)
+        croppedVolume.GetImageData().Modified()
+        self.setCastStats(croppedVolume, self.finishCastStats(castStats, croppedArray.size))
+
+        logging.info('Fused transform & crop processing completed')
+        return croppedVolume
+
+    @AlignCrop3DSlicerModuleProfiler.profile('cropVolumeGroup')
+    def runCropVolumeGroup(self, roi, volume, associatedNodes=(), transform=None, interpolation='linear',
+                           outputType='input', rescaleRange=None, spacing=None, progressCallback=None, cancelEvent=None):
+        """Fused harden & crop (see runAlignCropVolume) of a volume together with the label maps,
+        segmentations & further volumes associated with it (e.g. cochlear duct, facial nerve &
+        ossicle labels), all onto exactly the same output grid: the ROI & output grid are derived
+        once, every node is resampled through its own (linear) transform to world (transform
+        instead of the parent transform for volume), so a hardened volume & labels still under
+        the alignment transform are cropped in place. Nodes sharing a voxel grid in world
+        space are resampled together in one pass (see resampleArrays).
+        Label maps are resampled nearest neighbour in their own type, segmentations through a
+        label map export (overlapping segments keep the last one), further volumes with
+        interpolation in their own type and volume with interpolation & outputType.
+        The associated crops are referenced from the cropped volume (see getAssociatedCrops).
+        Returns the cropped volume & the list of the cropped associated nodes
+        """
+        if interpolation not in self.resampleInterpolations:
+            raise ValueError("Cropping associated nodes needs %s interpolation" % ' or '.join(self.resampleInterpolations))
+        logging.info('Group transform & crop processing started')
+
+        croppedVolume, croppedArray, inputArray, outputToInputIJK, rescale, castStats = self.prepareAlignCropVolume(
+            roi, volume, transform, outputType, rescaleRange, spacing)
+        outputIJKToRAS  = self.getVolumeIJKToRAS(croppedVolume)
+        volumeToRAS     = self.getTransformToWorldMatrix(transform if transform is not None else volume.GetParentTransformNode())
+
+        #Resampled voxels, grouped by input voxel grid (IJK to world)
+        grids = collections.OrderedDict()
+        def addItem(ijkToWorld, voxels, outputArray, itemInterpolation, itemRescale=None, itemCastStats=None):
+            gridKey = (voxels.shape, tuple(numpy.round(ijkToWorld, 6).flat))
+            grids.setdefault(gridKey, []).append({ 'ijkToWorld' : ijkToWorld, 'voxels' : voxels, 'outputArray' : outputArray,
+                                                   'interpolation' : itemInterpolation, 'rescale' : itemRescale,
+                                                   'castStats' : itemCastStats })
+        addItem(volumeToRAS.dot(self.getVolumeIJKToRAS(volume)), inputArray, croppedArray, interpolation, rescale, castStats)
+
+        croppedNodes, exportedLabelmaps = [], []
+        try:
+            for node in associatedNodes:
+                if node.IsA('vtkMRMLSegmentationNode'):
+                    labelmap, segments = self.exportSegmentationLabelmap(node)
+                    exportedLabelmaps.append(labelmap)
+                    source, itemInterpolation = labelmap, 'nearest'
+                elif node.IsA('vtkMRMLVolumeNode'):
+                    segments = None
+                    source = node
+                    itemInterpolation = 'nearest' if node.IsA('vtkMRMLLabelMapVolumeNode') else interpolation
+                else:
+                    raise ValueError("%s is neither a volume nor a segmentation" % node.GetName())
+                voxels = slicer.util.arrayFromVolume(source)
+                outputNode, outputArray = self.createVolumeNode(node.GetName() + '-cropped', croppedArray.shape, voxels.dtype,
+                                                                outputIJKToRAS, 'vtkMRMLLabelMapVolumeNode'
+                                                                if itemInterpolation == 'nearest' else 'vtkMRMLScalarVolumeNode')
+                croppedNodes.append((outputNode, segments))
+                #the exported label map is not under the transform of its segmentation
+                nodeToRAS = self.getTransformToWorldMatrix(node.GetParentTransformNode())
+                addItem(nodeToRAS.dot(self.getVolumeIJKToRAS(source)), voxels, outputArray, itemInterpolation)
+
+            #One pass per voxel grid, sharing the output to input indices of its nodes
+            for gridIndex, items in enumerate(grids.values()):
+                gridOutputToInputIJK = numpy.linalg.inv(items[0]['ijkToWorld']).dot(outputIJKToRAS)
+                onProgress = None
+                if progressCallback is not None:
+                    onProgress = lambda fraction, gridIndex=gridIndex: progressCallback((gridIndex + fraction) / len(grids))
+                self.resampleArrays([item['voxels'] for item in items], gridOutputToInputIJK, croppedArray.shape,
+                                    [item['interpolation'] for item in items], [item['outputArray'] for item in items],
+                                    None, progressCallback=onProgress, cancelEvent=cancelEvent,
+                                    rescales=[item['rescale'] for item in items],
+                                    castStats=[item['castStats'] for item in items])
+        finally:
+            for labelmap in exportedLabelmaps:
+                slicer.mrmlScene.RemoveNode(labelmap)
+
+        croppedVolume.GetImageData().Modified()
+        self.setCastStats(croppedVolume, self.finishCastStats(castStats, croppedArray.size))
+        outputNodes = []
+        for outputNode, segments in croppedNodes:
+            outputNode.GetImageData().Modified()
+            if segments is not None:
+                outputNode = self.importSegmentationLabelmap(outputNode, segments)
+            croppedVolume.AddNodeReferenceID('AlignCrop3DSlicerModule.Associated', outputNode.GetID())
+            outputNodes.append(outputNode)
+
+        logging.info('Group transform & crop processing completed')
+        return croppedVolume, outputNodes
+
+    def getAssociatedCrops(self, croppedVolume):
+        """Cropped associated nodes of a volume cropped by runCropVolumeGroup
+        """
+        role = 'AlignCrop3DSlicerModule.Associated'
+        return [croppedVolume.GetNthNodeReference(role, index)
+                for index in range(croppedVolume.GetNumberOfNodeReferences(role))]
+
+    def exportSegmentationLabelmap(self, segmentation):
+        """Exports all segments of a segmentation into a temporary label map (segment n has
+        label n + 1). Returns the label map & the (name, color) of the segments
+        """
+        segmentIDs = vtk.vtkStringArray()
+        segmentation.GetSegmentation().GetSegmentIDs(segmentIDs)
+        segments = []
+        for index in range(segmentIDs.GetNumberOfValues()):
+            segment = segmentation.GetSegmentation().GetSegment(segmentIDs.GetValue(index))
+            segments.append((segment.GetName(), list(segment.GetColor())))
+        labelmap = slicer.vtkMRMLLabelMapVolumeNode()
+        labelmap.SetName(slicer.mrmlScene.GenerateUniqueName(segmentation.GetName() + '-labels'))
+        slicer.mrmlScene.AddNode(labelmap)
+        if not slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentation, segmentIDs, labelmap):
+            slicer.mrmlScene.RemoveNode(labelmap)
+            raise RuntimeError("Failed to export the segments of %s" % segmentation.GetName())
+        return labelmap, segments
+
+    def importSegmentationLabelmap(self, labelmap, segments):
+        """Segmentation node with the segments (name, color) of the labels 1 - N of a label map,
+        which is removed from the scene
+        """
+        colorTable = slicer.vtkMRMLColorTableNode()
+        colorTable.SetTypeToUser()
+        colorTable.SetNumberOfColors(len(segments) + 1)
+        colorTable.SetColor(0, 'Background', 0.0, 0.0, 0.0, 0.0)
+        for label, (name, color) in enumerate(segments, 1):
+            colorTable.SetColor(label, name, color[0], color[1], color[2], 1.0)
+        slicer.mrmlScene.AddNode(colorTable)
+        labelmap.GetDisplayNode().SetAndObserveColorNodeID(colorTable.GetID())
+
+        segmentation = slicer.vtkMRMLSegmentationNode()
+        segmentation.SetName(labelmap.GetName())
+        slicer.mrmlScene.AddNode(segmentation)
+        segmentation.CreateDefaultDisplayNodes()
+        imported = slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap, segmentation)
+        slicer.mrmlScene.RemoveNode(labelmap)
+        slicer.mrmlScene.RemoveNode(colorTable)
+        if not imported:
+            slicer.mrmlScene.RemoveNode(segmentation)
+            raise RuntimeError("Failed to import the cropped segments of %s" % segmentation.GetName())
+        return segmentation
+
+    def startCropVolume(self, roi, volume, interpolation='linear', outputType='input', rescaleRange=None, spacing=None):
+        """Main thread half of a background crop. Adds the (empty) output volume to the
+        scene and returns it with compute(progressCallback, cancelEvent), which fills the
+        voxels without accessing the scene, so it can run in a worker thread.
+        Call croppedVolume.GetImageData().Modified() once compute returned, compute returns
+        the output type statistics (see prepareOutputCast).
+        Like runCropVolume, only voxel aligned ROIs of untransformed volumes are sliced out of the
+        voxels; transformed volumes, crops to a new spacing and ROIs oblique to the volume grid are
+        resampled onto the ROI grid (fused crop). Transformed ROIs need the Crop Volume module
+        (see runCropVolume) and raise ValueError
+        """
+        if not isinstance(roi, (list, tuple)) and roi.GetParentTransformNode():
+            raise ValueError("Transformed ROIs are cropped by the Crop Volume module, not in the background")
+        ijkToRAS = self.getVolumeIJKToRAS(volume)
+        if volume.GetParentTransformNode() or spacing is not None or \
+                not self.isROIVoxelAligned(self.getROIBounds(roi), ijkToRAS):
+            croppedVolume, croppedArray, inputArray, outputToInputIJK, rescale, castStats = self.prepareAlignCropVolume(
+                roi, volume, outputType=outputType, rescaleRange=rescaleRange, spacing=spacing)
+            def compute(progressCallback=None, cancelEvent=None):
+                self.resampleArray(inputArray, outputToInputIJK, croppedArray.shape, interpolation=interpolation,
+                                   outputArray=croppedArray, progressCallback=progressCallback, cancelEvent=cancelEvent,
+                                   rescale=rescale, castStats=castStats)
+                return self.finishCastStats(castStats, croppedArray.size)
+            return croppedVolume, compute
+
+        inputArray  = slicer.util.arrayFromVolume(volume)
+        (i0, i1), (j0, j1), (k0, k1) = self.computeROIVoxelExtent(self.getROIBounds(roi), ijkToRAS, inputArray.shape[::-1])
+        croppedIJKToRAS = numpy.array(ijkToRAS)
+        croppedIJKToRAS[:3, 3] = ijkToRAS.dot([i0, j0, k0, 1.0])[:3]
+        sourceArray = inputArray[k0:k1, j0:j1, i0:i1]
+        outputDtype, rescale, castStats = self.prepareOutputCast(inputArray.dtype, outputType, rescaleRange, sourceArray)
+        croppedVolume, croppedArray = self.createVolumeNode(volume.GetName() + '-cropped', sourceArray.shape,
+                                                            outputDtype, croppedIJKToRAS)
+        def compute(progressCallback=None, cancelEvent=None):
+            self.castArray(sourceArray, croppedArray, rescale, castStats,
+                           progressCallback=progressCallback, cancelEvent=cancelEvent)
+            return self.finishCastStats(castStats, croppedArray.size)
+        return croppedVolume, compute
+
+    def reportProgress(self, fraction, progressCallback=None, cancelEvent=None):
+        """Progress & cancellation point of long running computations
+        """
+        if cancelEvent is not None and cancelEvent.is_set():
+            raise AlignCrop3DSlicerModuleCancelledError("Cancelled by user")
+        if progressCallback is not None:
+            progressCallback(fraction)
+
+    @AlignCrop3DSlicerModuleProfiler.profile('alignCropCase')
+    def runAlignCropCase(self, inputVolume, movingFiducial, templateVolume, templateFiducial,
+                         placementChecklist, transformType='Rigid', fusedResample=True, scope=None, cache=None,
+                         robust=False, inlierThreshold=1.0, outputType='input', rescaleRange=None,
+                         spacing=None, interpolation='linear', surfaceThreshold=None, refinementMetric=None,
+                         roiMode='volume', roiThreshold=None, roiMargin=1.0, associatedNodes=()):
+        """Non interactive align, harden & crop of one case (the widget button chain).
+        With fusedResample the volume is not hardened, the ROI is resampled through the
+        transform in one pass instead. Intermediate nodes are taken from scope if given,
+        the template ROI from the atlas cache if given. robust & inlierThreshold are passed
+        on to runAlignmentRegistration, outputType, rescaleRange, spacing & interpolation
+        to the crop (see runCropVolume). Cases with fewer than 3 placed landmarks are aligned by
+        their surfaces (see runSurfaceRegistration, thresholded at surfaceThreshold). With a
+        refinementMetric the alignment is refined inside the template ROI (see runIntensityRefinement).
+        roiMode, roiThreshold & roiMargin select the template ROI (see runDefineCropROIVoxel).
+        associatedNodes (label maps & segmentations of the input volume) are aligned & cropped with
+        the volume in the same pass (see runCropVolumeGroup), hardening is then skipped.
+        Their crops are referenced from the cropped volume (see getAssociatedCrops).
+        Returns the landmark transform node and the cropped volume node
+        """
+        if scope:
+            transform = scope.getNode('landmarkTransform', 'vtkMRMLTransformNode', 'LandmarkTransform')
+        else:
+            transform = slicer.vtkMRMLTransformNode()
+            slicer.mrmlScene.AddNode(transform)
+        if sum(1 for placed in placementChecklist.values() if placed) < 3:
+            self.runSurfaceRegistration(transform, templateVolume, inputVolume, templateFiducial, movingFiducial,
+                                        placementChecklist, transformType=transformType, threshold=surfaceThreshold)
+        else:
+            self.runAlignmentRegistration(transform, templateFiducial, movingFiducial, placementChecklist,
+                                          transformType=transformType, robust=robust, inlierThreshold=inlierThreshold)
+
+        templateROI = self.runDefineCropROIVoxel(templateVolume, scope=scope, cache=cache, mode=roiMode,
+                                                 threshold=roiThreshold, margin=roiMargin)
+        if refinementMetric:
+            self.runIntensityRefinement(transform, templateVolume, inputVolume, templateROI, metric=refinementMetric,
+                                        fixedFiducial=templateFiducial, movingFiducial=movingFiducial,
+                                        placementChecklist=placementChecklist)
+
+        #Apply Landmark transform on input Volume, its associated nodes & Fiducials
+        for node in [inputVolume, movingFiducial] + list(associatedNodes):
+            node.SetAndObserveTransformNodeID(transform.GetID())
+        with AlignCrop3DSlicerModuleProfiler.stage('hardenFiducials'):
+            slicer.vtkSlicerTransformLogic().hardenTransform(movingFiducial)
+
+        #Crop to the template region of interest, either resampling the ROI once through
+        #the transform or hardening the whole volume first
+        if associatedNodes:
+            croppedVolume = self.runCropVolumeGroup(templateROI, inputVolume, associatedNodes, transform,
+                                                    interpolation=interpolation, outputType=outputType,
+                                                    rescaleRange=rescaleRange, spacing=spacing)[0]
+        elif fusedResample and interpolation in self.resampleInterpolations:
+            croppedVolume = self.runAlignCropVolume(templateROI, inputVolume, transform, interpolation=interpolation,
+                                                    outputType=outputType, rescaleRange=rescaleRange, spacing=spacing)
+        else:
+            with AlignCrop3DSlicerModuleProfiler.stage('harden'):
+                slicer.vtkSlicerTransformLogic().hardenTransform(inputVolume)
+            croppedVolume = self.runCropVolume(templateROI, inputVolume, scope=scope,
+                                               outputType=outputType, rescaleRange=rescaleRange,
+                                               spacing=spacing, interpolation=interpolation)
+
+        return transform, croppedVolume
+
+
+
+#
+# AlignCrop3DSlicerModuleTask
+#
+
+class AlignCrop3DSlicerModuleCancelledError(RuntimeError):
+    """Raised by computations cancelled through their cancel event
+    """
+    pass
+
+class AlignCrop3DSlicerModuleTask(object):
+    """Runs function(progressCallback, cancelEvent) in a worker thread while the Qt
+    event loop keeps running. A timer on the main thread reports the progress and
+    calls onFinished(result) or onFailed(exception) once the function returned, so
+    these callbacks may access the scene; the function itself must not.
+    """
+
+    def __init__(self, function, onFinished=None, onFailed=None, onProgress=None, interval=100):
+        self.function       = function
+        self.onFinished     = onFinished
+        self.onFailed       = onFailed
+        self.onProgress     = onProgress
+        self.cancelEvent    = threading.Event()
+        self.progress       = 0.0
+        self.result         = None
+        self.error          = None
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.timer = qt.QTimer()
+        self.timer.setInterval(interval)
+        self.timer.connect('timeout()', self.poll)
+
+    def start(self):
+        self.thread.start()
+        self.timer.start()
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def isRunning(self):
+        return self.thread.is_alive()
+
+    def setProgress(self, fraction):
+        self.progress = fraction
+
+    def run(self):
+        try:
+            self.result = self.function(self.setProgress, self.cancelEvent)
+        except Exception as e:
+            if not isinstance(e, AlignCrop3DSlicerModuleCancelledError):
+                logging.error(traceback.format_exc())
+            self.error = e
+
+    def poll(self):
+        if self.onProgress:
+            self.onProgress(self.progress)
+        if self.thread.is_alive():
+            return
+        self.timer.stop()
+        if self.error is not None:
+            if self.onFailed:
+                self.onFailed(self.error)
+        elif self.onFinished:
+            self.onFinished(self.result)
+
+
+#
+# AlignCrop3DSlicerModulePreview
+#
+
+class AlignCrop3DSlicerModulePreview(object):
+    """Progressive overlay of an aligned volume & its template in the slice views.
+    Downsampled copies are shown first and replaced by finer levels as soon as a
+    worker thread (see AlignCrop3DSlicerModuleTask) built them. Refining stops at
+    the first level as large as the slice views, the full resolution volumes are
+    shown last only if no level is, so large volumes can be checked at once.
+    Input levels keep every factor-th voxel (the parent transform is kept),
+    template levels are the averaged pyramid levels of the atlas cache when given.
+    """
+    sliceViewNames = ['Red', 'Yellow', 'Green']
+
+    def __init__(self, inputVolume, templateVolume, cache=None, minimumVoxels=32*1024*1024,
+                 minimumSize=96, interval=100):
+        self.inputVolume    = inputVolume
+        self.templateVolume = templateVolume
+        self.cache          = cache
+        self.interval       = interval
+        self.previewNodes   = {}
+        self.sources        = {}
+        self.task           = None
+        self.fitsView       = False
+        #Coarsest first, halved until the volume is small enough to be shown at full resolution
+        self.factors = []
+        dimensions = inputVolume.GetImageData().GetDimensions()
+        if dimensions[0] * dimensions[1] * dimensions[2] >= minimumVoxels:
+            factor = 2
+            while max(dimensions) // factor >= minimumSize and len(self.factors) < 3:
+                self.factors.insert(0, factor)
+                factor *= 2
+
+    def start(self, viewSize=None):
+        """Starts building the levels. Levels finer than the first one with viewSize
+        (default: the largest slice view size in pixels) voxels are skipped
+        """
+        if not self.factors:
+            return
+        if viewSize is None:
+            viewSize = self.getViewSize()
+        dimensions = self.inputVolume.GetImageData().GetDimensions()
+        for index, factor in enumerate(self.factors):
+            if max(dimensions) // factor >= viewSize:
+                self.factors = self.factors[:index + 1]
+                self.fitsView = True
+                break
+        #Voxels & geometry read on the main thread, the worker does not access the scene
+        for volume in (self.inputVolume, self.templateVolume):
+            self.sources[volume.GetID()] = self.getSource(volume)
+        self.refine()
+
+    def getViewSize(self):
+        layoutManager = slicer.app.layoutManager()
+        viewSizes = [0]
+        for sliceViewName in self.sliceViewNames:
+            sliceView = layoutManager.sliceWidget(sliceViewName).sliceView()
+            viewSizes.append(max(sliceView.width, sliceView.height))
+        return max(viewSizes)
+
+    def isRunning(self):
+        return bool(self.previewNodes) or self.task is not None
+
+    def getSource(self, volume):
+        """Voxels, IJKToRAS matrix & atlas cache key (None - no pyramid) of a volume
+        """
+        cacheKey = self.cache.getVolumeKey(volume) if volume is self.templateVolume and self.cache else None
+        return slicer.util.arrayFromVolume(volume), AlignCrop3DSlicerModuleLogic().getVolumeIJKToRAS(volume), cacheKey
+
+    def getLevel(self, volume, factor):
+        return self.computeLevel(*(self.getSource(volume) + (factor,)))
+
+    def computeLevel(self, voxels, ijkToRAS, cacheKey, factor):
+        """Voxels & IJKToRAS matrix of a level, without accessing the scene
+        """
+        if cacheKey is not None:
+            level, levelIJKToRAS = self.cache.getKeyPyramidLevel(cacheKey, voxels, ijkToRAS, int(round(numpy.log2(factor))))
+            return numpy.ascontiguousarray(level), levelIJKToRAS
+        levelIJKToRAS = numpy.array(ijkToRAS)
+        levelIJKToRAS[:3, :3] *= factor
+        return numpy.ascontiguousarray(voxels[::factor, ::factor, ::factor]), levelIJKToRAS
+
+    def computeLevels(self, factor, progressCallback=None, cancelEvent=None):
+        levels = {}
+        volumeIDs = [self.inputVolume.GetID(), self.templateVolume.GetID()]
+        for index, volumeID in enumerate(volumeIDs):
+            if cancelEvent is not None and cancelEvent.is_set():
+                raise AlignCrop3DSlicerModuleCancelledError()
+            with AlignCrop3DSlicerModuleProfiler.stage('previewLevel'):
+                levels[volumeID] = self.computeLevel(*(self.sources[volumeID] + (factor,)))
+            if progressCallback:
+                progressCallback(float(index + 1) / len(volumeIDs))
+        return levels
+
+    def showLevel(self, volume, level, levelIJKToRAS):
+        logic = AlignCrop3DSlicerModuleLogic()
+        previewNode, voxels = logic.createVolumeNode(volume.GetName() + '-preview', level.shape, level.dtype, levelIJKToRAS)
+        voxels[...] = level
+        previewNode.GetImageData().Modified()
+        previewNode.SetHideFromEditors(True)
+        previewNode.SetAndObserveTransformNodeID(volume.GetTransformNodeID())
+        displayNode, previewDisplayNode = volume.GetDisplayNode(), previewNode.GetDisplayNode()
+        if displayNode and previewDisplayNode:
+            previewDisplayNode.SetAndObserveColorNodeID(displayNode.GetColorNodeID())
+            previewDisplayNode.SetAutoWindowLevel(False)
+            previewDisplayNode.SetWindowLevel(displayNode.GetWindow(), displayNode.GetLevel())
+        self.previewNodes[volume.GetID()] = previewNode
+        return previewNode
+
+    def setSliceViewVolumes(self, backgroundVolume, foregroundVolume):
+        layoutManager = slicer.app.layoutManager()
+        for sliceViewName in self.sliceViewNames:
+            compositeNode = layoutManager.sliceWidget(sliceViewName).sliceLogic().GetSliceCompositeNode()
+            compositeNode.SetBackgroundVolumeID(backgroundVolume.GetID())
+            compositeNode.SetForegroundVolumeID(foregroundVolume.GetID())
+            compositeNode.SetForegroundOpacity(0.5)
+
+    def refine(self):
+        """Builds the next finer level in a worker thread. After the last level the views
+        keep it if it fits the views, otherwise they show the full resolution volumes
+        """
+        if not self.factors:
+            self.task = None
+            if not self.fitsView:
+                self.stop()
+            return
+        factor = self.factors.pop(0)
+        task = AlignCrop3DSlicerModuleTask(lambda progressCallback, cancelEvent:
+                                               self.computeLevels(factor, progressCallback, cancelEvent),
+                                           interval=self.interval)
+        task.onFinished = lambda levels: self.onLevelFinished(task, levels)
+        task.onFailed   = lambda error: self.onLevelFailed(task, error)
+        self.task = task
+        task.start()
+
+    def onLevelFinished(self, task, levels):
+        #levels of a stopped preview are dropped
+        if task is not self.task:
+            return
+        #previous level removed once the views show the new one
+        previousNodes = list(self.previewNodes.values())
+        self.setSliceViewVolumes(self.showLevel(self.inputVolume, *levels[self.inputVolume.GetID()]),
+                                 self.showLevel(self.templateVolume, *levels[self.templateVolume.GetID()]))
+        for previewNode in previousNodes:
+            slicer.mrmlScene.RemoveNode(previewNode)
+        self.refine()
+
+    def onLevelFailed(self, task, error):
+        if task is self.task:
+            self.stop()
+
+    def stop(self):
+        """Cancels the level being built, switches the slice views to the full resolution
+        volumes & removes the preview nodes
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.factors = []
+        if self.previewNodes:
+            self.setSliceViewVolumes(self.inputVolume, self.templateVolume)
+        for previewNode in self.previewNodes.values():
+            slicer.mrmlScene.RemoveNode(previewNode)
+        self.previewNodes = {}
+
+
+#
+# AlignCrop3DSlicerModuleAtlasCache
+#
+
+class AlignCrop3DSlicerModuleAtlasCache(object):
+    """Persistent cache of the data derived from atlas/template volumes & fiducials,
+    keyed by the file (path, size & modification time) & geometry of the atlas, or a content
+    hash of atlases not read from a file, so it is shared by sessions & batch workers.
+    Every atlas has a directory holding entry.json (geometry, template ROI bounds &
+    voxel extent, foreground ROI bounds, landmarks & centroids of its fiducial lists) and the downsampled
+    preview pyramid levels (.npy). The least recently used atlases are evicted once
+    the cache is larger than maxSizeMB.
+    """
+
+    def __init__(self, directory=None, maxSizeMB=2048):
+        if directory is None:
+            directory = os.path.join(slicer.app.cachePath, 'AlignCrop3DSlicerModule')
+        self.directory  = directory
+        self.maxSizeMB  = maxSizeMB
+        #Keys of the volumes seen in this session, by node & voxel modification time
+        self.volumeKeys = {}
+
+    def getVolumeFileStats(self, volume):
+        """Absolute path, size & modification time of the file a volume was read from,
+        None if the volume has no file or was modified since it was read
+        """
+        storageNode = volume.GetStorageNode()
+        if storageNode is None or volume.GetModifiedSinceRead():
+            return None
+        path = storageNode.GetFileName()
+        if not path or not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, repr(stat.st_mtime))
+
+    def getVolumeKey(self, volume):
+        """Hash of the file statistics (see getVolumeFileStats) & geometry of a volume node,
+        of its voxels & geometry if it was not read from a file (or modified since)
+        """
+        voxels      = slicer.util.arrayFromVolume(volume)
+        ijkToRAS    = AlignCrop3DSlicerModuleLogic().getVolumeIJKToRAS(volume)
+        sessionKey  = (volume.GetID(), volume.GetImageData().GetMTime(), tuple(ijkToRAS.round(6).flat))
+        if sessionKey not in self.volumeKeys:
+            digest = hashlib.sha1()
+            digest.update(repr((voxels.shape, voxels.dtype.str, sessionKey[2])).encode('ascii'))
+            fileStats = self.getVolumeFileStats(volume)
+            if fileStats is not None:
+                #Hashing the voxels of large atlases costs more than cropping them
+                digest.update(repr(fileStats).encode('utf-8'))
+            else:
+                flatVoxels = numpy.ascontiguousarray(voxels).reshape(-1)
+                chunkVoxels = max(1, (64 * 1024 * 1024) // flatVoxels.itemsize)
+                for start in range(0, flatVoxels.size, chunkVoxels):
+                    digest.update(flatVoxels[start:start + chunkVoxels])
+            self.volumeKeys[sessionKey] = digest.hexdigest()
+        return self.volumeKeys[sessionKey]
+
+    def getEntryPath(self, key, fileName=''):
+        return os.path.join(self.directory, key, fileName)
+
+    def getEntry(self, volume):
+        """Cached values of a volume (empty for new atlases). Marks the atlas as used
+        """
+        return self.readEntry(self.getVolumeKey(volume))
+
+    def readEntry(self, key):
+        entryPath = self.getEntryPath(key, 'entry.json')
+        try:
+            with open(entryPath) as entryFile:
+                entry = json.load(entryFile)
+            os.utime(entryPath, None)
+        except ValueError:
+            logging.warning("Ignoring unreadable atlas cache entry %s" % entryPath)
+            return {}
+        except (IOError, OSError):
+            #new atlas, or its entry evicted by another worker
+            return {}
+        return entry
+
+    def updateEntry(self, volume, **values):
+        """Stores values (JSON serializable) into the entry of a volume. The entry is re-read
+        & merged under the entry lock, so the values stored by concurrent workers are kept
+        """
+        key = self.getVolumeKey(volume)
+        with self.lockEntry(key):
+            entry = self.readEntry(key)
+            entry.update(values)
+            self.writeFile(self.getEntryPath(key, 'entry.json'),
+                           lambda entryFile: entryFile.write(json.dumps(entry, indent=2, sort_keys=True).encode('ascii')))
+        self.evict()
+        return entry
+
+    @contextlib.contextmanager
+    def lockEntry(self, key, timeout=10.0, staleSeconds=60.0):
+        """Exclusive lock of an atlas entry between workers (lock file created exclusively).
+        Locks older than staleSeconds (left by crashed workers) are broken, after timeout the
+        entry is updated without the lock
+        """
+        lockPath = self.getEntryPath(key, 'entry.lock')
+        start = time.time()
+        locked = False
+        while not locked and time.time() - start < timeout:
+            try:
+                self.makeEntryDirectory(lockPath)
+                os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                locked = True
+            except OSError:
+                try:
+                    if time.time() - os.path.getmtime(lockPath) > staleSeconds:
+                        os.remove(lockPath)
+                except OSError:
+                    pass
+                time.sleep(0.01)
+        if not locked:
+            logging.warning("Atlas cache entry %s updated without its lock" % key)
+        try:
+            yield
+        finally:
+            if locked:
+                try:
+                    os.remove(lockPath)
+                except OSError:
+                    pass
+
+    def makeEntryDirectory(self, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+
+    def writeFile(self, path, write, attempts=3):
+        """Writes through a temporary file replacing path atomically, so concurrent workers never
+        read partial or missing files. The entry directory is recreated if another worker evicted
+        it meanwhile; returns False (logged) if the file could not be written
+        """
+        temporaryPath = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        for attempt in range(attempts):
+            try:
+                self.makeEntryDirectory(path)
+                with open(temporaryPath, 'wb') as temporaryFile:
+                    write(temporaryFile)
+                os.replace(temporaryPath, path)
+                return True
+            except (IOError, OSError) as e:
+                error = e
+                try:
+                    os.remove(temporaryPath)
+                except OSError:
+                    pass
+        logging.warning("Atlas cache file %s not written: %s" % (path, error))
+        return False
+
+    def getROIBounds(self, volume, roiKey=None):
+        """Cached RAS bounds of the template ROI of a volume (None if not cached), of the
+        foreground ROI of roiKey if given (see runDefineCropROIVoxel)
+        """
+        if roiKey:
+            return self.getEntry(volume).get('foregroundROIs', {}).get(roiKey)
+        return self.getEntry(volume).get('roiBounds')
+
+    def setROIBounds(self, volume, roiBounds, roiKey=None):
+        if roiKey:
+            foregroundROIs = self.getEntry(volume).get('foregroundROIs', {})
+            foregroundROIs[roiKey] = [float(bound) for bound in roiBounds]
+            self.updateEntry(volume, foregroundROIs=foregroundROIs)
+            return
+        logic = AlignCrop3DSlicerModuleLogic()
+        ijkToRAS = logic.getVolumeIJKToRAS(volume)
+        self.updateEntry(volume, roiBounds      = [float(bound) for bound in roiBounds],
+                                 roiExtent      = logic.computeROIVoxelExtent(roiBounds, ijkToRAS, volume.GetImageData().GetDimensions()),
+                                 ijkToRAS       = ijkToRAS.tolist(),
+                                 dimensions     = list(volume.GetImageData().GetDimensions()))
+
+    def getLandmarks(self, volume, fiducial):
+        """Landmark positions (N x 3) & centroid of an atlas fiducial list, cached with its atlas
+        """
+        pos = [0.0, 0.0, 0.0]
+        points = numpy.zeros((fiducial.GetNumberOfFiducials(), 3))
+        for index in range(len(points)):
+            fiducial.GetNthFiducialPosition(index, pos)
+            points[index] = pos
+        fiducialKey = hashlib.sha1(points.round(6).tobytes()).hexdigest()
+
+        fiducials = self.getEntry(volume).get('fiducials', {})
+        if fiducialKey not in fiducials:
+            fiducials[fiducialKey] = { 'landmarks'  : points.tolist(),
+                                       'centroid'   : points.mean(axis=0).tolist() if len(points) else [0.0, 0.0, 0.0] }
+            self.updateEntry(volume, fiducials=fiducials)
+        cached = fiducials[fiducialKey]
+        return numpy.array(cached['landmarks']).reshape(-1, 3), numpy.array(cached['centroid'])
+
+    def getPyramidLevel(self, volume, level):
+        """Voxels (memory mapped) & IJKToRAS matrix of a volume downsampled by 2**level,
+        computed from the previous level on first use
+        """
+        ijkToRAS = AlignCrop3DSlicerModuleLogic().getVolumeIJKToRAS(volume)
+        if level == 0:
+            return slicer.util.arrayFromVolume(volume), ijkToRAS
+        pyramidLevel = self.getKeyPyramidLevel(self.getVolumeKey(volume), slicer.util.arrayFromVolume(volume), ijkToRAS, level)
+        self.getEntry(volume)
+        return pyramidLevel
+
+    def getKeyPyramidLevel(self, key, voxels, ijkToRAS, level):
+        """getPyramidLevel of the voxels & IJKToRAS matrix of the atlas with key, without
+        accessing the scene (worker threads)
+        """
+        if level == 0:
+            return voxels, ijkToRAS
+
+        levelPath = self.getEntryPath(key, 'pyramid_%d.npy' % level)
+        try:
+            levelVoxels = numpy.load(levelPath, mmap_mode='r')
+        except (IOError, OSError):
+            #not cached yet, or evicted by another worker
+            previousLevel, previousIJKToRAS = self.getKeyPyramidLevel(key, voxels, ijkToRAS, level - 1)
+            with AlignCrop3DSlicerModuleProfiler.stage('pyramidLevel'):
+                levelVoxels = self.downsample(previousLevel)
+            self.writeFile(levelPath, lambda levelFile: numpy.save(levelFile, levelVoxels))
+            self.evict()
+
+        #Averaging 2x2x2 voxels moves the first voxel centre by half a (previous level) voxel
+        scale = 2 ** level
+        levelIJKToRAS = numpy.array(ijkToRAS)
+        levelIJKToRAS[:3, :3] *= scale
+        levelIJKToRAS[:3, 3] = ijkToRAS.dot([(scale - 1) / 2.0] * 3 + [1.0])[:3]
+        return levelVoxels, levelIJKToRAS
+
+    def downsample(self, voxels, slabSlices=32):
+        """Mean of 2x2x2 voxel blocks (see downsampleArray of the logic)
+        """
+        return AlignCrop3DSlicerModuleLogic().downsampleArray(voxels, slabSlices)
+
+    def getSizeMB(self):
+        return sum(self.getEntrySize(key) for key in self.getKeys()) / 1048576.0
+
+    def getKeys(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [key for key in os.listdir(self.directory) if os.path.isdir(self.getEntryPath(key))]
+
+    def getEntrySize(self, key):
+        entryDirectory = self.getEntryPath(key)
+        return sum(os.path.getsize(os.path.join(entryDirectory, fileName)) for fileName in os.listdir(entryDirectory))
+
+    def evict(self):
+        """Removes the least recently used atlases until the cache fits into maxSizeMB.
+        Returns the removed keys
+        """
+        def lastUsed(key):
+            entryPath = self.getEntryPath(key, 'entry.json')
+            return os.path.getmtime(entryPath if os.path.exists(entryPath) else self.getEntryPath(key))
+
+        try:
+            keys    = sorted(self.getKeys(), key=lastUsed)
+            sizes   = dict((key, self.getEntrySize(key)) for key in keys)
+        except OSError:
+            #entry removed by another worker meanwhile
+            return []
+        totalSize = sum(sizes.values())
+        removed = []
+        #the most recently used atlas is kept even if it alone exceeds the limit
+        for key in keys[:-1]:
+            if totalSize <= self.maxSizeMB * 1048576:
+                break
+            shutil.rmtree(self.getEntryPath(key), ignore_errors=True)
+            totalSize -= sizes[key]
+            removed.append(key)
+        return removed
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.volumeKeys = {}
+
+
+#
+# AlignCrop3DSlicerModuleSceneScope
+#
+
+class AlignCrop3DSlicerModuleSceneScope(object):
+    """Keeps track of the intermediate nodes (fiducials, transforms, crop parameters,
+    ROIs) a case adds to the scene, by role. Asking for a role again returns the
+    node of the previous case, reset, instead of adding a new node; release()
+    removes the tracked nodes from the scene.
+    """
+
+    def __init__(self, scene=None):
+        self.scene  = scene if scene else slicer.mrmlScene
+        self.nodes  = {}
+        self.stats  = {'created': 0, 'reused': 0}
+
+    def getNode(self, role, className, name=None):
+        """Returns the node tracked for role, reset, or a new node of className
+        """
+        node = self.scene.GetNodeByID(self.nodes[role]) if role in self.nodes else None
+        if node and (not node.IsA(className) or self.isObservedTransform(node)):
+            #still in use by nodes outside the scope (e.g. a deferred, not hardened volume)
+            del self.nodes[role]
+            node = None
+
+        if node:
+            self.resetNode(node)
+            self.stats['reused'] += 1
+        else:
+            node = self.scene.CreateNodeByClass(className)
+            node.SetName(self.scene.GenerateUniqueName(name if name else role))
+            self.scene.AddNode(node)
+            node.UnRegister(None)
+            self.nodes[role] = node.GetID()
+            self.stats['created'] += 1
+        return node
+
+    def isObservedTransform(self, node):
+        if not node.IsA('vtkMRMLTransformNode'):
+            return False
+        trackedIDs = set(self.nodes.values())
+        transformables = self.scene.GetNodesByClass('vtkMRMLTransformableNode')
+        for index in range(transformables.GetNumberOfItems()):
+            transformable = transformables.GetItemAsObject(index)
+            if transformable.GetTransformNodeID() == node.GetID() and transformable.GetID() not in trackedIDs:
+                return True
+        return False
+
+    def resetNode(self, node):
+        if node.IsA('vtkMRMLTransformableNode') or node.IsA('vtkMRMLTransformNode'):
+            node.SetAndObserveTransformNodeID(None)
+        if node.IsA('vtkMRMLMarkupsNode'):
+            node.RemoveAllMarkups()
+        if node.IsA('vtkMRMLTransformNode'):
+            node.SetMatrixTransformToParent(vtk.vtkMatrix4x4())
+
+    def release(self, keep=()):
+        """Removes the tracked nodes (except the nodes in keep) from the scene.
+        Returns a report of the reclaimed nodes
+        """
+        keepIDs = set(node.GetID() for node in keep)
+        report = {'removed': 0, 'nodes': [], 'created': self.stats['created'], 'reused': self.stats['reused']}
+        for role in list(self.nodes.keys()):
+            node = self.scene.GetNodeByID(self.nodes[role])
+            if node is None:
+                del self.nodes[role]
+                continue
+            if node.GetID() in keepIDs:
+                continue
+            if self.isObservedTransform(node):
+                #transform of a volume that was not hardened, left to the volume
+                del self.nodes[role]
+                continue
+            report['nodes'].append('%s (%s)' % (node.GetName(), node.GetClassName()))
+            self.scene.RemoveNode(node)
+            del self.nodes[role]
+            report['removed'] += 1
+
+        logging.info('Scene scope released %d nodes (%d created, %d reused): %s' %
+                     (report['removed'], report['created'], report['reused'], ', '.join(report['nodes'])))
+        return report
 
 
 class AlignCrop3DSlicerModuleTest(ScriptedLoadableModuleTest):
@@ -900,11 +4787,64 @@ class AlignCrop3DSlicerModuleTest(ScriptedLoadableModuleTest):
     """
     slicer.mrmlScene.Clear(0)
 
+  def createStructureTemplate(self, logic):
+    """ Template volume of a smooth random structure (low pass filtered noise) with 0.5 mm voxels.
+    Returns the template node, its voxels & IJK to RAS matrix
+    """
+    noise = numpy.random.RandomState(1).rand(64, 64, 64)
+    frequencies = numpy.fft.fftfreq(64)
+    radius2 = frequencies[:, None, None] ** 2 + frequencies[None, :, None] ** 2 + frequencies[None, None, :] ** 2
+    structure = numpy.real(numpy.fft.ifftn(numpy.fft.fftn(noise) * numpy.exp(-2 * (numpy.pi * 2) ** 2 * radius2))) * 1000
+
+    templateIJKToRAS = numpy.diag([0.5, 0.5, 0.5, 1.0])
+    template, templateArray = logic.createVolumeNode('Template', structure.shape, numpy.float32, templateIJKToRAS)
+    templateArray[...] = structure
+    template.GetImageData().Modified()
+    return template, structure, templateIJKToRAS
+
   def runTest(self):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
     self.test_AlignCrop3DSlicerModule1()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleLandmarkSolver()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleSceneScope()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleVoxelAlignedCrop()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleBackgroundCrop()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleAtlasCache()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModulePreview()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleMultiAtlas()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleRegistrationQuality()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleRobustFitting()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleOutOfCoreCrop()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleResampleMemoryBudget()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleCompressedWriter()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleOutputType()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleIsotropicCrop()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleLandmarkProposal()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleSurfaceAlignment()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleIntensityRefinement()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleForegroundROI()
+    self.setUp()
+    self.test_AlignCrop3DSlicerModuleCoCrop()
 
   def test_AlignCrop3DSlicerModule1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -941,3 +4881,693 @@ class AlignCrop3DSlicerModuleTest(ScriptedLoadableModuleTest):
     logic = AlignCrop3DSlicerModuleLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleLandmarkSolver(self):
+    """ Recover a known rigid transform with the built-in landmark solver,
+    skipping one of the cochlea only landmarks
+    """
+    self.delayDisplay("Starting the landmark solver test")
+    import math
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    angle = math.radians(30)
+    expected = numpy.array([[math.cos(angle), -math.sin(angle), 0, 10.0],
+                            [math.sin(angle),  math.cos(angle), 0, -5.0],
+                            [0, 0, 1, 2.5],
+                            [0, 0, 0, 1]])
+    movingPoints = numpy.array([[0, 0, 0], [10, 0, 0], [0, 12, 0], [0, 0, 8]], dtype=float)
+    fixedPoints  = movingPoints.dot(expected[:3, :3].T) + expected[:3, 3]
+
+    placementChecklist = {'OW': True, 'CN': False, 'A': True, 'RW': True}
+    fixedFiducial   = slicer.vtkMRMLMarkupsFiducialNode()
+    movingFiducial  = slicer.vtkMRMLMarkupsFiducialNode()
+    transform       = slicer.vtkMRMLTransformNode()
+    for node in (fixedFiducial, movingFiducial, transform):
+      slicer.mrmlScene.AddNode(node)
+    for index, key in enumerate(logic.landmarkOrderCO):
+      fixedFiducial.AddFiducialFromArray(fixedPoints[index])
+      if placementChecklist[key]:
+        movingFiducial.AddFiducialFromArray(movingPoints[index])
+
+    matrix = logic.runAlignmentRegistration(transform, fixedFiducial, movingFiducial, placementChecklist)
+    self.assertTrue(numpy.allclose(matrix, expected, atol=1e-6))
+    self.assertTrue(numpy.allclose(logic.getTransformMatrix(transform), expected, atol=1e-6))
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleSceneScope(self):
+    """ Nodes asked for again by role are reused & released nodes leave the scene
+    """
+    self.delayDisplay("Starting the scene scope test")
+    scope = AlignCrop3DSlicerModuleSceneScope()
+    nodeCount = slicer.mrmlScene.GetNumberOfNodes()
+
+    for case in range(5):
+      fiducials = scope.getNode('movingFiducial', 'vtkMRMLMarkupsFiducialNode', 'F')
+      self.assertEqual(fiducials.GetNumberOfFiducials(), 0)
+      fiducials.AddFiducial(case, 0, 0)
+      scope.getNode('landmarkTransform', 'vtkMRMLTransformNode', 'LandmarkTransform')
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), nodeCount + 2)
+
+    report = scope.release()
+    self.assertEqual(report['removed'], 2)
+    self.assertEqual(report['reused'], 8)
+    self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), nodeCount)
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleVoxelAlignedCrop(self):
+    """ A voxel snapped ROI is cropped as a slice of the voxel array with the
+    matching geometry
+    """
+    self.delayDisplay("Starting the voxel aligned crop test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    ijkToRAS = numpy.array([[-0.5, 0, 0, 10], [0, -0.5, 0, 20], [0, 0, 0.25, -5], [0, 0, 0, 1]])
+    voxels = numpy.arange(20 * 30 * 40, dtype=numpy.int16).reshape(20, 30, 40)
+    volume, volumeArray = logic.createVolumeNode('Input', voxels.shape, voxels.dtype, ijkToRAS)
+    volumeArray[...] = voxels
+    volume.GetImageData().Modified()
+
+    #ROI faces on the boundaries of voxels i 4-11, j 5-14, k 2-17
+    roi = slicer.vtkMRMLAnnotationROINode()
+    slicer.mrmlScene.AddNode(roi)
+    lower = ijkToRAS.dot([11.5, 14.5, 1.5, 1])[:3]
+    upper = ijkToRAS.dot([3.5, 4.5, 17.5, 1])[:3]
+    roi.SetXYZ((lower + upper) / 2.0)
+    roi.SetRadiusXYZ(numpy.abs(upper - lower) / 2.0)
+    self.assertTrue(logic.isROIVoxelAligned(logic.getROIBounds(roi), ijkToRAS))
+
+    croppedVolume = logic.runCropVolume(roi, volume)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(croppedVolume), voxels[2:18, 5:15, 4:12]))
+    self.assertTrue(numpy.allclose(logic.getVolumeIJKToRAS(croppedVolume)[:3, 3], ijkToRAS.dot([4, 5, 2, 1])[:3]))
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleBackgroundCrop(self):
+    """ The background half of a crop reports its progress, stops when cancelled
+    and gives the same voxels as the synchronous crop
+    """
+    self.delayDisplay("Starting the background crop test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    voxels = numpy.arange(20 * 30 * 40, dtype=numpy.int16).reshape(20, 30, 40)
+    volume, volumeArray = logic.createVolumeNode('Input', voxels.shape, voxels.dtype, numpy.identity(4))
+    volumeArray[...] = voxels
+    volume.GetImageData().Modified()
+
+    roi = slicer.vtkMRMLAnnotationROINode()
+    slicer.mrmlScene.AddNode(roi)
+    roi.SetXYZ(10, 12, 8)
+    roi.SetRadiusXYZ(5, 6, 4)
+
+    cancelEvent = threading.Event()
+    cancelEvent.set()
+    croppedVolume, compute = logic.startCropVolume(roi, volume)
+    self.assertRaises(AlignCrop3DSlicerModuleCancelledError, compute, None, cancelEvent)
+    slicer.mrmlScene.RemoveNode(croppedVolume)
+
+    progress = []
+    croppedVolume, compute = logic.startCropVolume(roi, volume)
+    compute(progress.append, threading.Event())
+    croppedVolume.GetImageData().Modified()
+    self.assertEqual(progress[-1], 1.0)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(croppedVolume), voxels[4:13, 6:19, 5:16]))
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleAtlasCache(self):
+    """ Template ROI & pyramid levels are restored from the atlas cache, the least
+    recently used atlas is evicted
+    """
+    self.delayDisplay("Starting the atlas cache test")
+    logic = AlignCrop3DSlicerModuleLogic()
+    cacheDirectory = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleCacheTest')
+    cache = AlignCrop3DSlicerModuleAtlasCache(cacheDirectory, maxSizeMB=0.5)
+    cache.clear()
+
+    template, templateArray = logic.createVolumeNode('Template', (16, 20, 24), numpy.int16, numpy.diag([0.5, 0.5, 0.5, 1.0]))
+    templateArray[...] = numpy.arange(templateArray.size).reshape(templateArray.shape) % 1000
+    template.GetImageData().Modified()
+
+    roi = logic.runDefineCropROIVoxel(template, cache=cache)
+    cachedROI = logic.runDefineCropROIVoxel(template, cache=cache)
+    self.assertTrue(numpy.allclose(logic.getROIBounds(roi), logic.getROIBounds(cachedROI)))
+    self.assertEqual(cache.getEntry(template)['roiExtent'], [[0, 24], [0, 20], [0, 16]])
+
+    level, levelIJKToRAS = cache.getPyramidLevel(template, 1)
+    self.assertEqual(level.shape, (8, 10, 12))
+    self.assertEqual(level[0, 0, 0], numpy.rint(templateArray[:2, :2, :2].mean()))
+    self.assertTrue(numpy.allclose(levelIJKToRAS[:3, 3], [0.25, 0.25, 0.25]))
+
+    #A larger atlas pushes the cache over its size limit
+    other, otherArray = logic.createVolumeNode('Other', (128, 128, 128), numpy.int16, numpy.identity(4))
+    otherArray[...] = 1
+    other.GetImageData().Modified()
+    time.sleep(1)
+    cache.getPyramidLevel(other, 1)
+    self.assertEqual(cache.getKeys(), [cache.getVolumeKey(other)])
+
+    #Atlases read from a file are keyed by the file statistics, not by their voxels
+    atlasPath = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleCacheTest.nrrd')
+    slicer.util.saveNode(template, atlasPath)
+    atlas = slicer.util.loadVolume(atlasPath)
+    self.assertEqual(cache.getVolumeFileStats(atlas)[:2], (os.path.abspath(atlasPath), os.path.getsize(atlasPath)))
+    self.assertNotEqual(cache.getVolumeKey(atlas), cache.getVolumeKey(template))
+    self.assertIsNone(cache.getVolumeFileStats(template))
+    cache.clear()
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModulePreview(self):
+    """ Large volumes are overlaid coarse to fine, the slice views end on the full
+    resolution volumes
+    """
+    self.delayDisplay("Starting the progressive overlay test")
+    logic = AlignCrop3DSlicerModuleLogic()
+    inputVolume, inputArray = logic.createVolumeNode('Input', (200, 200, 200), numpy.uint8, numpy.identity(4))
+    inputArray[...] = 100
+    inputVolume.GetImageData().Modified()
+    templateVolume, templateArray = logic.createVolumeNode('Template', (200, 200, 200), numpy.uint8, numpy.identity(4))
+    templateArray[...] = 50
+    templateVolume.GetImageData().Modified()
+
+    preview = AlignCrop3DSlicerModulePreview(inputVolume, templateVolume, minimumVoxels=1, minimumSize=50)
+    self.assertEqual(preview.factors, [4, 2])
+    level, levelIJKToRAS = preview.getLevel(inputVolume, 4)
+    self.assertEqual(level.shape, (50, 50, 50))
+    self.assertTrue(numpy.allclose(numpy.diag(levelIJKToRAS), [4, 4, 4, 1]))
+
+    #Levels finer than the first one as large as the views are not built
+    preview.start(viewSize=40)
+    self.assertEqual(preview.factors, [])
+    self.assertTrue(preview.isRunning())
+    preview.stop()
+    self.assertFalse(preview.isRunning())
+
+    preview = AlignCrop3DSlicerModulePreview(inputVolume, templateVolume, minimumVoxels=1, minimumSize=50)
+    preview.start(viewSize=1000)
+    self.assertEqual(preview.factors, [2])
+    while preview.task is not None:
+      slicer.app.processEvents()
+    self.assertFalse(preview.isRunning())
+    preview.stop()
+    self.assertFalse(preview.isRunning())
+    compositeNode = slicer.app.layoutManager().sliceWidget('Red').sliceLogic().GetSliceCompositeNode()
+    self.assertEqual(compositeNode.GetBackgroundVolumeID(), inputVolume.GetID())
+    self.assertEqual(compositeNode.GetForegroundVolumeID(), templateVolume.GetID())
+    self.assertEqual(len(slicer.util.getNodes('*-preview*')), 0)
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleMultiAtlas(self):
+    """ The atlas the placed landmarks fit best is ranked first and its transform applied
+    """
+    self.delayDisplay("Starting the multi-atlas test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    movingPoints = numpy.array([[0, 0, 0], [10, 0, 0], [0, 12, 0], [0, 0, 8]], dtype=float)
+    translation = numpy.array([5.0, -3.0, 2.0])
+    atlasFiducials = []
+    for name, noise in [('Noisy', 1.0), ('Exact', 0.0), ('Noisier', 2.0)]:
+      fiducial = slicer.vtkMRMLMarkupsFiducialNode()
+      fiducial.SetName(name)
+      slicer.mrmlScene.AddNode(fiducial)
+      for index, point in enumerate(movingPoints + translation):
+        fiducial.AddFiducialFromArray(point + noise * numpy.array([(-1) ** index, 0, 0]))
+      atlasFiducials.append(fiducial)
+    #An atlas of the 7 TB landmarks starting with the exact CO points is not paired with the CO checklist
+    tbFiducial = slicer.vtkMRMLMarkupsFiducialNode()
+    tbFiducial.SetName('TB')
+    slicer.mrmlScene.AddNode(tbFiducial)
+    for point in numpy.vstack([movingPoints + translation, numpy.zeros((3, 3))]):
+      tbFiducial.AddFiducialFromArray(point)
+    atlasFiducials.append(tbFiducial)
+    movingFiducial = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(movingFiducial)
+    for point in movingPoints:
+      movingFiducial.AddFiducialFromArray(point)
+
+    transform = slicer.vtkMRMLTransformNode()
+    slicer.mrmlScene.AddNode(transform)
+    placementChecklist = dict((key, True) for key in logic.landmarkOrderCO)
+    ranking = logic.runMultiAtlasRegistration(transform, atlasFiducials, movingFiducial, placementChecklist)
+
+    self.assertEqual([candidate['index'] for candidate in ranking], [1, 0, 2])
+    self.assertAlmostEqual(ranking[0]['error'], 0.0, places=6)
+    self.assertTrue(numpy.allclose(logic.getTransformMatrix(transform)[:3, 3], translation))
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleRegistrationQuality(self):
+    """ Leave-one-out errors match one refit per left out landmark, a displaced landmark
+    has the largest leave-one-out error
+    """
+    self.delayDisplay("Starting the registration quality test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    movingPoints = numpy.array([[0, 0, 0], [10, 0, 0], [0, 12, 0], [0, 0, 8], [6, 6, 6], [-4, 3, 1]], dtype=float)
+    fixedPoints = movingPoints + [1.0, 2.0, 3.0]
+    fixedPoints[4] += [0.0, 3.0, 0.0]
+    matrix = logic.computeLandmarkTransform(fixedPoints, movingPoints)
+    quality = logic.computeRegistrationQuality(fixedPoints, movingPoints, matrix)
+
+    self.assertAlmostEqual(quality['fre'], logic.computeFiducialRegistrationError(fixedPoints, movingPoints, matrix))
+    for left in range(len(movingPoints)):
+      others = [index for index in range(len(movingPoints)) if index != left]
+      refit = logic.computeLandmarkTransform(fixedPoints[others], movingPoints[others])
+      predicted = refit[:3, :3].dot(movingPoints[left]) + refit[:3, 3]
+      self.assertAlmostEqual(quality['looTRE'][left], numpy.linalg.norm(predicted - fixedPoints[left]))
+    self.assertEqual(int(numpy.argmax(quality['looTRE'])), 4)
+    self.assertFalse(logic.isRegistrationQualityAcceptable(quality))
+    self.assertEqual(logic.computeRegistrationQuality(movingPoints[:3], movingPoints[:3], numpy.identity(4))['looTRE'], None)
+
+    #surface fits share the schema and are judged by their RMS distance & kept pairs alone
+    surfaceQuality = logic.createRegistrationQuality('surface', 'Rigid', [], 0.3, inlierFraction=0.95)
+    self.assertEqual(set(surfaceQuality) - set(quality), set(['inlierFraction']))
+    self.assertTrue(logic.isRegistrationQualityAcceptable(surfaceQuality))
+    surfaceQuality['inlierFraction'] = 0.5
+    self.assertFalse(logic.isRegistrationQualityAcceptable(surfaceQuality))
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleRobustFitting(self):
+    """ A misplaced landmark is rejected and the others are fitted exactly
+    """
+    self.delayDisplay("Starting the robust fitting test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    angle = numpy.radians(20)
+    rotation = numpy.array([[numpy.cos(angle), 0, numpy.sin(angle)], [0, 1, 0], [-numpy.sin(angle), 0, numpy.cos(angle)]])
+    movingPoints = numpy.array([[0, 0, 0], [10, 0, 0], [0, 12, 0], [0, 0, 8], [6, 6, 6], [-4, 3, 1], [3, -5, 2]], dtype=float)
+    fixedPoints = movingPoints.dot(rotation.T) + [1.0, 2.0, 3.0]
+    fixedPoints[2] += [0.0, 0.0, 6.0]
+
+    matrix, inlierMask = logic.computeRobustLandmarkTransform(fixedPoints, movingPoints, inlierThreshold=0.5)
+    self.assertEqual(list(numpy.nonzero(~inlierMask)[0]), [2])
+    self.assertTrue(numpy.allclose(matrix[:3, :3], rotation))
+    self.assertTrue(numpy.allclose(matrix[:3, 3], [1.0, 2.0, 3.0]))
+
+    #Cochlea protocol: 4 landmarks, one misplaced
+    matrix, inlierMask = logic.computeRobustLandmarkTransform(fixedPoints[[0, 1, 2, 3]], movingPoints[[0, 1, 2, 3]], inlierThreshold=0.5)
+    self.assertEqual(list(inlierMask), [True, True, False, True])
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleOutOfCoreCrop(self):
+    """ Resampling a file slab by slab under a small memory budget matches the in memory
+    resampling
+    """
+    self.delayDisplay("Starting the out-of-core crop test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    voxels = numpy.random.RandomState(0).randint(0, 1000, (40, 50, 60)).astype(numpy.int16)
+    ijkToRAS = numpy.diag([0.5, 0.5, 0.5, 1.0])
+    ijkToRAS[:3, 3] = [-10, -12, -8]
+    inputPath = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleOutOfCoreInput.nrrd')
+    outputPath = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleOutOfCoreOutput.nrrd')
+    logic.writeNrrd(inputPath, voxels, ijkToRAS)
+
+    angle = numpy.radians(15)
+    transformToWorld = numpy.identity(4)
+    transformToWorld[:3, :3] = [[numpy.cos(angle), -numpy.sin(angle), 0], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]]
+    transformToWorld[:3, 3] = [1, 2, 0.5]
+    roiBounds = [-5, 5, -6, 4, -3, 3]
+    logic.runAlignCropVolumeFromFile(roiBounds, inputPath, outputPath, transformToWorld, memoryBudgetMB=0.2)
+
+    outputArray, outputIJKToRAS = logic.openNrrdArray(outputPath)
+    outputShape, expectedIJKToRAS = logic.computeROIOutputGeometry(roiBounds, [0.5, 0.5, 0.5])
+    expected = logic.resampleArray(voxels, numpy.linalg.inv(transformToWorld.dot(ijkToRAS)).dot(expectedIJKToRAS), outputShape)
+    self.assertTrue(numpy.array_equal(numpy.asarray(outputArray), expected))
+    self.assertTrue(numpy.allclose(outputIJKToRAS, expectedIJKToRAS))
+    del outputArray
+    os.remove(outputPath)
+
+    #a cancelled compressed crop leaves neither its raw intermediate nor a partial output
+    cancelEvent = threading.Event()
+    cancelEvent.set()
+    with self.assertRaises(AlignCrop3DSlicerModuleCancelledError):
+      logic.runAlignCropVolumeFromFile(roiBounds, inputPath, outputPath, transformToWorld, memoryBudgetMB=0.2,
+                                       cancelEvent=cancelEvent, encoding='gzip', outputType='uint8', rescaleRange=[0, 1000])
+    self.assertFalse(os.path.exists(outputPath))
+    self.assertFalse(os.path.exists(outputPath + '.raw.nrrd'))
+    os.remove(inputPath)
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleResampleMemoryBudget(self):
+    """ The peak memory of a rotated out-of-core crop stays within its memory budget
+    """
+    self.delayDisplay("Starting the resample memory budget test")
+    import tracemalloc
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    voxels = numpy.random.RandomState(0).randint(0, 1000, (120, 120, 120)).astype(numpy.int16)
+    inputPath = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleMemoryBudgetInput.nrrd')
+    outputPath = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleMemoryBudgetOutput.nrrd')
+    logic.writeNrrd(inputPath, voxels, numpy.diag([0.5, 0.5, 0.5, 1.0]))
+    del voxels
+
+    #rotated about all axes so every slab reads an input region larger than itself
+    transformToWorld = logic.computeRigidParameterMatrix([0.3, -0.2, 0.5, 1.0, 2.0, 0.5], [30, 30, 30])
+    memoryBudgetMB = 4
+    for encoding in ['raw', 'gzip']:
+      tracemalloc.start()
+      try:
+        logic.runAlignCropVolumeFromFile([12, 48, 12, 48, 12, 48], inputPath, outputPath, transformToWorld,
+                                         memoryBudgetMB=memoryBudgetMB, encoding=encoding)
+        peak = tracemalloc.get_traced_memory()[1]
+      finally:
+        tracemalloc.stop()
+      self.assertTrue(peak <= memoryBudgetMB * 1024 * 1024)
+      os.remove(outputPath)
+    os.remove(inputPath)
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleCompressedWriter(self):
+    """ Chunks compressed on threads form a gzip encoded NRRD file Slicer reads back
+    """
+    self.delayDisplay("Starting the compressed writer test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    voxels = (numpy.arange(30 * 40 * 50) % 700).astype(numpy.int16).reshape(30, 40, 50)
+    ijkToRAS = numpy.diag([-0.25, -0.25, 0.5, 1.0])
+    outputPath = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleCompressed.nrrd')
+    logic.writeNrrd(outputPath, voxels, ijkToRAS, slabMemoryMB=1, encoding='gzip', threads=4)
+    self.assertEqual(logic.readNrrdHeader(outputPath)['encoding'], 'gzip')
+
+    volume = slicer.util.loadVolume(outputPath)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(volume), voxels))
+    self.assertTrue(numpy.allclose(logic.getVolumeIJKToRAS(volume), ijkToRAS))
+    os.remove(outputPath)
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleOutputType(self):
+    """ Down-cast crops rescale the intensity range onto the output type and count
+    the clipped voxels, the input type is kept by default
+    """
+    self.delayDisplay("Starting the output type test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    voxels = (numpy.arange(20 * 30 * 40) % 2000 - 500).astype(numpy.int16).reshape(20, 30, 40)
+    volume, volumeArray = logic.createVolumeNode('Input', voxels.shape, voxels.dtype, numpy.identity(4))
+    volumeArray[...] = voxels
+    volume.GetImageData().Modified()
+    roiBounds = [5, 15, 6, 18, 4, 12]
+
+    croppedVolume = logic.runCropVolumeArray(roiBounds, volume)
+    self.assertEqual(slicer.util.arrayFromVolume(croppedVolume).dtype, numpy.int16)
+
+    croppedVolume = logic.runCropVolumeArray(roiBounds, volume, outputType='uint8')
+    castStats = logic.getCastStats(croppedVolume)
+    croppedArray = slicer.util.arrayFromVolume(croppedVolume)
+    self.assertEqual(croppedArray.dtype, numpy.uint8)
+    self.assertEqual((croppedArray.min(), croppedArray.max()), (0, 255))
+    self.assertEqual(castStats['clippedFraction'], 0.0)
+
+    #int16 output of int16 input keeps the intensities (HU) unless a rescale range is given
+    croppedVolume = logic.runCropVolumeArray(roiBounds, volume, outputType='int16')
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(croppedVolume), voxels[4:12, 6:18, 5:15]))
+    self.assertNotIn('inputRange', logic.getCastStats(croppedVolume))
+    #a down-cast needs a range, given or computed from the voxels
+    self.assertRaises(ValueError, logic.prepareOutputCast, numpy.int16, 'uint8')
+    self.assertEqual(logic.prepareOutputCast(numpy.uint8, 'int16')[1], None)
+
+    croppedVolume = logic.runCropVolumeArray(roiBounds, volume, outputType='uint8', rescaleRange=(0, 1000))
+    castStats = logic.getCastStats(croppedVolume)
+    source = voxels[4:12, 6:18, 5:15]
+    expected = numpy.clip(numpy.rint(source * 0.255), 0, 255)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(croppedVolume), expected))
+    self.assertEqual(castStats['clippedLow'], numpy.count_nonzero(source < 0))
+    self.assertEqual(castStats['clippedHigh'], numpy.count_nonzero(source * 0.255 > 255.5))
+
+    #resampled crops are cast slab by slab
+    transform = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transform)
+    volume.SetAndObserveTransformNodeID(transform.GetID())
+    roi = slicer.vtkMRMLAnnotationROINode()
+    slicer.mrmlScene.AddNode(roi)
+    roi.SetXYZ(10, 12, 8)
+    roi.SetRadiusXYZ(5, 6, 4)
+    reference = slicer.util.arrayFromVolume(logic.runAlignCropVolume(roi, volume)).astype(float)
+    croppedVolume = logic.runAlignCropVolume(roi, volume, outputType='int16', rescaleRange=(-500, 1499))
+    castStats = logic.getCastStats(croppedVolume)
+    croppedArray = slicer.util.arrayFromVolume(croppedVolume)
+    self.assertEqual(croppedArray.dtype, numpy.int16)
+    self.assertEqual(castStats['clippedFraction'], 0.0)
+    #the reference is rounded to the input type before rescaling
+    expected = reference * castStats['scale'] + castStats['offset']
+    self.assertTrue(numpy.abs(croppedArray - expected).max() <= castStats['scale'] / 2.0 + 1.0)
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleIsotropicCrop(self):
+    """ Crops resampled to an isotropic spacing in the same pass interpolate the
+    input voxels (exactly for a linear ramp)
+    """
+    self.delayDisplay("Starting the isotropic crop test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    k, j, i = numpy.mgrid[0:20, 0:30, 0:40]
+    ijkToRAS = numpy.diag([0.5, 0.5, 1.0, 1.0])
+    volume, volumeArray = logic.createVolumeNode('Input', k.shape, numpy.float32, ijkToRAS)
+    volumeArray[...] = 2 * i + 3 * j + 5 * k
+    volume.GetImageData().Modified()
+
+    roi = slicer.vtkMRMLAnnotationROINode()
+    slicer.mrmlScene.AddNode(roi)
+    roi.SetXYZ(7.5, 7.5, 9.5)
+    roi.SetRadiusXYZ(4.5, 3.5, 4.5)
+
+    croppedVolume = logic.runCropVolume(roi, volume, isotropic=True)
+    self.assertTrue(numpy.allclose(croppedVolume.GetSpacing(), [0.5, 0.5, 0.5]))
+
+    croppedVolume = logic.runCropVolume(roi, volume, spacing=0.25)
+    self.assertTrue(numpy.allclose(croppedVolume.GetSpacing(), [0.25, 0.25, 0.25]))
+    croppedArray = slicer.util.arrayFromVolume(croppedVolume)
+    ck, cj, ci = numpy.mgrid[0:croppedArray.shape[0], 0:croppedArray.shape[1], 0:croppedArray.shape[2]]
+    points = numpy.stack([ci.ravel(), cj.ravel(), ck.ravel(), numpy.ones(ci.size)])
+    inputIJK = numpy.linalg.inv(ijkToRAS).dot(logic.getVolumeIJKToRAS(croppedVolume)).dot(points)
+    expected = (2 * inputIJK[0] + 3 * inputIJK[1] + 5 * inputIJK[2]).reshape(croppedArray.shape)
+    self.assertTrue(numpy.allclose(croppedArray, expected, atol=1e-3))
+
+    self.assertRaises(ValueError, logic.runCropVolume, roi, volume, spacing=[0.25, 0.25, 0.5], interpolation='sinc')
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleLandmarkProposal(self):
+    """ Atlas landmarks are found by template matching in a shifted input with a different
+    spacing and pre-filled into the moving fiducials
+    """
+    self.delayDisplay("Starting the landmark proposal test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    template, structure, templateIJKToRAS = self.createStructureTemplate(logic)
+
+    shift = numpy.array([2.3, -1.7, 1.4])
+    inputIJKToRAS = numpy.diag([0.4, 0.4, 0.4, 1.0])
+    inputIJKToRAS[:3, 3] = [-2, -3, -1]
+    shiftMatrix = numpy.identity(4)
+    shiftMatrix[:3, 3] = -shift
+    volume, volumeArray = logic.createVolumeNode('Input', (80, 80, 80), numpy.float32, inputIJKToRAS)
+    logic.resampleArray(structure, numpy.linalg.inv(templateIJKToRAS).dot(shiftMatrix).dot(inputIJKToRAS), volumeArray.shape,
+                        outputArray=volumeArray)
+    volume.GetImageData().Modified()
+
+    points = numpy.array([[8, 9, 10], [20, 14, 18], [11, 22, 14], [17, 18, 8]], dtype=float)
+    templateFiducial = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(templateFiducial)
+    for point in points:
+      templateFiducial.AddFiducialFromArray(point)
+
+    proposals = logic.proposeLandmarks(volume, template, templateFiducial, levels=2)
+    self.assertEqual([proposal['key'] for proposal in proposals], logic.landmarkOrderCO)
+    for proposal, point in zip(proposals, points):
+      self.assertTrue(numpy.linalg.norm(numpy.array(proposal['position']) - point - shift) < 0.2)
+      self.assertTrue(proposal['score'] > 0.9)
+
+    movingFiducial = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(movingFiducial)
+    proposals[1]['score'] = 0.1
+    placementChecklist = logic.applyLandmarkProposals(movingFiducial, proposals, minimumScore=0.5)
+    self.assertEqual(placementChecklist, {'OW': True, 'CN': False, 'A': True, 'RW': True})
+    self.assertEqual(movingFiducial.GetNumberOfFiducials(), 3)
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleSurfaceAlignment(self):
+    """ A rotated & shifted input is aligned to the template by its thresholded surface,
+    with none and with one placed landmark
+    """
+    self.delayDisplay("Starting the surface alignment test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    #Ellipsoid with a ball & a bar, so the surface has a unique orientation
+    def createShape(name, shape, ijkToRAS, worldFromVolume):
+      volume, volumeArray = logic.createVolumeNode(name, shape, numpy.float32, ijkToRAS)
+      k, j, i = numpy.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
+      x, y, z = worldFromVolume.dot(ijkToRAS).dot(numpy.stack([i.ravel(), j.ravel(), k.ravel(), numpy.ones(i.size)]))[:3]
+      inside = ((((x - 15) / 9) ** 2 + ((y - 15) / 6) ** 2 + ((z - 15) / 5) ** 2 < 1) |
+                ((x - 22) ** 2 + (y - 22) ** 2 + (z - 12) ** 2 < 9) |
+                ((abs(x - 10) < 1.5) & (abs(y - 8) < 6) & (abs(z - 20) < 2)))
+      volumeArray[...] = (inside * 1000.0 + 100).reshape(shape)
+      volume.GetImageData().Modified()
+      return volume
+
+    angle = numpy.radians(10)
+    expected = numpy.identity(4)
+    expected[:3, :3] = [[numpy.cos(angle), -numpy.sin(angle), 0], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]]
+    expected[:3, 3] = [2, -3, 1.5]
+    template = createShape('Template', (60, 60, 60), numpy.diag([0.5, 0.5, 0.5, 1.0]), numpy.identity(4))
+    inputIJKToRAS = numpy.diag([0.4, 0.4, 0.4, 1.0])
+    inputIJKToRAS[:3, 3] = [-3, 0, 2]
+    volume = createShape('Input', (80, 80, 80), inputIJKToRAS, expected)
+
+    templateFiducial = slicer.vtkMRMLMarkupsFiducialNode()
+    movingFiducial = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(templateFiducial)
+    slicer.mrmlScene.AddNode(movingFiducial)
+    templateFiducial.AddFiducialFromArray([15, 15, 15])
+    movingFiducial.AddFiducialFromArray(numpy.linalg.inv(expected).dot([15, 15, 15, 1])[:3])
+
+    centre = numpy.linalg.inv(expected).dot([15, 15, 15, 1])
+    for placementChecklist in [dict((key, False) for key in logic.landmarkOrderCO),
+                               dict((key, key == 'OW') for key in logic.landmarkOrderCO)]:
+      transform = slicer.vtkMRMLTransformNode()
+      slicer.mrmlScene.AddNode(transform)
+      matrix = logic.runSurfaceRegistration(transform, template, volume, templateFiducial, movingFiducial,
+                                            placementChecklist, maxPoints=1500)
+      rotation = matrix[:3, :3].dot(expected[:3, :3].T)
+      self.assertTrue(numpy.degrees(numpy.arccos(min(1.0, (numpy.trace(rotation) - 1) / 2))) < 2.0)
+      self.assertTrue(numpy.linalg.norm(matrix.dot(centre) - expected.dot(centre)) < 0.25)
+      quality = logic.getRegistrationQuality(transform)
+      self.assertEqual(quality['method'], 'surface')
+      self.assertTrue(quality['fre'] < 0.5)
+      self.assertIsNone(quality['conditionNumber'])
+      self.assertTrue(logic.isRegistrationQualityAcceptable(quality))
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleIntensityRefinement(self):
+    """ A slightly misaligned landmark transform is refined by the intensities inside the ROI,
+    with both similarity metrics
+    """
+    self.delayDisplay("Starting the intensity refinement test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    template, structure, templateIJKToRAS = self.createStructureTemplate(logic)
+
+    expected = logic.computeRigidParameterMatrix(numpy.radians([0, 0, 5]).tolist() + [0.7, -0.4, 0.3], [0, 0, 0])
+    inputIJKToRAS = numpy.diag([0.4, 0.4, 0.4, 1.0])
+    inputIJKToRAS[:3, 3] = [-2, -3, -1]
+    volume, volumeArray = logic.createVolumeNode('Input', (90, 90, 90), numpy.float32, inputIJKToRAS)
+    logic.resampleArray(structure, numpy.linalg.inv(templateIJKToRAS).dot(expected).dot(inputIJKToRAS), volumeArray.shape,
+                        outputArray=volumeArray)
+    volume.GetImageData().Modified()
+
+    roiBounds = [6, 26, 6, 26, 6, 26]
+    centre = numpy.array([16, 16, 16, 1])
+    misaligned = logic.computeRigidParameterMatrix([0.01, -0.015, 0.012, 0.5, -0.4, 0.3], centre[:3]).dot(expected)
+    #Landmarks placed exactly, so the refined residuals are smaller than those of the misaligned fit
+    movingPoints = numpy.array([[10, 12, 14], [20, 12, 14], [10, 22, 14], [10, 12, 22]], dtype=float)
+    templateFiducial, movingFiducial = slicer.vtkMRMLMarkupsFiducialNode(), slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(templateFiducial)
+    slicer.mrmlScene.AddNode(movingFiducial)
+    for point in movingPoints:
+      templateFiducial.AddFiducialFromArray(expected.dot(list(point) + [1.0])[:3])
+      movingFiducial.AddFiducialFromArray(point)
+    placementChecklist = dict((key, True) for key in logic.landmarkOrderCO)
+    for metric in logic.refinementMetrics:
+      transform = slicer.vtkMRMLTransformNode()
+      slicer.mrmlScene.AddNode(transform)
+      logic.setTransformMatrix(transform, misaligned)
+      logic.updateRegistrationQuality(transform, templateFiducial, movingFiducial, placementChecklist)
+      matrix = logic.runIntensityRefinement(transform, template, volume, roiBounds, metric=metric,
+                                            fixedFiducial=templateFiducial, movingFiducial=movingFiducial,
+                                            placementChecklist=placementChecklist)
+      self.assertTrue(numpy.linalg.norm(matrix.dot(numpy.linalg.inv(expected)).dot(centre) - centre) < 0.1)
+      rotation = matrix[:3, :3].dot(expected[:3, :3].T)
+      self.assertTrue(numpy.degrees(numpy.arccos(min(1.0, (numpy.trace(rotation) - 1) / 2))) < 0.3)
+      quality = logic.getRegistrationQuality(transform)
+      refinement = quality['refinement']
+      self.assertTrue(refinement['accepted'])
+      self.assertTrue(refinement['finalValue'] > refinement['initialValue'])
+      self.assertEqual(refinement['landmarkMetrics'], 'refined')
+      self.assertTrue(quality['fre'] < 0.1 < refinement['landmarkFit']['fre'])
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleForegroundROI(self):
+    """ The foreground ROI is the voxel aligned bounding box of the thresholded template plus
+    the margin, and is restored from the atlas cache
+    """
+    self.delayDisplay("Starting the foreground ROI test")
+    logic = AlignCrop3DSlicerModuleLogic()
+    cacheDirectory = os.path.join(slicer.app.temporaryPath, 'AlignCrop3DSlicerModuleForegroundTest')
+    cache = AlignCrop3DSlicerModuleAtlasCache(cacheDirectory)
+    cache.clear()
+
+    ijkToRAS = numpy.diag([0.5, 0.5, 0.5, 1.0])
+    ijkToRAS[:3, 3] = [1, 2, 3]
+    template, templateArray = logic.createVolumeNode('Template', (100, 120, 140), numpy.int16, ijkToRAS)
+    templateArray[...] = 10
+    templateArray[20:40, 30:70, 50:60] = 1000
+    template.GetImageData().Modified()
+
+    self.assertEqual(logic.computeForegroundExtent(template, threshold=500, margin=0.0), [[50, 60], [30, 70], [20, 40]])
+    roi = logic.runDefineCropROIVoxel(template, cache=cache, mode='foreground', margin=1.0)
+    roiBounds = logic.getROIBounds(roi)
+    self.assertTrue(numpy.allclose(roiBounds, [24.75, 31.75, 15.75, 37.75, 11.75, 23.75]))
+    self.assertTrue(logic.isROIVoxelAligned(roiBounds, ijkToRAS))
+
+    cachedROI = logic.runDefineCropROIVoxel(template, cache=cache, mode='foreground', margin=1.0)
+    self.assertTrue(numpy.allclose(logic.getROIBounds(cachedROI), roiBounds))
+    self.assertEqual(list(cache.getEntry(template)['foregroundROIs'].values()), [roiBounds])
+    self.assertFalse(cache.getROIBounds(template))
+
+    croppedVolume = logic.runCropVolume(roi, template)
+    self.assertEqual(slicer.util.arrayFromVolume(croppedVolume).shape, (24, 44, 14))
+    cache.clear()
+    self.delayDisplay('Test passed!')
+
+  def test_AlignCrop3DSlicerModuleCoCrop(self):
+    """ A label map & a segmentation of a transformed volume are cropped with exactly its
+    geometry, nearest neighbour, in one call
+    """
+    self.delayDisplay("Starting the co-cropping test")
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    ijkToRAS = numpy.diag([0.5, 0.5, 0.5, 1.0])
+    volume, volumeArray = logic.createVolumeNode('Input', (40, 40, 40), numpy.int16, ijkToRAS)
+    volumeArray[...] = numpy.arange(volumeArray.size).reshape(volumeArray.shape) % 1000
+    volume.GetImageData().Modified()
+    labelmap, labelArray = logic.createVolumeNode('Labels', (40, 40, 40), numpy.uint8, ijkToRAS, 'vtkMRMLLabelMapVolumeNode')
+    labelArray[...] = 0
+    labelArray[10:20, 10:30, 5:15] = 1
+    labelArray[22:30, 12:18, 20:34] = 2
+    labelmap.GetImageData().Modified()
+    segmentation = slicer.vtkMRMLSegmentationNode()
+    slicer.mrmlScene.AddNode(segmentation)
+    segmentation.CreateDefaultDisplayNodes()
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap, segmentation)
+
+    transform = slicer.vtkMRMLTransformNode()
+    slicer.mrmlScene.AddNode(transform)
+    logic.setTransformMatrix(transform, logic.computeRigidParameterMatrix([0, 0, 0.2, 1.0, -0.5, 0], [10, 10, 10]))
+    for node in [volume, labelmap, segmentation]:
+      node.SetAndObserveTransformNodeID(transform.GetID())
+    roi = slicer.vtkMRMLAnnotationROINode()
+    slicer.mrmlScene.AddNode(roi)
+    roi.SetXYZ([10, 10, 8])
+    roi.SetRadiusXYZ([6, 7, 5])
+
+    croppedVolume, croppedNodes = logic.runCropVolumeGroup(roi, volume, [labelmap, segmentation], interpolation='linear')
+    self.assertEqual(logic.getAssociatedCrops(croppedVolume), croppedNodes)
+    croppedLabels = slicer.util.arrayFromVolume(croppedNodes[0])
+    self.assertTrue(croppedNodes[0].IsA('vtkMRMLLabelMapVolumeNode'))
+    self.assertEqual(croppedLabels.shape, slicer.util.arrayFromVolume(croppedVolume).shape)
+    self.assertTrue(numpy.allclose(logic.getVolumeIJKToRAS(croppedNodes[0]), logic.getVolumeIJKToRAS(croppedVolume)))
+    self.assertEqual(set(numpy.unique(croppedLabels)), set([0, 1, 2]))
+
+    #Same voxels as a separate nearest neighbour crop of the label map
+    separateLabels = slicer.util.arrayFromVolume(logic.runAlignCropVolume(roi, labelmap, interpolation='nearest'))
+    self.assertTrue(numpy.array_equal(croppedLabels, separateLabels))
+
+    self.assertTrue(croppedNodes[1].IsA('vtkMRMLSegmentationNode'))
+    self.assertEqual(croppedNodes[1].GetSegmentation().GetNumberOfSegments(), 2)
+    self.assertEqual(croppedNodes[1].GetSegmentation().GetNthSegment(0).GetName(),
+                     segmentation.GetSegmentation().GetNthSegment(0).GetName())
+
+    #A hardened volume is cropped with the labels still under the alignment transform
+    slicer.vtkSlicerTransformLogic().hardenTransform(volume)
+    hardenedVolume, hardenedNodes = logic.runCropVolumeGroup(roi, volume, [labelmap], interpolation='linear')
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(hardenedNodes[0]), separateLabels))
+    self.assertTrue(numpy.allclose(logic.getVolumeIJKToRAS(hardenedNodes[0]), logic.getVolumeIJKToRAS(hardenedVolume)))
+    self.assertTrue(numpy.abs(slicer.util.arrayFromVolume(hardenedVolume).astype(int) -
+                              slicer.util.arrayFromVolume(croppedVolume)).max() <= 1)
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,417 @@
+"""
+Headless batch align & crop of many cases against one atlas/template.
+
+Driver (any python, launches one Slicer worker process per case):
+
+    python AlignCrop3DSlicerModuleLib/BatchAlignCrop.py --slicer /path/to/Slicer
+        --manifest cases.csv --atlas atlas.nrrd --atlas-landmarks atlas.fcsv
+        --output-dir results --workers 8
+
+The manifest is a CSV file with the columns
+    case, volume, landmarks [, skip] [, labels]
+where landmarks is a markups fiducial file with the placed landmarks in protocol
+order, skip an optional ';' separated list of skipped landmark keys
+(e.g. 'CN' or 'SF;PSC') and labels an optional ';' separated list of label map or
+segmentation (.seg.nrrd) files of the volume, which are aligned & cropped with exactly
+its geometry in the same pass (written as <case>_<label file>_cropped.nrrd / .seg.nrrd).
+Relative paths are resolved against the manifest folder.
+Cases with fewer than 3 placed landmarks are aligned by their bone surfaces (thresholded
+at --surface-threshold, Otsu by default) instead. With --refine ncc/mi the alignment is
+refined by the intensities inside the template ROI (normalized correlation or mutual information).
+With --roi-mode foreground the template ROI is the bounding box of the atlas voxels above
+--roi-threshold (Otsu by default) plus --roi-margin, instead of the whole atlas.
+
+Each case is processed by
+    Slicer --no-splash --no-main-window --python-script AlignCrop3DSlicerModuleLib/BatchAlignCrop.py --worker ...
+which writes <case>_cropped.nrrd, <case>_transform.h5 and <case>_result.json into the
+output folder. The driver collects the per-case results into report.jsonl & report.csv
+with the registration quality of every case (fiducial registration error, leave-one-out
+target registration error, condition number); cases exceeding the --max-* limits are flagged
+(and with --profile the per-stage timings of all cases into profile.jsonl).
+With --out-of-core the case volumes (uncompressed NRRD files) are never loaded: only the
+landmarks are registered and the cropped region is resampled slab by slab from the memory
+mapped file, within --memory-budget-mb.
+Cropped volumes are written with --encoding gzip (compressed on --write-threads cores,
+the cores per worker by default, at --compression-level) or raw (uncompressed, fastest for scratch storage).
+With --output-type uint8/int16 the cropped intensities (--rescale-range, the range of the
+cropped region by default) are rescaled onto a smaller type; clipped voxels are reported.
+Input types that fit into the output type (e.g. int16 CT, in HU) are not rescaled
+unless --rescale-range is given.
+With --spacing the cropped region is resampled to an isotropic spacing (--interpolation)
+in the same pass, so no separate resampling of the cropped volumes is needed.
+Data derived from the atlas (template ROI, landmarks) is computed by the first worker
+and shared with the others through the atlas cache in --cache-dir.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import traceback
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+REPORT_FIELDS = [ 'case', 'status', 'flagged', 'fre', 'maxLooTRE', 'conditionNumber', 'rejected', 'elapsedSeconds',
+                  'outputType', 'clippedFraction', 'output', 'transform', 'error' ]
+
+#
+# Driver
+#
+
+def readManifest(manifestPath):
+    """Reads the case manifest, returns a list of case dictionaries with absolute paths
+    """
+    manifestDir = os.path.dirname(os.path.abspath(manifestPath))
+    cases = []
+    with open(manifestPath) as manifestFile:
+        for row in csv.DictReader(manifestFile):
+            row = dict((key.strip(), (value or '').strip()) for key, value in row.items() if key)
+            for key in ('volume', 'landmarks'):
+                if not os.path.isabs(row[key]):
+                    row[key] = os.path.join(manifestDir, row[key])
+            row['skip'] = [key for key in row.get('skip', '').split(';') if key]
+            row['labels'] = [path if os.path.isabs(path) else os.path.join(manifestDir, path)
+                             for path in row.get('labels', '').split(';') if path]
+            if not row.get('case'):
+                row['case'] = os.path.splitext(os.path.basename(row['volume']))[0]
+            cases.append(row)
+    return cases
+
+def runCaseProcess(case, args):
+    """Runs one case in its own Slicer process & returns its result dictionary
+    """
+    resultPath = os.path.join(args.output_dir, case['case'] + '_result.json')
+    if os.path.exists(resultPath):
+        os.remove(resultPath)
+
+    command = [ args.slicer, '--no-splash', '--no-main-window',
+                '--python-script', os.path.abspath(__file__),
+                '--worker',
+                '--case', case['case'],
+                '--volume', case['volume'],
+                '--landmarks', case['landmarks'],
+                '--skip', ';'.join(case['skip']),
+                '--labels', ';'.join(case['labels']),
+                '--atlas', args.atlas,
+                '--atlas-landmarks', args.atlas_landmarks,
+                '--transform-type', args.transform_type,
+                '--output-dir', args.output_dir ]
+    if args.profile:
+        command.append('--profile')
+    command += [ '--encoding', args.encoding, '--compression-level', str(args.compression_level),
+                 '--write-threads', str(args.write_threads), '--output-type', args.output_type ]
+    if args.rescale_range:
+        command += ['--rescale-range'] + [str(value) for value in args.rescale_range]
+    if args.spacing:
+        command += ['--spacing', str(args.spacing)]
+    command += ['--interpolation', args.interpolation]
+    if args.out_of_core:
+        command += ['--out-of-core', '--memory-budget-mb', str(args.memory_budget_mb)]
+    if args.robust:
+        command += ['--robust', '--inlier-threshold', str(args.inlier_threshold)]
+    if args.surface_threshold is not None:
+        command += ['--surface-threshold', str(args.surface_threshold)]
+    if args.refine:
+        command += ['--refine', args.refine]
+    command += ['--roi-mode', args.roi_mode, '--roi-margin', str(args.roi_margin)]
+    if args.roi_threshold is not None:
+        command += ['--roi-threshold', str(args.roi_threshold)]
+    command += [ '--max-fre', str(args.max_fre), '--max-loo-tre', str(args.max_loo_tre),
+                 '--max-condition-number', str(args.max_condition_number),
+                 '--min-inlier-fraction', str(args.min_inlier_fraction) ]
+    if args.cache_dir:
+        command += ['--cache-dir', args.cache_dir, '--cache-size-mb', str(args.cache_size_mb)]
+
+    startTime = time.time()
+    logPath = os.path.join(args.output_dir, case['case'] + '_log.txt')
+    with open(logPath, 'w') as logFile:
+        process = subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT)
+        timer = None
+        if args.timeout > 0:
+            timer = threading.Timer(args.timeout, process.kill)
+            timer.start()
+        process.wait()
+        if timer:
+            timer.cancel()
+
+    if os.path.exists(resultPath):
+        with open(resultPath) as resultFile:
+            result = json.load(resultFile)
+    else:
+        result = {'case': case['case'], 'status': 'failed',
+                  'error': 'worker exited with code %s without a result, see %s' % (process.returncode, logPath)}
+    result['elapsedSeconds'] = round(time.time() - startTime, 3)
+    return result
+
+def writeReport(results, outputDir):
+    """Writes the per-case results as JSON lines & CSV
+    """
+    with open(os.path.join(outputDir, 'report.jsonl'), 'w') as reportFile:
+        for result in results:
+            reportFile.write(json.dumps(result, sort_keys=True) + '\n')
+
+    with open(os.path.join(outputDir, 'report.csv'), 'w') as reportFile:
+        writer = csv.DictWriter(reportFile, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+def collectProfiles(results, outputDir):
+    """Concatenates the per-case stage timings into profile.jsonl
+    """
+    with open(os.path.join(outputDir, 'profile.jsonl'), 'w') as profileFile:
+        for result in results:
+            casePath = os.path.join(outputDir, result['case'] + '_profile.jsonl')
+            if os.path.exists(casePath):
+                with open(casePath) as caseFile:
+                    profileFile.write(caseFile.read())
+
+def runDriver(args):
+    args.output_dir         = os.path.abspath(args.output_dir)
+    args.atlas              = os.path.abspath(args.atlas)
+    args.atlas_landmarks    = os.path.abspath(args.atlas_landmarks)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    cases = readManifest(args.manifest)
+    print('Processing %d cases with %d workers' % (len(cases), args.workers))
+
+    pool = ThreadPool(args.workers)
+    results = []
+    for result in pool.imap_unordered(lambda case: runCaseProcess(case, args), cases):
+        results.append(result)
+        print('[%d/%d] %s: %s%s' % (len(results), len(cases), result['case'], result['status'],
+                                    ' (flagged)' if result.get('flagged') else ''))
+    pool.close()
+    pool.join()
+
+    results.sort(key=lambda result: result['case'])
+    writeReport(results, args.output_dir)
+    if args.profile:
+        collectProfiles(results, args.output_dir)
+
+    failed = [result['case'] for result in results if result['status'] != 'completed']
+    flagged = [result['case'] for result in results if result.get('flagged')]
+    print('%d cases completed, %d failed, %d flagged for review' % (len(results) - len(failed), len(failed), len(flagged)))
+    return 1 if failed else 0
+
+#
+# Worker (runs inside Slicer)
+#
+
+def loadNode(loader, path):
+    """Calls a slicer.util loader & returns the loaded node on all Slicer versions
+    """
+    result = loader(path, returnNode=True)
+    if isinstance(result, tuple):
+        success, result = result
+        if not success:
+            result = None
+    if result is None:
+        raise IOError('Failed to load %s' % path)
+    return result
+
+def isSegmentationFile(path):
+    """Segmentation files (.seg.nrrd, .seg.nhdr), anything else is loaded as a label map
+    """
+    return os.path.basename(path).lower().split('.', 1)[-1] in ('seg.nrrd', 'seg.nhdr')
+
+def runWorker(args):
+    import slicer
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from AlignCrop3DSlicerModule import AlignCrop3DSlicerModuleLogic, AlignCrop3DSlicerModuleProfiler, AlignCrop3DSlicerModuleAtlasCache
+
+    if args.profile:
+        profilePath = os.path.join(args.output_dir, args.case + '_profile.jsonl')
+        if os.path.exists(profilePath):
+            os.remove(profilePath)
+        AlignCrop3DSlicerModuleProfiler.enable(profilePath, args.case)
+
+    result = {'case': args.case, 'status': 'failed'}
+    try:
+        logic = AlignCrop3DSlicerModuleLogic()
+        cache = AlignCrop3DSlicerModuleAtlasCache(args.cache_dir, args.cache_size_mb) if args.cache_dir else None
+
+        templateVolume      = loadNode(slicer.util.loadVolume, args.atlas)
+        templateFiducial    = loadNode(slicer.util.loadMarkupsFiducialList, args.atlas_landmarks)
+        movingFiducial      = loadNode(slicer.util.loadMarkupsFiducialList, args.landmarks)
+
+        #Placement checklist of the protocol matching the atlas landmarks
+        if templateFiducial.GetNumberOfFiducials() == len(logic.landmarkOrderCO):
+            order = logic.landmarkOrderCO
+        else:
+            order = logic.landmarkOrderTB
+        skipped = [key for key in args.skip.split(';') if key]
+        unknown = [key for key in skipped if key not in order]
+        if unknown:
+            raise ValueError('Unknown landmark keys %s, expected one of %s' % (unknown, order))
+        placementChecklist = dict((key, key not in skipped) for key in order)
+
+        outputPath      = os.path.join(args.output_dir, args.case + '_cropped.nrrd')
+        transformPath   = os.path.join(args.output_dir, args.case + '_transform.h5')
+        labelPaths = [path for path in args.labels.split(';') if path]
+        if args.out_of_core:
+            if labelPaths:
+                raise ValueError('Label maps & segmentations are cropped from the loaded volume, '
+                                 'process the case without --out-of-core')
+            if sum(1 for placed in placementChecklist.values() if placed) < 3:
+                raise ValueError('Surface alignment (fewer than 3 landmarks) needs the volume loaded, '
+                                 'process the case without --out-of-core')
+            transform = slicer.vtkMRMLTransformNode()
+            slicer.mrmlScene.AddNode(transform)
+            logic.runAlignmentRegistration(transform, templateFiducial, movingFiducial, placementChecklist,
+                                           transformType=args.transform_type,
+                                           robust=args.robust, inlierThreshold=args.inlier_threshold)
+            templateROI = logic.runDefineCropROIVoxel(templateVolume, cache=cache, mode=args.roi_mode,
+                                                      threshold=args.roi_threshold, margin=args.roi_margin)
+            castStats = {}
+            logic.runAlignCropVolumeFromFile(templateROI, args.volume, outputPath, logic.getTransformToWorldMatrix(transform),
+                                             memoryBudgetMB=args.memory_budget_mb, encoding=args.encoding,
+                                             compressionLevel=args.compression_level, outputType=args.output_type,
+                                             rescaleRange=args.rescale_range, castStats=castStats,
+                                             spacing=args.spacing, interpolation=args.interpolation,
+                                             threads=args.write_threads)
+        else:
+            inputVolume = loadNode(slicer.util.loadVolume, args.volume)
+            associatedNodes = [loadNode(slicer.util.loadSegmentation, path) if isSegmentationFile(path)
+                               else loadNode(slicer.util.loadLabelVolume, path) for path in labelPaths]
+            transform, croppedVolume = logic.runAlignCropCase(inputVolume, movingFiducial, templateVolume,
+                                                              templateFiducial, placementChecklist,
+                                                              transformType=args.transform_type, cache=cache,
+                                                              robust=args.robust, inlierThreshold=args.inlier_threshold,
+                                                              outputType=args.output_type, rescaleRange=args.rescale_range,
+                                                              spacing=args.spacing, interpolation=args.interpolation,
+                                                              surfaceThreshold=args.surface_threshold,
+                                                              refinementMetric=args.refine, roiMode=args.roi_mode,
+                                                              roiThreshold=args.roi_threshold, roiMargin=args.roi_margin,
+                                                              associatedNodes=associatedNodes)
+            if croppedVolume is None:
+                raise RuntimeError('Cropping produced no output volume')
+            castStats = logic.getCastStats(croppedVolume) or {}
+            logic.saveVolume(croppedVolume, outputPath, encoding=args.encoding,
+                             compressionLevel=args.compression_level, threads=args.write_threads)
+            result['labels'] = []
+            for path, croppedNode in zip(labelPaths, logic.getAssociatedCrops(croppedVolume)):
+                labelName = os.path.basename(path).split('.')[0]
+                if croppedNode.IsA('vtkMRMLSegmentationNode'):
+                    labelPath = os.path.join(args.output_dir, '%s_%s_cropped.seg.nrrd' % (args.case, labelName))
+                    slicer.util.saveNode(croppedNode, labelPath)
+                else:
+                    labelPath = os.path.join(args.output_dir, '%s_%s_cropped.nrrd' % (args.case, labelName))
+                    logic.saveVolume(croppedNode, labelPath, encoding=args.encoding,
+                                     compressionLevel=args.compression_level, threads=args.write_threads)
+                result['labels'].append(labelPath)
+        slicer.util.saveNode(transform, transformPath)
+
+        quality = logic.getRegistrationQuality(transform)
+        result.update({ 'status'    : 'completed',
+                        'output'    : outputPath,
+                        'transform' : transformPath,
+                        'matrix'    : logic.getTransformMatrix(transform).tolist(),
+                        'quality'   : quality,
+                        'castStats' : castStats,
+                        'flagged'   : not logic.isRegistrationQualityAcceptable(quality, args.max_fre, args.max_loo_tre,
+                                                                                args.max_condition_number,
+                                                                                args.min_inlier_fraction) })
+        if quality:
+            result.update(dict((key, quality[key]) for key in ['fre', 'maxLooTRE', 'conditionNumber']))
+            result['rejected'] = ';'.join(quality['rejected'])
+        result.update(dict((key, castStats.get(key)) for key in ['outputType', 'clippedFraction']))
+    except Exception as e:
+        result['error']     = '%s: %s' % (type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+
+    with open(os.path.join(args.output_dir, args.case + '_result.json'), 'w') as resultFile:
+        json.dump(result, resultFile, indent=2, sort_keys=True)
+
+    return 0 if result['status'] == 'completed' else 1
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description='Batch align & crop of volumes to an atlas/template')
+    parser.add_argument('--worker', action='store_true', help='Process a single case (used inside Slicer)')
+    parser.add_argument('--manifest', help='CSV manifest with case, volume, landmarks [, skip] columns')
+    parser.add_argument('--slicer', default=os.environ.get('SLICER_EXECUTABLE', 'Slicer'),
+                        help='Slicer executable used for the worker processes')
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help='Number of cases processed in parallel')
+    parser.add_argument('--timeout', type=float, default=0, help='Per case timeout in seconds (0 - no timeout)')
+    parser.add_argument('--atlas', required=True, help='Atlas/template volume')
+    parser.add_argument('--atlas-landmarks', required=True, help='Atlas/template fiducials')
+    parser.add_argument('--transform-type', default='Rigid', choices=['Rigid', 'Similarity'])
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--profile', action='store_true',
+                        help='Record per stage timings & memory of each case into profile.jsonl')
+    parser.add_argument('--cache-dir', help='Atlas cache folder shared by the workers (default - no cache)')
+    parser.add_argument('--cache-size-mb', type=float, default=2048, help='Atlas cache size limit')
+    parser.add_argument('--encoding', default='gzip', choices=['gzip', 'raw'], help='Encoding of the cropped volumes')
+    parser.add_argument('--compression-level', type=int, default=1, choices=range(1, 10),
+                        help='gzip level, 1 fastest - 9 smallest')
+    parser.add_argument('--write-threads', type=int,
+                        help='Threads compressing each cropped volume (0 - all cores, default - the cores per worker)')
+    parser.add_argument('--output-type', default='input', choices=['input', 'uint8', 'int16'],
+                        help='Scalar type of the cropped volumes (input - keep the input type)')
+    parser.add_argument('--rescale-range', type=float, nargs=2, metavar=('LOW', 'HIGH'),
+                        help='Intensities mapped onto the full --output-type range (default - range of the cropped region)')
+    parser.add_argument('--spacing', type=float,
+                        help='Isotropic spacing (mm) the cropped region is resampled to (default - input spacing)')
+    parser.add_argument('--interpolation', default='linear', choices=['nearest', 'linear', 'sinc', 'bspline'],
+                        help='Interpolation of resampled crops (--out-of-core - nearest or linear)')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='Crop the (raw NRRD) case volumes from disk without loading them')
+    parser.add_argument('--memory-budget-mb', type=float, default=1024,
+                        help='Working memory of an out-of-core crop')
+    parser.add_argument('--robust', action='store_true',
+                        help='Reject misplaced landmarks (consensus of all 3 landmark fits) before the final fit')
+    parser.add_argument('--inlier-threshold', type=float, default=1.0,
+                        help='Landmarks further than this (mm) from the consensus fit are rejected')
+    parser.add_argument('--surface-threshold', type=float,
+                        help='Bone threshold of the surface alignment of cases with fewer than 3 landmarks (default - Otsu)')
+    parser.add_argument('--refine', choices=['ncc', 'mi'],
+                        help='Refine the alignment by the intensities inside the template ROI (default - landmarks only)')
+    parser.add_argument('--roi-mode', default='volume', choices=['volume', 'foreground'],
+                        help='Template ROI - the whole atlas or the bounding box of its foreground')
+    parser.add_argument('--roi-threshold', type=float,
+                        help='Foreground threshold of --roi-mode foreground (default - Otsu)')
+    parser.add_argument('--roi-margin', type=float, default=1.0,
+                        help='Margin (mm) around the foreground of --roi-mode foreground')
+    parser.add_argument('--max-fre', type=float, default=1.0, help='Cases with a larger FRE (mm) are flagged')
+    parser.add_argument('--max-loo-tre', type=float, default=2.0,
+                        help='Cases with a larger leave-one-out TRE (mm) are flagged')
+    parser.add_argument('--max-condition-number', type=float, default=100.0,
+                        help='Cases with a worse conditioned landmark configuration are flagged')
+    parser.add_argument('--min-inlier-fraction', type=float, default=0.8,
+                        help='Surface aligned cases keeping fewer surface point pairs are flagged')
+    #worker only
+    parser.add_argument('--case')
+    parser.add_argument('--volume')
+    parser.add_argument('--landmarks')
+    parser.add_argument('--skip', default='')
+    parser.add_argument('--labels', default='')
+    args = parser.parse_args(argv)
+    if not args.worker and not args.manifest:
+        parser.error('--manifest is required')
+    if args.write_threads is None:
+        #all cores for each of the parallel workers would oversubscribe the node
+        args.write_threads = max(1, multiprocessing.cpu_count() // max(1, args.workers))
+    if args.out_of_core and args.interpolation not in ('nearest', 'linear'):
+        parser.error('--out-of-core supports nearest or linear --interpolation')
+    if args.out_of_core and args.refine:
+        parser.error('--refine needs the case volumes loaded, it can not be combined with --out-of-core')
+    return args
+
+def main(argv):
+    args = parseArguments(argv)
+    if args.worker:
+        return runWorker(args)
+    return runDriver(args)
+
+if __name__ == '__main__':
+    exitCode = main(sys.argv[1:])
+    try:
+        import slicer
+        slicer.util.exit(exitCode)
+    except (ImportError, AttributeError):
+        sys.exit(exitCode)
@@ -0,0 +1,192 @@
+"""
+Headless benchmark of the align, harden & crop stages on synthetic volumes.
+
+    Slicer --no-splash --no-main-window --python-script AlignCrop3DSlicerModuleBenchmark.py
+        --sizes 128 256 512 1024 --dtypes uint8 int16 float32
+        --baselines baselines.json --output results.json
+
+Every stage (runAlignmentRegistration, hardening, runDefineCropROIVoxel, runCropVolume
+and the fused runAlignCropVolume) is timed separately, with the peak resident memory
+reached during the stage. With --baselines the results are compared against stored
+results and the script exits with a non-zero code when a stage is slower (or uses
+more memory) than its baseline by more than the regression threshold.
+--update-baselines writes the current results as the new baselines instead.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+import numpy
+import slicer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from AlignCrop3DSlicerModule import AlignCrop3DSlicerModuleLogic, AlignCrop3DSlicerModuleProfiler
+
+#
+# Memory
+#
+
+class PeakMemorySampler(object):
+    """Samples the resident memory in a background thread while a stage runs
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+
+    def __enter__(self):
+        self.startRSS = AlignCrop3DSlicerModuleProfiler.currentRSS()
+        self.peakRSS = self.startRSS
+        self.running = True
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while self.running:
+            self.peakRSS = max(self.peakRSS, AlignCrop3DSlicerModuleProfiler.currentRSS())
+            time.sleep(self.interval)
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peakRSS = max(self.peakRSS, AlignCrop3DSlicerModuleProfiler.currentRSS())
+
+def timeStage(results, key, function, *args, **kwargs):
+    cpuClock = getattr(time, 'process_time', None) or time.clock
+    with PeakMemorySampler() as memory:
+        startWall, startCPU = time.time(), cpuClock()
+        value = function(*args, **kwargs)
+        wall, cpu = time.time() - startWall, cpuClock() - startCPU
+    results[key] = { 'wallSeconds'  : round(wall, 4),
+                     'cpuSeconds'   : round(cpu, 4),
+                     'peakRSSMB'    : round(memory.peakRSS / 1048576.0, 1),
+                     'deltaRSSMB'   : round((memory.peakRSS - memory.startRSS) / 1048576.0, 1) }
+    print('%-40s %8.3f s  peak %8.1f MB' % (key, wall, results[key]['peakRSSMB']))
+    return value
+
+#
+# Synthetic data
+#
+
+def createSyntheticVolume(logic, name, size, dtype, spacing):
+    """Cube with a centred sphere & a gradient, so interpolation has something to do
+    """
+    ijkToRAS = numpy.diag([spacing, spacing, spacing, 1.0])
+    ijkToRAS[:3, 3] = -spacing * (size - 1) / 2.0
+    volume, voxels = logic.createVolumeNode(name, (size, size, size), dtype, ijkToRAS)
+
+    coordinates = numpy.arange(size, dtype=numpy.float32) - (size - 1) / 2.0
+    info = numpy.iinfo(dtype) if numpy.issubdtype(dtype, numpy.integer) else None
+    maximum = min(info.max, 1000) if info else 1000.0
+    for k in range(size):
+        radius2 = coordinates[numpy.newaxis, :] ** 2 + coordinates[:, numpy.newaxis] ** 2 + coordinates[k] ** 2
+        sliceValues = (radius2 < (size / 3.0) ** 2) * (maximum / 2.0) + (coordinates[numpy.newaxis, :] + size / 2.0) * (maximum / 2.0 / size)
+        voxels[k] = sliceValues.astype(dtype)
+    volume.GetImageData().Modified()
+    return volume
+
+def createFiducials(name, points):
+    fiducials = slicer.vtkMRMLMarkupsFiducialNode()
+    fiducials.SetName(name)
+    slicer.mrmlScene.AddNode(fiducials)
+    for point in points:
+        fiducials.AddFiducialFromArray(point)
+    return fiducials
+
+def runCase(logic, size, dtype, spacing, results):
+    prefix = '%d_%s_' % (size, numpy.dtype(dtype).name)
+
+    inputVolume     = createSyntheticVolume(logic, 'Input', size, dtype, spacing)
+    templateVolume  = createSyntheticVolume(logic, 'Template', max(size // 2, 8), dtype, spacing)
+
+    #Known rigid transform between the placed & template landmarks
+    extent = spacing * size / 4.0
+    fixedPoints = numpy.array([[extent, 0, 0], [0, extent, 0], [0, 0, extent], [-extent, -extent, 0]])
+    angle = numpy.radians(10)
+    rotation = numpy.array([[numpy.cos(angle), -numpy.sin(angle), 0], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]])
+    movingPoints = (fixedPoints - [spacing, 2 * spacing, 0]).dot(rotation)
+    templateFiducial    = createFiducials('TemplateFiducials', fixedPoints)
+    movingFiducial      = createFiducials('MovingFiducials', movingPoints)
+    placementChecklist  = dict((key, True) for key in logic.landmarkOrderCO)
+
+    transform = slicer.vtkMRMLTransformNode()
+    slicer.mrmlScene.AddNode(transform)
+    timeStage(results, prefix + 'alignmentRegistration', logic.runAlignmentRegistration,
+              transform, templateFiducial, movingFiducial, placementChecklist)
+
+    templateROI = timeStage(results, prefix + 'defineCropROIVoxel', logic.runDefineCropROIVoxel, templateVolume)
+
+    inputVolume.SetAndObserveTransformNodeID(transform.GetID())
+    timeStage(results, prefix + 'alignCropVolume', logic.runAlignCropVolume, templateROI, inputVolume)
+
+    timeStage(results, prefix + 'harden', slicer.vtkSlicerTransformLogic().hardenTransform, inputVolume)
+    timeStage(results, prefix + 'cropVolume', logic.runCropVolume, templateROI, inputVolume)
+
+    slicer.mrmlScene.Clear(0)
+
+#
+# Baselines
+#
+
+def compareBaselines(results, baselines, threshold, memoryThreshold):
+    """Returns the list of regressions (stages slower or larger than baseline + threshold)
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        baseline = baselines.get(key)
+        if not baseline:
+            continue
+        if result['wallSeconds'] > baseline['wallSeconds'] * (1.0 + threshold) and result['wallSeconds'] - baseline['wallSeconds'] > 0.05:
+            regressions.append('%s: %.3f s (baseline %.3f s)' % (key, result['wallSeconds'], baseline['wallSeconds']))
+        if result['deltaRSSMB'] > baseline['deltaRSSMB'] * (1.0 + memoryThreshold) and result['deltaRSSMB'] - baseline['deltaRSSMB'] > 16:
+            regressions.append('%s: %.1f MB (baseline %.1f MB)' % (key, result['deltaRSSMB'], baseline['deltaRSSMB']))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='AlignCrop3DSlicerModule benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512, 1024])
+    parser.add_argument('--dtypes', nargs='+', default=['uint8', 'int16', 'float32'])
+    parser.add_argument('--spacing', type=float, default=0.05, help='Voxel size (mm)')
+    parser.add_argument('--baselines', help='JSON file with the baseline results')
+    parser.add_argument('--update-baselines', action='store_true', help='Store the results as the new baselines')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed relative slow down')
+    parser.add_argument('--memory-threshold', type=float, default=0.25, help='Allowed relative memory increase')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    args = parser.parse_args(argv)
+
+    logic = AlignCrop3DSlicerModuleLogic()
+
+    results = {}
+    for size in args.sizes:
+        for dtype in args.dtypes:
+            runCase(logic, size, numpy.dtype(dtype), args.spacing, results)
+
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2, sort_keys=True)
+
+    if args.baselines and args.update_baselines:
+        baselines = {}
+        if os.path.exists(args.baselines):
+            with open(args.baselines) as baselineFile:
+                baselines = json.load(baselineFile)
+        baselines.update(results)
+        with open(args.baselines, 'w') as baselineFile:
+            json.dump(baselines, baselineFile, indent=2, sort_keys=True)
+        print('Baselines updated: %s' % args.baselines)
+    elif args.baselines:
+        with open(args.baselines) as baselineFile:
+            regressions = compareBaselines(results, json.load(baselineFile), args.threshold, args.memory_threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    exitCode = main(sys.argv[1:])
+    slicer.util.exit(exitCode)